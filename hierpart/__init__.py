@@ -1,5 +1,24 @@
 from hierpart import HierarchicalPartition
 from hierpart import load_hierarchical_partition
 from hierpart import save_hierarchical_partition
-from hierpart import hierarchical_mutual_informations
-from hierpart import normalized_hierarchical_mutual_informations
+from hierpart import sub_hierarchical_mutual_information
+from hierpart import hierarchical_mutual_information
+from hierpart import normalized_hierarchical_mutual_information
+from hierpart import levelwise_similarity
+from hierpart import HMICache
+from hierpart import PreparedHierarchy
+from hierpart import SharedHierarchy
+from hierpart import compare_hierarchy_files
+from hierpart import load_hierarchical_partition_binary
+from hierpart import save_hierarchical_partition_binary
+from hierpart import adjusted_nhmi
+from hierpart import hmi_pvalue
+from hierpart import bootstrap_nhmi
+from hierpart import TrackedComparison
+from hierpart import approximate_nhmi
+from hierpart import nhmi_at_least
+from hierpart import save_hierarchical_partition_labels
+from hierpart import out_of_core_hierarchical_mutual_information
+from hierpart import release_shared_memory
+from hierpart import node_bitsets
+from hierpart import membership_nbytes
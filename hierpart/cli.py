@@ -0,0 +1,299 @@
+# This code is published according to the
+# GNU General Public License (GPL) version 2
+#
+# Author: Juan I. Perotti
+# Personal disclaimer: Use this code at your own risk.
+
+"""The **hierpart** command, to compare and describe hierarchical partitions stored in files.
+
+Usage examples::
+
+    $ hierpart compare reference.txt candidate_*.txt --jobs 8 --output nhmi.csv
+    $ hierpart matrix run_*.npz --norm add --jobs 8 --output nhmi.npy --checkpoint nhmi.ckpt
+    $ hierpart stats run_*.txt
+
+Files ending in '.npz' are read with **load_hierarchical_partition_binary()**; any other file with **load_hierarchical_partition()**.
+"""
+
+import os
+import sys
+import csv
+import argparse
+import collections
+import multiprocessing
+import numpy
+from hierpart import load_hierarchical_partition
+from hierpart import load_hierarchical_partition_binary
+from hierpart import HierarchicalPartition
+from hierpart import PreparedHierarchy
+from hierpart import release_shared_memory
+from hierpart import _normalize_hmi
+
+##############################################################################
+# Private Functions ##########################################################
+##############################################################################
+
+def _load(filename):
+    if filename.endswith('.npz'):
+        return load_hierarchical_partition_binary(filename)
+    return load_hierarchical_partition(filename)
+
+def _pool_map(function,tasks,n_jobs,initializer=None,initargs=()):
+    """Maps **function** over **tasks**, in order, using a pool of **n_jobs** processes (or none, if n_jobs is 1)."""
+    if n_jobs==1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield function(task)
+        return
+    pool=multiprocessing.Pool(n_jobs,initializer=initializer,initargs=initargs)
+    try:
+        for result in pool.imap(function,tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+_WORKER={}
+
+def _init_compare_worker(prepared):
+    _WORKER['prepared']=prepared
+
+def _compare_worker(filename):
+    return (filename,)+_WORKER['prepared'].compare(_load(filename))
+
+def _init_matrix_worker(filenames,norm):
+    _WORKER['filenames']=filenames
+    _WORKER['norm']=norm
+    _WORKER['hierarchies']=collections.OrderedDict()
+
+_MAX_WORKER_HIERARCHIES=8
+
+def _worker_hierarchy(i):
+    """Returns the i-th tree, loading it from its file unless it is among the **_MAX_WORKER_HIERARCHIES** trees this worker used last."""
+    hierarchies=_WORKER['hierarchies']
+    try:
+        hp=hierarchies.pop(i)
+    except KeyError:
+        hp=_load(_WORKER['filenames'][i])
+    hierarchies[i]=hp
+    while len(hierarchies)>_MAX_WORKER_HIERARCHIES:
+        hierarchies.popitem(last=False)
+    return hp
+
+def _matrix_worker(task):
+    """Compares the i-th tree against the trees j of the task (i,js), preparing it only once.
+
+    Only the tree i is held for the whole task; the trees j go through the small cache of **_worker_hierarchy()**, so a worker never holds more than a few trees.
+    """
+    i,js=task
+    prepared=PreparedHierarchy(_load(_WORKER['filenames'][i]),norm=_WORKER['norm'])
+    return i,[(j,)+prepared.compare(_worker_hierarchy(j)) for j in js]
+
+def _stats_worker(filename):
+    hp=_load(filename)
+    depths=hp.depths_basic_stats()
+    branching=hp.branching_factors_basic_stats() if hp.num_nodes()>1 else (0.0,0.0,0.0,0.0,0)
+    return (filename,hp.num_nodes(),hp.total_num_elements(),hp.max_depth(),depths[4],depths[0],branching[0],hp.hierarchical_entropy())
+
+def _read_checkpoint(checkpoint,filenames):
+    """Returns the rows of the checkpoint file, as a dict (i,j)->values, after checking it belongs to the same list of files."""
+    done={}
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return done
+    header=[]
+    with open(checkpoint,'r') as fh:
+        for line in fh:
+            if line.startswith('#'):
+                header.append(line.rstrip('\n'))
+                continue
+            if not line.endswith('\n'):
+                continue # A line cut by an interruption, maybe inside its last value.
+            cols=line.strip().split(',')
+            if len(cols)!=6:
+                continue # A line cut by an interruption, and ended by a later run.
+            done[int(cols[0]),int(cols[1])]=tuple(float(v) for v in cols[2:])
+    assert header==_checkpoint_header(filenames),'ERROR: the checkpoint file belongs to a different list of files.'
+    return done
+
+def _checkpoint_header(filenames):
+    return ['# hierpart matrix checkpoint']+['# file %d %s' % (i,filename) for i,filename in enumerate(filenames)]
+
+def _write_table(rows,header,output):
+    if output is None:
+        fhw=sys.stdout
+    else:
+        fhw=open(output,'wb')
+    writer=csv.writer(fhw)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([repr(v) if isinstance(v,float) else v for v in row])
+    if output is not None:
+        fhw.close()
+
+##############################################################################
+# Commands ###################################################################
+##############################################################################
+
+def compare(args):
+    """Compares a reference tree against each of the given trees.
+
+    With several jobs, the workers attach the reference from a shared memory segment, instead of sharing the tree copy-on-write, which its reference counts would soon copy into each of them.
+    """
+    reference=_load(args.reference)
+    name=None
+    if args.jobs!=1:
+        name=reference.to_shared_memory()
+        reference=HierarchicalPartition.attach(name)
+    try:
+        prepared=PreparedHierarchy(reference,norm=args.norm)
+        rows=list(_pool_map(_compare_worker,args.files,args.jobs,_init_compare_worker,(prepared,)))
+    finally:
+        if name is not None:
+            release_shared_memory(name)
+    header=['filename','NHMI','HMI_xy','HMI_xx','HMI_yy']
+    if args.output is not None and args.output.endswith('.npy'):
+        numpy.save(args.output,numpy.array([row[1:] for row in rows],dtype=numpy.double))
+    else:
+        _write_table(rows,header,args.output)
+
+def matrix(args):
+    """Compares all the given trees against each other, and writes the matrix of normalized hierarchical mutual informations.
+
+    The trees are not loaded here: each worker loads, from their files, only the trees its comparisons need, so they are neither held by this process nor sent to the workers.
+    """
+    n=len(args.files)
+    done=_read_checkpoint(args.checkpoint,args.files)
+    pending=[(i,[j for j in xrange(i+1,n) if (i,j) not in done]) for i in xrange(n)]
+    pending=[task for task in pending if task[1]]
+    fhw=None
+    if args.checkpoint is not None:
+        if os.path.exists(args.checkpoint):
+            # Drops the line cut by an interruption, which was ignored, so that the new rows do not extend it.
+            with open(args.checkpoint,'r+b') as fh:
+                fh.seek(0,os.SEEK_END)
+                size=fh.tell()
+                fh.seek(max(0,size-4096))
+                tail=fh.read()
+                if not tail.endswith('\n'):
+                    fh.truncate(size-len(tail)+tail.rfind('\n')+1)
+        new=not os.path.exists(args.checkpoint) or os.path.getsize(args.checkpoint)==0
+        fhw=open(args.checkpoint,'a')
+        if new:
+            print >>fhw,'\n'.join(_checkpoint_header(args.files))
+    try:
+        for i,row in _pool_map(_matrix_worker,pending,args.jobs,_init_matrix_worker,(args.files,args.norm)):
+            for values in row:
+                done[i,values[0]]=values[1:]
+                if fhw is not None:
+                    print >>fhw,','.join([str(i),str(values[0])]+[repr(v) for v in values[1:]])
+            if fhw is not None:
+                fhw.flush()
+    finally:
+        if fhw is not None:
+            fhw.close()
+    # The diagonal needs I(T;T) of each tree, which every comparison involving it already holds.
+    entropies={}
+    for (i,j),values in done.items():
+        entropies[i]=values[2]
+        entropies[j]=values[3]
+    M=numpy.zeros((n,n),dtype=numpy.double)
+    for i in xrange(n):
+        HMI_xx=entropies[i] if i in entropies else _load(args.files[i]).hierarchical_entropy()
+        M[i,i]=_normalize_hmi(HMI_xx,HMI_xx,HMI_xx,args.norm)[0]
+    for (i,j),values in done.items():
+        M[i,j]=M[j,i]=values[0]
+    if args.output is not None and args.output.endswith('.npy'):
+        numpy.save(args.output,M)
+    else:
+        _write_table([[filename]+M[i].tolist() for i,filename in enumerate(args.files)],['filename']+args.files,args.output)
+
+def stats(args):
+    """Describes each of the given trees."""
+    rows=_pool_map(_stats_worker,args.files,args.jobs)
+    header=['filename','num_nodes','num_elements','max_depth','num_leaves','avrg_leaf_depth','avrg_branching_factor','hierarchical_entropy']
+    _write_table(rows,header,args.output)
+
+def main(argv=None):
+    """Runs the **hierpart** command with the arguments **argv** (by default, those of the command line).
+
+    Example
+    -------
+    >>> import os, csv, shutil, tempfile
+    >>> from hierpart import HierarchicalPartition, save_hierarchical_partition, save_hierarchical_partition_binary
+    >>> tmpdir=tempfile.mkdtemp()
+    >>> hpx=HierarchicalPartition(range(8))
+    >>> n1=hpx.add_child(hpx.root(),range(4))
+    >>> n2=hpx.add_child(hpx.root(),range(4,8))
+    >>> for i in xrange(0,8,2): dummy=hpx.add_child(n1 if i<4 else n2,range(i,i+2))
+    >>> hpy=HierarchicalPartition(range(8))
+    >>> n1=hpy.add_child(hpy.root(),range(2))
+    >>> n2=hpy.add_child(hpy.root(),range(2,8))
+    >>> hpz=HierarchicalPartition(range(8))
+    >>> for i in xrange(0,8,4): dummy=hpz.add_child(hpz.root(),range(i,i+4))
+    >>> files=[os.path.join(tmpdir,name) for name in ('x.txt','y.txt','z.npz')]
+    >>> save_hierarchical_partition(hpx,files[0])
+    >>> save_hierarchical_partition(hpy,files[1])
+    >>> save_hierarchical_partition_binary(hpz,files[2])
+    >>> output=os.path.join(tmpdir,'nhmi.npy')
+    >>> main(['compare',files[0]]+files+['--jobs','2','--output',output])
+    >>> print ' '.join('%.6f' % v for v in numpy.load(output)[:,0])
+    1.000000 0.244370 0.707107
+    >>> # A matrix, and the same matrix resumed from a checkpoint cut inside the last value of its second comparison.
+    >>> checkpoint=os.path.join(tmpdir,'nhmi.ckpt')
+    >>> main(['matrix']+files+['--jobs','2','--output',output,'--checkpoint',checkpoint])
+    >>> M=numpy.load(output)
+    >>> for row in M: print ' '.join('%.6f' % v for v in row)
+    1.000000 0.244370 0.707107
+    0.244370 1.000000 0.345592
+    0.707107 0.345592 1.000000
+    >>> lines=open(checkpoint).readlines()
+    >>> len(lines)
+    7
+    >>> fhw=open(checkpoint,'w')
+    >>> fhw.write(''.join(lines[:5])+lines[5][:-4])
+    >>> fhw.close()
+    >>> main(['matrix']+files+['--output',output,'--checkpoint',checkpoint])
+    >>> numpy.allclose(numpy.load(output),M), open(checkpoint).readlines()==lines
+    (True, True)
+    >>> output=os.path.join(tmpdir,'stats.csv')
+    >>> main(['stats']+files+['--output',output])
+    >>> for row in csv.reader(open(output)): print os.path.basename(row[0]), row[1:4], row[4]
+    filename ['num_nodes', 'num_elements', 'max_depth'] num_leaves
+    x.txt ['7', '8', '2'] 4
+    y.txt ['3', '8', '1'] 2
+    z.npz ['3', '8', '1'] 2
+    >>> shutil.rmtree(tmpdir)
+    """
+    parser=argparse.ArgumentParser(prog='hierpart',description='Compare and describe hierarchical partitions stored in files (text, or binary if ending in .npz).')
+    subparsers=parser.add_subparsers()
+
+    def add_common(subparser,norm=True):
+        if norm:
+            subparser.add_argument('--norm',default='CS',choices=['CS','add','max'],help='normalization of the hierarchical mutual information (default: CS).')
+        subparser.add_argument('--jobs',type=int,default=1,help='number of worker processes (default: 1).')
+        subparser.add_argument('--output',default=None,help='output file; .npy for a numpy array, else CSV (default: CSV to stdout).')
+
+    p=subparsers.add_parser('compare',help='compare a reference against each file.')
+    p.add_argument('reference')
+    p.add_argument('files',nargs='+')
+    add_common(p)
+    p.set_defaults(command=compare)
+
+    p=subparsers.add_parser('matrix',help='compare all files against each other.')
+    p.add_argument('files',nargs='+')
+    add_common(p)
+    p.add_argument('--checkpoint',default=None,help='file recording the finished comparisons, to resume an interrupted job.')
+    p.set_defaults(command=matrix)
+
+    p=subparsers.add_parser('stats',help='describe each file.')
+    p.add_argument('files',nargs='+')
+    add_common(p,norm=False)
+    p.set_defaults(command=stats)
+
+    args=parser.parse_args(argv)
+    assert args.jobs>0,'ERROR: --jobs should be positive.'
+    args.command(args)
+
+if __name__=='__main__':
+    main()
@@ -5,7 +5,17 @@
 # Personal disclaimer: Use this code at your own risk.
 
 import sys
-from collections import defaultdict
+import time
+import multiprocessing
+import hashlib
+import sqlite3
+import heapq
+import os
+import shutil
+import tempfile
+import weakref
+from collections import defaultdict, deque
+from multiprocessing.pool import ThreadPool
 import numpy
 import random
 from operator import itemgetter
@@ -19,6 +29,39 @@ def _basic_stats(l):
     a=numpy.array(l,dtype=numpy.double)
     return a.mean(),a.min(),a.max(),a.std(),len(a)
 
+def _elements_array(elements):
+    """Returns the elements as a <numpy.ndarray>: of int64 if all of them are integers, else of their str()."""
+    if isinstance(elements,numpy.ndarray) and elements.dtype.kind in 'iu':
+        return elements.astype(numpy.int64)
+    if all(isinstance(e,(int,long,numpy.integer)) for e in elements):
+        return numpy.array(elements,dtype=numpy.int64)
+    return numpy.array([str(e) for e in elements])
+
+# Shared memory
+###############
+
+# Python 2 lacks <multiprocessing.shared_memory>, so the arrays are shared as .npy files in a memory-backed
+# directory (/dev/shm, when available), that each process maps read-only: the pages are shared, not copied.
+
+_SHARED_MEMORY_DIR='/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm',os.W_OK) else None
+
+def _share_arrays(arrays):
+    """Writes the arrays of the dict (skipping None values) into a new shared memory segment, and returns its name."""
+    name=tempfile.mkdtemp(prefix='hierpart-',dir=_SHARED_MEMORY_DIR)
+    for key,array in arrays.items():
+        if array is not None:
+            numpy.save(os.path.join(name,key+'.npy'),array)
+    return name
+
+def _attach_arrays(name):
+    """Returns a dict with read-only memory maps of the arrays of the shared memory segment **name**."""
+    assert os.path.isdir(name),'ERROR: there is no shared memory segment named '+repr(name)
+    arrays={}
+    for filename in os.listdir(name):
+        if filename.endswith('.npy'):
+            arrays[filename[:-4]]=numpy.load(os.path.join(name,filename),mmap_mode='r')
+    return arrays
+
 ##############################################################################
 # Classes ####################################################################
 ##############################################################################
@@ -27,12 +70,19 @@ class HierarchicalPartition:
     """This class implements the hierarchical partition data structure.
     It is able to contain any kind of element that can be contained in a set.
 
+    Comments:
+        The data derived from the tree (eg., the traversal orders, the node table, the label matrix, the hashes or the entropies) is computed on first use, and cached until the next modification of the tree. The cached arrays are read-only, and so are the views of them that the methods return.
+
     Parameters
     ----------
     elements : <list>
         The list of elements that are going to be contained by the HierarchicalPartition.
     checks : <bool>
         If True, different (slow) checks run througth the creation of the object, plus in some other methods. This is True by default.
+    weights : <list=None>
+        Optional non-negative weights of the elements, in the same order as **elements**. Then, the hierarchical mutual informations count every element by its weight instead of once, as if it were duplicated that many times. By default, every element has weight 1.
+    elements_are_indices : <bool=False>
+        If True, the elements should be the integers 0,1,...,N-1, in this order. Then, the elements of each node are stored as a (read-only) int64 <numpy.ndarray>, which are their own encoded ids (see **_element_ids()**): no table of elements is built, and neither the construction nor the hierarchical mutual informations between two such trees hash the elements. Such trees can only be modified with **add_child()**.
 
     Returns
     -------
@@ -81,17 +131,45 @@ class HierarchicalPartition:
     5 ['b']
     6 ['c']
     """
-    def __init__(self,elements,checks=True):
+    def __init__(self,elements,checks=True,weights=None,elements_are_indices=False):
         self._checks=bool(checks)
-        self._elements=list(elements)
+        self._indices=bool(elements_are_indices)
+        if self._indices:
+            self._elements=numpy.array(elements,dtype=numpy.int64)
+            assert self._elements.ndim==1,'ERROR: the elements should be a sequence of integers.'
+            if self._checks:
+                assert numpy.array_equal(self._elements,numpy.arange(len(self._elements))),'ERROR: with elements_are_indices, the elements should be 0,1,...,N-1.'
+            self._elements.flags.writeable=False
+        else:
+            self._elements=list(elements)
+        if weights is None:
+            self._weights=None
+        else:
+            self._weights=numpy.array(weights,dtype=numpy.double)
+            assert self._weights.shape==(len(self._elements),),'ERROR: there should be one weight per element.'
+            assert (self._weights>=0.0).all(),'ERROR: the weights should be non-negative.'
+            self._weights.flags.writeable=False
         self._tree=nx.DiGraph()
         self._N=1
         self._root=self._N-1
+        self._next_node=self._N
         self._tree.add_node(self._root)
         self._node_elements={}
-        self._node_elements[self._root]=elements
+        self._node_elements[self._root]=self._elements
         self._node_depth={}
         self._node_depth[self._root]=0
+        self._deepest=None
+        self._weights_buffer=None
+        self._trackers=None
+        self._cache={}
+
+    def __getstate__(self):
+        # The cached arrays are not pickled; they are cheaper to recompute than to transfer.
+        state=self.__dict__.copy()
+        state['_cache']={}
+        state['_weights_buffer']=None
+        state['_trackers']=None
+        return state
 
     def tree(self):
         """The returned tree describes the topology of the hierarchical partition.
@@ -126,6 +204,23 @@ class HierarchicalPartition:
             True or False, depending on how it was defined at the object creation."""
         return self._checks
 
+    def elements_are_indices(self):
+        """
+        Returns
+        -------
+        : <bool>
+            True if the elements are the integers 0,1,...,N-1, stored as <numpy.ndarray> (see **HierarchicalPartition**).
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(range(6),elements_are_indices=True)
+        >>> n1=hp.add_child(hp.root(),[0,1,2])
+        >>> print hp.elements_are_indices(), hp.node_elements(n1)
+        True [0 1 2]
+        """
+        return self._indices
+
     def num_nodes(self):
         """
         Returns
@@ -414,6 +509,69 @@ class HierarchicalPartition:
         """
         return self.node_elements(self.root())
 
+    def element_weights(self):
+        """Returns the weights of the elements, in the order of **all_elements()**.
+
+        Returns
+        -------
+        : <numpy.ndarray> or None
+            The (read-only) weights, or None if the elements are not weighted.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c'],weights=[2.0,1.0,0.5])
+        >>> n1=hp.add_child(hp.root(),['a','b'])
+        >>> print hp.element_weights().tolist(), hp.node_weight(n1)
+        [2.0, 1.0, 0.5] 3.0
+        >>> print HierarchicalPartition(['a','b','c']).element_weights()
+        None
+        """
+        return self._weights
+
+    def node_weight(self,node):
+        """Returns the total weight of the elements of node **node**; ie., its size if the elements are not weighted.
+
+        Parameters
+        ----------
+        node : "node"
+            A node of the tree.
+
+        Returns
+        -------
+        : <float>
+            The weight of the node.
+        """
+        if self._weights is None:
+            return float(self.node_size(node))
+        return float(self._weights[self._element_ids(node)].sum())
+
+    def _element_index(self):
+        """Returns a dict mapping each element to its position in **all_elements()**, ie., its encoded id. The dict is cached until the next modification of the tree."""
+        try:
+            return self._cache['element_index']
+        except KeyError:
+            pass
+        _index={}
+        for i,element in enumerate(self.all_elements()):
+            _index[element]=i
+        self._cache['element_index']=_index
+        return _index
+
+    def _element_ids(self,node):
+        """Returns the elements of node **node** encoded as a <numpy.ndarray> of positions in **all_elements()**. The arrays are cached until the next modification of the tree."""
+        if self._indices:
+            return self._node_elements[node]
+        _ids=self._cache.setdefault('element_ids',{})
+        try:
+            return _ids[node]
+        except KeyError:
+            pass
+        _index=self._element_index()
+        a=numpy.fromiter((_index[e] for e in self.node_elements(node)),dtype=numpy.int64,count=self.node_size(node))
+        _ids[node]=a
+        return a
+
     def total_num_elements(self):
         """Returns the number of elements contained in the tree.
 
@@ -455,7 +613,7 @@ class HierarchicalPartition:
         >>> print hp.max_depth()
         3
         """
-        return max([self.node_depth(node) for node in self.nodes()])
+        return int(self.node_table()['depth'].max())
 
     def depths_basic_stats(self):
         """Return *basic_stats* about the list of depths of the leaves in the tree.
@@ -486,7 +644,8 @@ class HierarchicalPartition:
         >>> print hp.depths_basic_stats()
         (2.25, 1.0, 3.0, 0.82915619758884995, 4)
         """
-        return _basic_stats([self.node_depth(node) for node in self.leaves()])
+        table=self.node_table()
+        return _basic_stats(table['depth'][table['leaf']])
 
     def max_size(self):
         """Returns the size of the node with the largest size in the tree, aka, the root.
@@ -499,7 +658,7 @@ class HierarchicalPartition:
         : <int>
             The size of the largest node in the tree. The size of a node is measured as the number of elements the node contains. It should be the size of the root.
         """
-        _max_size=max([self.node_size(node) for node in self.nodes()])
+        _max_size=int(self.node_table()['size'].max())
         assert _max_size==self.node_size(self.root()), "ERROR: The root is not the node with the largest size!"
         return _max_size
 
@@ -510,7 +669,7 @@ class HierarchicalPartition:
         -------
         : <int> 
             The size of the smallest node in the tree. The size of a node is measured as the number of elements the node contains.""" 
-        _min_size=min([self.node_size(node) for node in self.nodes()])
+        _min_size=int(self.node_table()['size'].min())
         assert _min_size>0, "ERROR: There is a node with size<=0."
         return _min_size
 
@@ -543,10 +702,11 @@ class HierarchicalPartition:
         >>> print hp.branching_factors(no_leaves=False)
         [2, 2, 0, 0, 2, 0, 0]
         """
+        table=self.node_table()
         if no_leaves:
-            return [self.node_branching_factor(node) for node in self.nodes() if not self.node_leaf(node)]
+            return table['branching_factor'][~table['leaf']].tolist()
         else:
-            return [self.node_branching_factor(node) for node in self.nodes()]
+            return table['branching_factor'].tolist()
 
     def branching_factors_basic_stats(self,no_leaves=True):
         """Return *basic_stats* about the list of depths in the tree.
@@ -590,6 +750,7 @@ class HierarchicalPartition:
 
         Remarks:
         If **checks** is set to True (at the moment of the creation of the HierarchicalPartition object), then, the current method checks that the set of elements in the new child is contained by the set of elements of the parent node.
+        The tree keeps its own copy of **child_elements**.
 
         Parameters
         ----------
@@ -613,38 +774,642 @@ class HierarchicalPartition:
         ['a', 'b', 'c']
         """
         self._N+=1
-        new_child=self._N-1
+        new_child=self._next_node
+        self._next_node+=1
         if self.checks():
             assert parent in self._tree.nodes(),'ERROR in add_child: "parent" is not in the "tree".'
         self._tree.add_edge(parent,new_child)
+        if self._indices:
+            child_elements=numpy.array(child_elements,dtype=numpy.int64)
+            child_elements.flags.writeable=False
+        else:
+            child_elements=list(child_elements)
         if self.checks():
             try:
-                assert set(child_elements) <= set(self.node_elements(parent)), 'ERROR in add_child: the "elements" in the child is not a subset of the "elements" in the parent.'
+                if self._indices:
+                    assert numpy.in1d(child_elements,self.node_elements(parent)).all(), 'ERROR in add_child: the "elements" in the child is not a subset of the "elements" in the parent.'
+                else:
+                    assert set(child_elements) <= set(self.node_elements(parent)), 'ERROR in add_child: the "elements" in the child is not a subset of the "elements" in the parent.'
             except:
                 print '# child_elements',child_elements
                 print '# parent_elements',self.node_elements(parent)
                 assert False
         self._node_elements[new_child]=child_elements
         self._node_depth[new_child]=self._node_depth[parent]+1
+        if self._deepest is not None:
+            for e in child_elements:
+                self._deepest[e]=new_child
+        self._modified([parent],changed=[])
         return new_child
 
+    def _modified(self,nodes,changed=None,removed=()):
+        """Clears the cache after a modification of the tree, and tells the trackers (see **TrackedComparison**) which nodes saw their sub-tree change, and which nodes were **removed**.
+
+        If **changed** is given, the elements of the root kept their positions (new ones may have been appended), and only the nodes in **changed** saw their elements change. Then, the element index and the encoded elements of the other nodes (see **_element_ids()**) are kept.
+        """
+        kept={}
+        if changed is not None:
+            for key in ('element_index','element_ids'):
+                if key in self._cache:
+                    kept[key]=self._cache[key]
+            _ids=kept.get('element_ids')
+            if _ids:
+                for node in changed:
+                    _ids.pop(node,None)
+        self._cache.clear()
+        self._cache.update(kept)
+        if self._trackers:
+            for tracker in list(self._trackers):
+                tracker._touch(self,nodes,removed)
+
+    # Mutation of the tree
+    # Nodes keep their names across edits, and new nodes are never given the name of a removed one.
+    # Every element list is owned by its tree (add_child() copies the lists it is given), so the lists can be modified in place.
+
+    def _ancestors(self,node):
+        """Returns the list of the ancestors of node **node**, from its parent up to the root."""
+        ancestors=[]
+        parent=self.node_parent(node)
+        while parent is not None:
+            ancestors.append(parent)
+            parent=self.node_parent(parent)
+        return ancestors
+
+    def _subtree_nodes(self,node):
+        """Returns the list of the nodes of the sub-tree rooted at node **node**, in BFS order."""
+        nodes=[node]
+        i=0
+        while i<len(nodes):
+            nodes.extend(self._tree[nodes[i]])
+            i+=1
+        return nodes
+
+    def _deepest_nodes(self):
+        """Returns the dict mapping each element to the deepest node containing it. It is built on first use, and then kept up to date by **add_child()** and the mutation methods."""
+        if self._deepest is None:
+            self._deepest={}
+            for node in self.bfs_traversal():
+                for e in self.node_elements(node):
+                    self._deepest[e]=node
+        return self._deepest
+
+    def _set_root_elements(self,elements):
+        if self._weights is not None:
+            _index=self._element_index()
+            self._weights=self._weights[[_index[e] for e in elements]]
+            self._weights.flags.writeable=False
+            self._weights_buffer=None
+        self._elements=elements
+        self._node_elements[self.root()]=elements
+
+    def _append_weights(self,weights):
+        """Appends weights for new elements of the root, growing a buffer geometrically so that the appends take amortized constant time per element."""
+        n=len(self._weights)
+        k=len(weights)
+        if self._weights_buffer is None or len(self._weights_buffer)<n+k:
+            buffer=numpy.empty(max(2*n,n+k,16),dtype=numpy.double)
+            buffer[:n]=self._weights
+            self._weights_buffer=buffer
+        self._weights_buffer[n:n+k]=weights
+        self._weights=self._weights_buffer[:n+k]
+        self._weights.flags.writeable=False
+
+    def _remove_elements(self,nodes,elements):
+        """Removes the set of elements **elements** from each of the nodes **nodes**."""
+        for node in nodes:
+            kept=[e for e in self._node_elements[node] if e not in elements]
+            if node==self.root():
+                self._set_root_elements(kept)
+            else:
+                self._node_elements[node]=kept
+
+    def _add_elements(self,nodes,elements):
+        """Appends the list of elements **elements** to each of the nodes **nodes**, none of which is the root."""
+        for node in nodes:
+            self._node_elements[node].extend(elements)
+
+    def remove_subtree(self,node):
+        """Removes a node, together with its sub-tree and its elements, from the tree.
+
+        Comments:
+            The elements of the node are removed from all its ancestors too. To turn a node into a leaf, remove its children instead.
+            It takes time proportional to the size of the sub-tree plus the sizes of the ancestors of the node.
+
+        Parameters
+        ----------
+        node : "node"
+            A node of the tree, other than the root.
+
+        Returns
+        -------
+        : <list>
+            The removed elements.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> hp.remove_subtree(n3)
+        ['b', 'c']
+        >>> hp.show()
+        0 ['a', 'd', 'e', 'f']
+        1 ['a']
+        2 ['d', 'e', 'f']
+        3 ['a']
+        """
+        assert not self._indices,'ERROR in remove_subtree: the trees with elements_are_indices only support add_child().'
+        assert node!=self.root(),'ERROR in remove_subtree: the root cannot be removed.'
+        parent=self.node_parent(node)
+        removed=self.node_elements(node)
+        self._remove_elements(self._ancestors(node),set(removed))
+        subtree=self._subtree_nodes(node)
+        for v in subtree:
+            del self._node_elements[v]
+            del self._node_depth[v]
+        self._tree.remove_nodes_from(subtree)
+        self._N-=len(subtree)
+        if self._deepest is not None:
+            for e in removed:
+                self._deepest.pop(e,None)
+        self._modified([parent],removed=subtree)
+        return removed
+
+    def merge_siblings(self,node,sibling):
+        """Merges a node into one of its siblings.
+
+        Comments:
+            The node **sibling** disappears: its elements are appended to **node**, and its children become children of **node**. To keep the tree consistent, either both nodes or none of them should be leaves.
+            It takes time proportional to the size of **sibling** plus its number of children.
+
+        Parameters
+        ----------
+        node : "node"
+            The node that remains.
+        sibling : "node"
+            The node merged into **node**. It should have the same parent as **node**.
+
+        Returns
+        -------
+        : "node"
+            The merged node, ie., **node**.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> hp.merge_siblings(n1,n2)
+        1
+        >>> hp.show()
+        0 ['a', 'b', 'c', 'd', 'e', 'f']
+        1 ['a', 'b', 'c', 'd', 'e', 'f']
+        3 ['a']
+        4 ['b', 'c']
+        """
+        assert not self._indices,'ERROR in merge_siblings: the trees with elements_are_indices only support add_child().'
+        parent=self.node_parent(node)
+        assert node!=sibling and parent is not None and self.node_parent(sibling)==parent,'ERROR in merge_siblings: the nodes should be different siblings.'
+        moved=self.node_elements(sibling)
+        self._add_elements([node],moved)
+        for child in list(self._tree[sibling]):
+            self._tree.add_edge(node,child)
+        self._tree.remove_node(sibling)
+        del self._node_elements[sibling]
+        del self._node_depth[sibling]
+        self._N-=1
+        if self._deepest is not None:
+            for e in moved:
+                if self._deepest.get(e)==sibling:
+                    self._deepest[e]=node
+        self._modified([node],changed=[node,sibling],removed=[sibling])
+        return node
+
+    def split_node(self,node,elements):
+        """Splits a node in two siblings.
+
+        Comments:
+            The elements **elements** are moved out of the node into a new sibling, together with the children of the node whose elements are all in **elements**. No child should have elements on both sides.
+            It takes time proportional to the size of the node plus the sizes of its children.
+
+        Parameters
+        ----------
+        node : "node"
+            A node of the tree, other than the root.
+        elements : <list>
+            The elements, of the node, that go to the new sibling.
+
+        Returns
+        -------
+        : "node"
+            The new sibling.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> hp.split_node(n1,['b','c'])
+        5
+        >>> hp.show()
+        0 ['a', 'b', 'c', 'd', 'e', 'f']
+        1 ['a']
+        2 ['d', 'e', 'f']
+        5 ['b', 'c']
+        3 ['a']
+        4 ['b', 'c']
+        >>> print hp.node_parent(n3)
+        5
+        """
+        assert not self._indices,'ERROR in split_node: the trees with elements_are_indices only support add_child().'
+        parent=self.node_parent(node)
+        assert parent is not None,'ERROR in split_node: the root cannot be split.'
+        moved=set(elements)
+        kept=[e for e in self.node_elements(node) if e not in moved]
+        assert len(kept)+len(moved)==self.node_size(node),'ERROR in split_node: "elements" is not a subset of the elements of "node".'
+        moved_children=[]
+        for child in self._tree[node]:
+            inside=sum(1 for e in self.node_elements(child) if e in moved)
+            assert inside in (0,self.node_size(child)),'ERROR in split_node: a child of "node" has elements on both sides of the split.'
+            if inside>0:
+                moved_children.append(child)
+        new_node=self._next_node
+        self._next_node+=1
+        self._N+=1
+        self._tree.add_edge(parent,new_node)
+        for child in moved_children:
+            self._tree.remove_edge(node,child)
+            self._tree.add_edge(new_node,child)
+        self._node_elements[new_node]=[e for e in self.node_elements(node) if e in moved]
+        self._node_elements[node]=kept
+        self._node_depth[new_node]=self._node_depth[node]
+        if self._deepest is not None:
+            for e in self._node_elements[new_node]:
+                if self._deepest.get(e)==node:
+                    self._deepest[e]=new_node
+        self._modified([node,new_node],changed=[node,new_node])
+        return new_node
+
+    def move_element(self,element,node):
+        """Moves an element to a node.
+
+        Comments:
+            The element leaves the deepest node containing it and its ancestors, and it joins **node** and its ancestors; the common ancestors are not touched. To keep the tree consistent, **node** should be a leaf. Nodes left empty are not removed.
+            It takes time proportional to the sizes of the nodes it leaves and joins.
+
+        Parameters
+        ----------
+        element : "element"
+            An element of the tree.
+        node : "node"
+            The node the element moves to.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> hp.move_element('c',n2)
+        >>> hp.show()
+        0 ['a', 'b', 'c', 'd', 'e', 'f']
+        1 ['a', 'b']
+        2 ['d', 'e', 'f', 'c']
+        3 ['a']
+        4 ['b']
+        """
+        assert not self._indices,'ERROR in move_element: the trees with elements_are_indices only support add_child().'
+        deepest=self._deepest_nodes()
+        assert element in deepest,'ERROR in move_element: "element" is not in the tree.'
+        old_path=[deepest[element]]+self._ancestors(deepest[element])
+        new_path=[node]+self._ancestors(node)
+        old_nodes=set(old_path)
+        new_nodes=set(new_path)
+        left=[v for v in old_path if v not in new_nodes]
+        joined=[v for v in new_path if v not in old_nodes]
+        self._remove_elements(left,set([element]))
+        self._add_elements(joined,[element])
+        deepest[element]=node
+        self._modified([old_path[0],node],changed=left+joined)
+
+    def move_subtree(self,node,new_parent):
+        """Moves a node, together with its sub-tree, under a new parent.
+
+        Comments:
+            The elements of the node leave its old ancestors and join the new ones; the common ancestors are not touched. The depths of the sub-tree are shifted accordingly.
+            It takes time proportional to the size of the sub-tree plus the sizes of the ancestors it leaves and joins.
+
+        Parameters
+        ----------
+        node : "node"
+            A node of the tree, other than the root.
+        new_parent : "node"
+            The new parent of **node**. It should not belong to the sub-tree of **node**.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> hp.move_subtree(n3,n2)
+        >>> hp.show()
+        0 ['a', 'b', 'c', 'd', 'e', 'f']
+        1 ['a']
+        2 ['d', 'e', 'f', 'b', 'c']
+        3 ['a']
+        4 ['b', 'c']
+        5 ['b']
+        6 ['c']
+        >>> print hp.node_depth(n3)
+        2
+        """
+        assert not self._indices,'ERROR in move_subtree: the trees with elements_are_indices only support add_child().'
+        parent=self.node_parent(node)
+        assert parent is not None,'ERROR in move_subtree: the root cannot be moved.'
+        new_path=[new_parent]+self._ancestors(new_parent)
+        assert node not in new_path,'ERROR in move_subtree: "new_parent" belongs to the sub-tree of "node".'
+        old_path=[parent]+self._ancestors(parent)
+        old_nodes=set(old_path)
+        new_nodes=set(new_path)
+        elements=self.node_elements(node)
+        left=[v for v in old_path if v not in new_nodes]
+        joined=[v for v in new_path if v not in old_nodes]
+        self._remove_elements(left,set(elements))
+        self._add_elements(joined,elements)
+        self._tree.remove_edge(parent,node)
+        self._tree.add_edge(new_parent,node)
+        shift=self._node_depth[new_parent]+1-self._node_depth[node]
+        if shift!=0:
+            for v in self._subtree_nodes(node):
+                self._node_depth[v]+=shift
+        self._modified([parent,new_parent],changed=left+joined)
+
+    def _path(self,node):
+        """Returns the list of nodes from the root down to a node. The node can also be given as such a list, which is then checked (if **checks** is True) and returned."""
+        if isinstance(node,(list,tuple)):
+            path=list(node)
+            if self.checks():
+                assert len(path)>0 and path[0]==self.root(),'ERROR: a path should start at the root.'
+                for parent,child in zip(path[:-1],path[1:]):
+                    assert self.node_parent(child)==parent,'ERROR: the path is not a chain of parent and child nodes.'
+            return path
+        path=[node]+self._ancestors(node)
+        path.reverse()
+        return path
+
+    def insert_element(self,element,node,weight=None):
+        """Inserts a new element in a node, and in all its ancestors.
+
+        Comments:
+            The element is appended to the elements of every node in the path from the root to **node**. To keep the tree consistent, **node** should be a leaf.
+            It takes amortized O(depth) time.
+
+        Parameters
+        ----------
+        element : "element"
+            The new element. It should not be in the tree yet.
+        node : "node" or <list>
+            The deepest node the element joins, or the path of nodes from the root down to it.
+        weight : <float=None>
+            The weight of the element, if the elements are weighted. By default, 1.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> hp.insert_element('g',n3)
+        >>> hp.insert_element('h',[root,n2])
+        >>> hp.show()
+        0 ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+        1 ['a', 'b', 'c', 'g']
+        2 ['d', 'e', 'f', 'h']
+        3 ['a']
+        4 ['b', 'c', 'g']
+        >>> hpc=hp.copy()
+        >>> hp.insert_element('i',n3)
+        >>> print hpc.node_elements(n3), hpc.consistency()
+        ['b', 'c', 'g'] True
+        """
+        self.insert_elements([element],[node],None if weight is None else [weight])
+
+    def insert_elements(self,elements,nodes,weights=None):
+        """Inserts a batch of new elements, each one in a node and in all its ancestors.
+
+        Comments:
+            The elements going to the same node are appended together, so that each distinct path is walked only once.
+            It takes amortized O(number of elements + number of distinct nodes * depth) time.
+
+        Parameters
+        ----------
+        elements : <list>
+            The new elements. They should not be in the tree yet.
+        nodes : <list>
+            For each element, the deepest node it joins, or the path of nodes from the root down to it (see **insert_element()**).
+        weights : <list=None>
+            The weights of the elements, if the elements are weighted. By default, 1.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d'],weights=[1,1,1,1])
+        >>> n1=hp.add_child(hp.root(),['a','b'])
+        >>> n2=hp.add_child(hp.root(),['c','d'])
+        >>> hp.insert_elements(['e','f','g'],[n1,n2,n1],weights=[2,1,1])
+        >>> hp.show()
+        0 ['a', 'b', 'c', 'd', 'e', 'g', 'f']
+        1 ['a', 'b', 'e', 'g']
+        2 ['c', 'd', 'f']
+        >>> print hp.element_weights().tolist()
+        [1.0, 1.0, 1.0, 1.0, 2.0, 1.0, 1.0]
+        """
+        assert not self._indices,'ERROR in insert_elements: the trees with elements_are_indices only support add_child().'
+        elements=list(elements)
+        nodes=list(nodes)
+        assert len(nodes)==len(elements),'ERROR in insert_elements: there should be one node per element.'
+        assert weights is None or len(weights)==len(elements),'ERROR in insert_elements: there should be one weight per element.'
+        assert weights is None or self._weights is not None,'ERROR in insert_elements: the elements of the tree are not weighted.'
+        assert len(set(elements))==len(elements),'ERROR in insert_elements: repeated elements.'
+        deepest=self._deepest_nodes()
+        groups=defaultdict(list)
+        keys=[]
+        targets={}
+        for i,(element,node) in enumerate(zip(elements,nodes)):
+            assert element not in deepest,'ERROR in insert_elements: an element is already in the tree.'
+            key=tuple(node) if isinstance(node,(list,tuple)) else node
+            if key not in targets:
+                keys.append(key)
+                targets[key]=node
+            groups[key].append(i)
+        root_order=[]
+        touched=[]
+        changed=set()
+        for key in keys:
+            positions=groups[key]
+            path=self._path(targets[key])
+            added=[elements[i] for i in positions]
+            for node in path:
+                self._node_elements[node].extend(added)
+            for element in added:
+                deepest[element]=path[-1]
+            root_order.extend(positions)
+            touched.append(path[-1])
+            changed.update(path)
+        if self._weights is not None:
+            _weights=numpy.ones(len(elements),dtype=numpy.double) if weights is None else numpy.array(weights,dtype=numpy.double)
+            assert (_weights>=0.0).all(),'ERROR: the weights should be non-negative.'
+            self._append_weights(_weights[root_order])
+        self._modified(touched,changed=changed)
+        # The new elements were appended to the root, so the positions of the others did not change.
+        _index=self._cache.get('element_index')
+        if _index is not None:
+            root_elements=self._node_elements[self.root()]
+            for i in xrange(len(root_elements)-len(elements),len(root_elements)):
+                _index[root_elements[i]]=i
+
     def consistency(self):
-        """Checks the consistency of the tree.
+        """Checks the consistency of the tree, ie., that the children of every node are disjoint subsets of it that cover it.
+
+        Comments:
+            See **consistency_report()** to find out which nodes are inconsistent.
 
         Returns
         -------
         : <bool>
             It returns True if the consistency is right. Otherwise, it returns False.
         """
-        for node in self._tree:
-            if self.node_leaf(node):
+        report=self.consistency_report()
+        return not ( report['overlapping'] or report['not_covered'] or report['not_subset'] )
+
+    def consistency_report(self):
+        """Checks the consistency of the tree, and reports the offending nodes.
+
+        Comments:
+            The check works level by level over the encoded elements (see **_element_ids()**), counting them with <numpy.bincount>, so it takes O(N*depth) time on consistent trees. Only the elements of a child outside its parent, and the levels where some element is in several nodes (both already inconsistent), are sorted as (parent,element) pairs.
+            Elements that are not in the root are not encoded; the nodes holding them are reported as 'not_subset'.
+
+        Returns
+        -------
+        : <dict>
+            A dict with the following keys, each one mapping to a sorted list of nodes:
+                'overlapping' : nodes with (at least) two children sharing elements.
+                'not_covered' : non-leaf nodes with elements not contained in any of their children.
+                'not_subset' : nodes with elements not contained in their parent.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'],checks=False)
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> print hp.consistency()
+        True
+        >>> n4=hp.add_child(n2,['d','e'])
+        >>> n5=hp.add_child(n2,['e','a'])
+        >>> print hp.consistency()
+        False
+        >>> report=hp.consistency_report()
+        >>> print report['overlapping'], report['not_covered'], report['not_subset']
+        [2] [2] [6]
+        >>> n6=hp.add_child(n3,['b','z'])
+        >>> print hp.consistency_report()['not_subset']
+        [6, 7]
+        """
+        table=self.node_table()
+        parent_row=self._parent_rows()
+        N=max(self.total_num_elements(),1)
+        report={'overlapping':set(),'not_covered':set(),'not_subset':set()}
+
+        def ids_of(i):
+            node=table['node'][i]
+            try:
+                ids=self._element_ids(node)
+            except KeyError:
+                _index=self._element_index()
+                report['not_subset'].add(i)
+                return numpy.array([_index[e] for e in self.node_elements(node) if e in _index],dtype=numpy.int64)
+            if self._indices and len(ids)>0 and ( ids.min()<0 or ids.max()>=self.total_num_elements() ):
+                report['not_subset'].add(i)
+                return ids[(ids>=0)&(ids<self.total_num_elements())]
+            return ids
+
+        for d in xrange(1,int(table['depth'].max())+1):
+            child_rows=numpy.flatnonzero(table['depth']==d)
+            parent_rows=numpy.flatnonzero((table['depth']==d-1)&(~table['leaf']))
+            child_ids=[ids_of(i) for i in child_rows]
+            parent_ids=[ids_of(i) for i in parent_rows]
+            child_sizes=numpy.array([len(a) for a in child_ids],dtype=numpy.int64)
+            parent_sizes=numpy.array([len(a) for a in parent_ids],dtype=numpy.int64)
+            if child_sizes.sum()==0:
                 continue
-            children_union=[]
-            for child in self._tree[node]:
-                children_union+=self.node_elements(child)
-            if not set(children_union)==set(self.node_elements(node)):
-                return False
-        return True
+            child_owner=numpy.repeat(child_rows,child_sizes)
+            child_elements=numpy.concatenate(child_ids)
+            parent_owner=numpy.repeat(parent_rows,parent_sizes)
+            parent_elements=numpy.concatenate(parent_ids) if len(parent_ids)>0 else numpy.zeros(0,dtype=numpy.int64)
+            if numpy.bincount(parent_elements,minlength=N).max()<=1:
+                # Each element has at most one owner at depth d-1.
+                owner=numpy.empty(N,dtype=numpy.int64)
+                owner.fill(-1)
+                owner[parent_elements]=parent_owner
+                inside=owner[child_elements]==parent_row[child_owner]
+                # Elements of a child that are not in its parent
+                report['not_subset'].update(child_owner[~inside].tolist())
+                # Children sharing elements (the few outside their parent are sorted)
+                count=numpy.bincount(child_elements[inside],minlength=N)
+                report['overlapping'].update(owner[count>1].tolist())
+                outside_keys=numpy.sort(parent_row[child_owner[~inside]]*N+child_elements[~inside])
+                report['overlapping'].update((outside_keys[1:][outside_keys[1:]==outside_keys[:-1]]//N).tolist())
+                # Elements of a parent that are not in any of its children
+                report['not_covered'].update(parent_owner[count[parent_elements]==0].tolist())
+                continue
+            child_keys=parent_row[child_owner]*N+child_elements
+            parent_keys=numpy.unique(parent_owner*N+parent_elements)
+            # Children sharing elements
+            order=numpy.argsort(child_keys,kind='mergesort')
+            sorted_keys=child_keys[order]
+            repeated=sorted_keys[1:]==sorted_keys[:-1]
+            report['overlapping'].update(parent_row[child_owner[order][1:][repeated]].tolist())
+            # Elements of a child that are not in its parent
+            outside=~numpy.in1d(child_keys,parent_keys)
+            report['not_subset'].update(child_owner[outside].tolist())
+            # Elements of a parent that are not in any of its children
+            covered=numpy.unique(child_keys[~outside])
+            covered_count=numpy.bincount(covered//N,minlength=len(table['node']))
+            parent_count=numpy.bincount(parent_keys//N,minlength=len(table['node']))
+            report['not_covered'].update(numpy.flatnonzero(covered_count<parent_count).tolist())
+        for key in report:
+            report[key]=sorted(table['node'][list(report[key])].tolist())
+        return report
 
     def nodes(self):
         """Returns a list of the node, ie., sub-communities, in the tree.
@@ -664,7 +1429,8 @@ class HierarchicalPartition:
         : <list>
             A list of the nodes in the tree that are a leaf.
         """
-        return [node for node in self.nodes() if self.node_leaf(node)]
+        table=self.node_table()
+        return table['node'][table['leaf']].tolist()
 
     def __iter__(self):
         """Iterates over the nodes of the tree. The iterator goes from the largest node to the smallest node, where the size of the nodes is measured using the method **node_size()**.
@@ -684,7 +1450,7 @@ class HierarchicalPartition:
         >>> print [node for node in hp]
         [0, 1, 2, 4, 3, 5, 6]
         """
-        for dummy,node in sorted([ (self.node_size(node),node) for node in self._tree ],key=itemgetter(0),reverse=True):
+        for node in self.size_order().tolist():
             yield node
 
     def bfs_traversal(self):
@@ -705,15 +1471,8 @@ class HierarchicalPartition:
         >>> print [node for node in hp.bfs_traversal()]
         [0, 1, 2, 3, 4, 5, 6]
         """
-        yield self.root()
-        wave=[self.root()]
-        while len(wave)>0:
-            new_wave=[]
-            for node in wave:
-                for child in self.node_children(node):
-                    new_wave.append(child)
-                    yield child
-            wave=new_wave
+        for node in self.bfs_order().tolist():
+            yield node
 
     def dfs_traversal(self):
         """It yields over the nodes of the tree, performing a DFS algorithm that starts from the root.
@@ -732,12 +1491,99 @@ class HierarchicalPartition:
         >>> print [node for node in hp.dfs_traversal()]
         [0, 2, 1, 4, 6, 5, 3]
         """
+        for node in self.dfs_order().tolist():
+            yield node
+
+    def postorder_traversal(self):
+        """It yields over the nodes of the tree, such that every node comes after all its descendants. It is the reverse of **dfs_traversal()**.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> print [node for node in hp.postorder_traversal()]
+        [3, 5, 6, 4, 1, 2, 0]
+        """
+        for node in self.postorder().tolist():
+            yield node
+
+    def _children(self):
+        """Returns a dict mapping each node to the list of its children. It is cached until the next modification of the tree."""
+        try:
+            return self._cache['children']
+        except KeyError:
+            pass
+        children={}
+        for node in self._tree:
+            children[node]=list(self._tree[node])
+        self._cache['children']=children
+        return children
+
+    def _traversal_orders(self):
+        """Computes, in a single pass over the adjacency of the tree, the node orders used by the traversals."""
+        try:
+            return self._cache['traversal_orders']
+        except KeyError:
+            pass
+        children=self._children()
+        bfs=[self.root()]
+        for node in bfs:
+            bfs.extend(children[node])
+        dfs=[]
         stack=[self.root()]
         while len(stack)>0:
             node=stack.pop()
-            yield node
-            for child in self.node_children(node):
-                stack.append(child)
+            dfs.append(node)
+            stack.extend(children[node])
+        table=self.node_table()
+        orders={'bfs':numpy.array(bfs,dtype=numpy.int64),
+                'dfs':numpy.array(dfs,dtype=numpy.int64),
+                'size':table['node'][numpy.argsort(-table['size'],kind='mergesort')]}
+        for a in orders.values():
+            a.flags.writeable=False
+        orders['postorder']=orders['dfs'][::-1]
+        self._cache['traversal_orders']=orders
+        return orders
+
+    def bfs_order(self):
+        """Returns the nodes in the order of **bfs_traversal()**, as an int64 <numpy.ndarray>."""
+        return self._traversal_orders()['bfs'].view()
+
+    def dfs_order(self):
+        """Returns the nodes in the (pre)order of **dfs_traversal()**, as an int64 <numpy.ndarray>."""
+        return self._traversal_orders()['dfs'].view()
+
+    def postorder(self):
+        """Returns the nodes in the order of **postorder_traversal()**, as an int64 <numpy.ndarray>."""
+        return self._traversal_orders()['postorder'].view()
+
+    def size_order(self):
+        """Returns the nodes in the order of **__iter__()**, ie., from the largest to the smallest node, as an int64 <numpy.ndarray>.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> print hp.size_order()
+        [0 1 2 4 3 5 6]
+        >>> print hp.size_order().flags.writeable
+        False
+        """
+        return self._traversal_orders()['size'].view()
 
     def edges(self):
         #"""It yields over the edges of the tree."""
@@ -798,7 +1644,7 @@ class HierarchicalPartition:
         [(0, 1), (0, 2), (1, 3), (1, 4), (4, 5), (4, 6)]
         >>> for node in hpc.nodes(): assert hpc.node_elements(node)==hp.node_elements(node)
         """
-        _hp=HierarchicalPartition(self.all_elements())
+        _hp=HierarchicalPartition(self.all_elements(),weights=self._weights,elements_are_indices=self._indices)
         wave=[self.root()]
         _wave=[_hp.root()]
         while len(wave)>0:
@@ -858,7 +1704,7 @@ class HierarchicalPartition:
         assert set(old_elements_2_new_elements.keys())==set(self.all_elements()),'ERROR: not set(old_elements_2_new_elements.keys())==set(self.all_elements())'
         assert len(set(old_elements_2_new_elements.values()))==self.total_num_elements(),"ERROR: not len(set(old_elements_2_new_elements.values()))==self.total_num_elements()"
 
-        _hp=HierarchicalPartition([old_elements_2_new_elements[e] for e in self.all_elements()])
+        _hp=HierarchicalPartition([old_elements_2_new_elements[e] for e in self.all_elements()],weights=self._weights)
         wave=[self.root()]
         _wave=[_hp.root()]
         while len(wave)>0:
@@ -873,26 +1719,356 @@ class HierarchicalPartition:
             _wave=_new_wave
         return _hp
 
-    def nodes_at_depth(self,depth):
-        """Returns a list of all the nodes in the tree that have a specified depth.
+    def restrict(self,elements,collapse=False):
+        """Returns the sub-hierarchy induced by a subset of the elements.
 
         Comments:
-            The list might be empty.
-            The list not necessarily conform a partition of the full set of elements.
+            Every node is intersected with **elements**, and the nodes that become empty are dropped together with their sub-trees.
+            The order of the elements inside the nodes is preserved. Elements not in the tree are ignored.
+            It takes O(N*depth) time, using vectorized masks over the encoded elements.
 
         Parameters
         ----------
-        depth : <int>
-            The depth at which the nodes to be returned should be.
+        elements : <list>
+            The elements to keep.
+        collapse : <bool=False>
+            If True, a node left with a single child is merged with that child, ie., the resulting unary chains are collapsed.
 
         Returns
         -------
-        : <list> 
-            A list of the nodes at depth "depth". 
+        : HierarchicalPartition
+            The restricted tree. Its nodes are renamed.
 
-        Examples
-        --------
-        >>> from hierpart import HierarchicalPartition
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> hp.restrict(['a','b','d']).show()
+        0 ['a', 'b', 'd']
+        1 ['a', 'b']
+        2 ['d']
+        3 ['a']
+        4 ['b']
+        5 ['b']
+        >>> hp.restrict(['a','b','d'],collapse=True).show()
+        0 ['a', 'b', 'd']
+        1 ['a', 'b']
+        2 ['d']
+        3 ['a']
+        4 ['b']
+        """
+        mask=numpy.zeros(self.total_num_elements(),dtype=bool)
+        if self._indices:
+            ids=numpy.array(elements,dtype=numpy.int64)
+            mask[ids[(ids>=0)&(ids<len(mask))]]=True
+        else:
+            _index=self._element_index()
+            mask[[_index[e] for e in elements if e in _index]]=True
+        table=self.node_table()
+        parent_row=self._parent_rows()
+        _position=self._node_position()
+        kept_ids=[]
+        for node in table['node'].tolist():
+            ids=self._element_ids(node)
+            kept_ids.append(ids[mask[ids]])
+        kept=numpy.array([len(ids)>0 for ids in kept_ids],dtype=bool)
+        kept_children=numpy.bincount(parent_row[kept&(parent_row>=0)],minlength=len(kept))
+        all_elements=self.all_elements()
+        # The restriction of a tree with elements_are_indices keeps the mode if the kept elements are 0,1,...,n-1.
+        indices=self._indices and mask[:mask.sum()].all()
+        if self._indices and not indices:
+            all_elements=all_elements.tolist()
+
+        root=self.root()
+        root_ids=kept_ids[_position[root]]
+        _hp=HierarchicalPartition([all_elements[i] for i in root_ids],checks=False,weights=None if self._weights is None else self._weights[root_ids],elements_are_indices=indices)
+        node_2_new_node={root:_hp.root()}
+        for node in self.bfs_traversal():
+            if node==root:
+                continue
+            i=_position[node]
+            parent=table['parent'][i]
+            if not kept[i] or parent not in node_2_new_node:
+                continue
+            if collapse and kept_children[parent_row[i]]==1:
+                node_2_new_node[node]=node_2_new_node[parent]
+                continue
+            node_2_new_node[node]=_hp.add_child(node_2_new_node[parent],kept_ids[i] if indices else [all_elements[j] for j in kept_ids[i]])
+        _hp._checks=self._checks
+        return _hp
+
+    def compress(self,mode='safe'):
+        """Returns a compressed copy of the tree, where zero-size nodes and chains of single-child nodes are contracted.
+
+        Comments:
+            With mode 'safe', the zero-size nodes are dropped, and the unary tails (ie., chains of single-child nodes ending in a leaf) are contracted into their top node, which becomes a leaf.
+            This does not change the hierarchical mutual information against any other tree. A zero-size node has no common elements with anything, so it contributes 0. A node v with a single child c has Sx=0 and Sxy=Sy, then I(T_v;T'_w) = sum_w' p(w') I(T_c;T'_w'), which vanishes if c is a leaf; by induction, it vanishes along the whole tail, just as for the leaf v.
+            With mode 'full', every node with a single child is, in addition, merged with its child. This preserves I(T;T), but it changes I(T;T') in general, because the hierarchical mutual information compares the levels of both trees depth by depth.
+
+        Parameters
+        ----------
+        mode : <str='safe'>
+            One of 'safe' or 'full'.
+
+        Returns
+        -------
+        : (HierarchicalPartition,<dict>)
+            The compressed tree, and a dict mapping every node of the current tree to the node of the compressed tree that contains it (dropped zero-size nodes map to None).
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> from hierpart import hierarchical_mutual_information
+        >>> hp=HierarchicalPartition(['a','b','c','d'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b'])
+        >>> n2=hp.add_child(root,['c','d'])
+        >>> n3=hp.add_child(n1,['a'])
+        >>> n4=hp.add_child(n1,['b'])
+        >>> n5=hp.add_child(n2,['c','d'])
+        >>> n6=hp.add_child(n5,['c'])
+        >>> n7=hp.add_child(n5,['d'])
+        >>> n8=hp.add_child(n3,['a'])
+        >>> n9=hp.add_child(n8,['a'])
+        >>> hpc,node_2_new_node=hp.compress()
+        >>> print hpc.num_nodes(), node_2_new_node[n9]==node_2_new_node[n3]
+        8 True
+        >>> hpf,node_2_new_node=hp.compress(mode='full')
+        >>> print hpf.num_nodes(), node_2_new_node[n5]==node_2_new_node[n2]
+        7 True
+        >>> hpy=HierarchicalPartition(['a','b','c','d'])
+        >>> rooty=hpy.root()
+        >>> n1y=hpy.add_child(rooty,['a','b','c'])
+        >>> n2y=hpy.add_child(rooty,['d'])
+        >>> n3y=hpy.add_child(n1y,['a'])
+        >>> n4y=hpy.add_child(n1y,['b','c'])
+        >>> n5y=hpy.add_child(n3y,['a'])
+        >>> print '%.6f %.6f' % (hierarchical_mutual_information(hp,hpy),hierarchical_mutual_information(hpc,hpy))
+        0.562335 0.562335
+        """
+        assert mode in ('safe','full'), "ERROR: mode should be one of 'safe','full'"
+        table=self.node_table()
+        parent_row=self._parent_rows()
+        _position=self._node_position()
+        nonempty=table['size']>0
+        nonempty_children=numpy.bincount(parent_row[nonempty&(parent_row>=0)],minlength=len(nonempty))
+        # A node is on a unary tail if it has at most one non-empty child, and that child is on a unary tail.
+        tail=nonempty&(nonempty_children==0)
+        for node in self.postorder().tolist():
+            i=_position[node]
+            j=parent_row[i]
+            if tail[i] and j>=0 and nonempty_children[j]==1:
+                tail[j]=True
+
+        root=self.root()
+        _hp=HierarchicalPartition(self.all_elements(),checks=False,weights=self._weights,elements_are_indices=self._indices)
+        node_2_new_node={root:_hp.root()}
+        for node in self.bfs_traversal():
+            if node==root:
+                continue
+            i=_position[node]
+            j=parent_row[i]
+            parent=table['parent'][i]
+            if not nonempty[i] or node_2_new_node[parent] is None:
+                node_2_new_node[node]=None
+            elif tail[j] or ( mode=='full' and nonempty_children[j]==1 ):
+                node_2_new_node[node]=node_2_new_node[parent]
+            else:
+                node_2_new_node[node]=_hp.add_child(node_2_new_node[parent],self.node_elements(node))
+        _hp._checks=self._checks
+        return _hp,node_2_new_node
+
+    def _element_digests(self):
+        """Returns a uint64 <numpy.ndarray> with a digest of each element in **all_elements()**, taken from the md5 of its repr (or of the repr of the pair (element,weight), if the elements are weighted). It is cached until the next modification of the tree."""
+        try:
+            return self._cache['element_digests']
+        except KeyError:
+            pass
+        if self._weights is None:
+            reprs=(repr(e) for e in self.all_elements())
+        else:
+            reprs=(repr((e,w)) for e,w in zip(self.all_elements(),self._weights.tolist()))
+        digests=numpy.fromiter((int(hashlib.md5(r).hexdigest()[:16],16) for r in reprs),dtype=numpy.uint64,count=self.total_num_elements())
+        self._cache['element_digests']=digests
+        return digests
+
+    def _subtree_hashes(self):
+        """Computes, bottom-up, the Merkle hash of every sub-tree. It is cached until the next modification of the tree."""
+        try:
+            return self._cache['subtree_hashes']
+        except KeyError:
+            pass
+        digests=self._element_digests()
+        children=self._children()
+        hashes={}
+        for node in self.postorder().tolist():
+            elements_digest=digests[self._element_ids(node)].sum(dtype=numpy.uint64)
+            h=hashlib.sha1('%d:%d;' % (elements_digest,self.node_size(node)))
+            for child_hash in sorted(hashes[child] for child in children[node]):
+                h.update(child_hash)
+            hashes[node]=h.digest()
+        self._cache['subtree_hashes']=hashes
+        return hashes
+
+    def subtree_hash(self,node):
+        """Returns a canonical hash of the sub-tree rooted at node **node**.
+
+        Comments:
+            The hash is computed bottom-up (Merkle-like) out of the elements of each node and the hashes of its children. It does not depend on the order of the children or of the elements inside the nodes, nor on the names of the nodes. Then, two sub-trees with the same hash are, up to hash collisions, identical.
+
+        Parameters
+        ----------
+        node : "node"
+            A node of the tree.
+
+        Returns
+        -------
+        : <str>
+            The hexadecimal hash of the sub-tree.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hpx=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> n1x=hpx.add_child(hpx.root(),['a','b','c'])
+        >>> n2x=hpx.add_child(hpx.root(),['d','e','f'])
+        >>> dummy=hpx.add_child(n1x,['a'])
+        >>> dummy=hpx.add_child(n1x,['b','c'])
+        >>> hpy=HierarchicalPartition(['f','e','d','c','b','a'])
+        >>> n1y=hpy.add_child(hpy.root(),['f','e','d'])
+        >>> n2y=hpy.add_child(hpy.root(),['c','b','a'])
+        >>> dummy=hpy.add_child(n2y,['c','b'])
+        >>> dummy=hpy.add_child(n2y,['a'])
+        >>> print hpx.subtree_hash(n1x)==hpy.subtree_hash(n2y)
+        True
+        >>> print hpx.subtree_hash(hpx.root())==hpy.subtree_hash(hpy.root())
+        True
+        >>> print hpx.subtree_hash(n1x)==hpy.subtree_hash(n1y)
+        False
+        """
+        return self._subtree_hashes()[node].encode('hex')
+
+    def content_hash(self):
+        """Returns a canonical hash of the content of the tree.
+
+        Comments:
+            It is the **subtree_hash()** of the root. So, it does not depend on the names of the nodes, nor on the order of the children or the elements. It is meant to identify trees across runs; eg., as the key of an **HMICache**.
+
+        Returns
+        -------
+        : <str>
+            The hexadecimal hash of the tree.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d'])
+        >>> n1=hp.add_child(hp.root(),['a','b'])
+        >>> n2=hp.add_child(hp.root(),['c','d'])
+        >>> hpc=HierarchicalPartition(['a','b','c','d'])
+        >>> n2c=hpc.add_child(hpc.root(),['d','c'])
+        >>> n1c=hpc.add_child(hpc.root(),['b','a'])
+        >>> print hp.content_hash()==hpc.content_hash()
+        True
+        >>> dummy=hpc.add_child(n1c,['a'])
+        >>> print hp.content_hash()==hpc.content_hash()
+        False
+        """
+        return self.subtree_hash(self.root())
+
+    def hierarchical_entropy(self,node=None,max_depth=None):
+        """Returns the hierarchical entropy of the sub-tree rooted at a node, ie., I(T_v;T_v).
+
+        Comments:
+            The entropies of all the sub-trees are computed together, bottom-up, and cached until the next modification of the tree. They assume the children of every node are disjoint, as in a consistent tree.
+            If the elements are weighted, the sizes of the nodes are replaced by their weights (see **node_weight()**).
+
+        Parameters
+        ----------
+        node : "node"
+            A node of the tree. By default, the root.
+        max_depth : <int=None>
+            If given, the sub-tree is truncated this many levels below **node**, ie., the nodes there are taken as leaves (see **hierarchical_mutual_information()**). The truncated value is not cached.
+
+        Returns
+        -------
+        : <float>
+            The value I(T_v;T_v).
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> print '%.6f %.6f' % (hp.hierarchical_entropy(),hp.hierarchical_entropy(n3))
+        1.242453 0.693147
+        >>> print '%.6f %.6f' % (hp.hierarchical_entropy(max_depth=1),hp.hierarchical_entropy(n1,max_depth=1))
+        0.693147 0.636514
+        """
+        if node is None:
+            node=self.root()
+        if max_depth is not None:
+            ids=self._element_ids(node)
+            depth=self.node_depth(node)
+            L=self._label_matrix(depth+max_depth)[ids,depth:]
+            nonleaf=self._nonleaf_mask()
+            weights=None if self._weights is None else self._weights[ids]
+            return _label_hmi(L,L,nonleaf,nonleaf,weights=weights,max_depth=max_depth)
+        try:
+            return self._cache['hierarchical_entropy'][node]
+        except KeyError:
+            pass
+        children=self._children()
+        entropy={}
+        # Same arithmetic as sub_hierarchical_mutual_information(self,self,node,node,depth).
+        for v in self.postorder().tolist():
+            denxy=self.node_weight(v)
+            if denxy==0.0 or len(children[v])==0:
+                entropy[v]=0.0
+                continue
+            Sx=0.0
+            second_term_xy=0.0
+            for child in children[v]:
+                frac=self.node_weight(child)/denxy
+                Sx-=_plogp(frac)
+                second_term_xy+=frac*entropy[child]
+            entropy[v]=Sx+second_term_xy
+        self._cache['hierarchical_entropy']=entropy
+        return entropy[node]
+
+    def nodes_at_depth(self,depth):
+        """Returns a list of all the nodes in the tree that have a specified depth.
+
+        Comments:
+            The list might be empty.
+            The list not necessarily conform a partition of the full set of elements.
+
+        Parameters
+        ----------
+        depth : <int>
+            The depth at which the nodes to be returned should be.
+
+        Returns
+        -------
+        : <list> 
+            A list of the nodes at depth "depth". 
+
+        Examples
+        --------
+        >>> from hierpart import HierarchicalPartition
         >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
         >>> root=hp.root()
         >>> n1=hp.add_child(root,['a','b','c'])
@@ -926,6 +2102,339 @@ class HierarchicalPartition:
         """
         return [ node for node in self._tree if self.node_depth(node)==depth ]
 
+    def _label_matrix(self,max_depth=None):
+        """Returns the (N x (max_depth()+1)) <numpy.ndarray> of int32 labels whose column d holds, for each element in **all_elements()**, the node at depth d containing it.
+
+        Elements belonging to a leaf shallower than d keep the label of that leaf (ie., leaves are padded down to the deeper levels).
+        The matrix is built in a single pass over the nodes, and it is cached (read-only) until the next modification of the tree.
+        If **max_depth** is given, only the columns 0..max_depth are built, out of the nodes down to that depth; the deeper nodes are not visited.
+        """
+        if max_depth is not None:
+            return self._truncated_label_matrix(max_depth)
+        try:
+            return self._cache['label_matrix']
+        except KeyError:
+            pass
+        _max_depth=max(self._node_depth.values())
+        L=numpy.empty((self.total_num_elements(),_max_depth+1),dtype=numpy.int32)
+        L.fill(-1)
+        for node in self._tree:
+            L[self._element_ids(node),self._node_depth[node]]=node
+        for d in xrange(1,_max_depth+1):
+            padded=L[:,d]==-1
+            L[padded,d]=L[padded,d-1]
+        L.flags.writeable=False
+        self._cache['label_matrix']=L
+        return L
+
+    def _truncated_label_matrix(self,max_depth):
+        """Returns the columns 0..max_depth of **_label_matrix()**, visiting only the nodes down to depth **max_depth**. It is cached until the next modification of the tree."""
+        key=('label_matrix',max_depth)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        if 'label_matrix' in self._cache:
+            return self._cache['label_matrix'][:,:max_depth+1]
+        levels=[[self.root()]]
+        while len(levels)<=max_depth:
+            level=[ child for node in levels[-1] for child in self._tree[node] ]
+            if not level:
+                # The tree is not deeper than max_depth.
+                return self._label_matrix()
+            levels.append(level)
+        L=numpy.empty((self.total_num_elements(),max_depth+1),dtype=numpy.int32)
+        L.fill(-1)
+        for d,level in enumerate(levels):
+            for node in level:
+                L[self._element_ids(node),d]=node
+            if d>0:
+                padded=L[:,d]==-1
+                L[padded,d]=L[padded,d-1]
+        L.flags.writeable=False
+        self._cache[key]=L
+        return L
+
+    def _csr_arrays(self):
+        """Returns the tree as flat arrays, with the nodes in BFS order: the nodes, the position of the parent of each node (-1 for the root), and the offsets and encoded elements (see **_element_ids()**) of the nodes, such that element_ids[offsets[i]:offsets[i+1]] are the elements of the i-th node."""
+        nodes=self.bfs_order()
+        _position={}
+        for i,node in enumerate(nodes.tolist()):
+            _position[node]=i
+        parent=numpy.array([_position.get(self.node_parent(node),-1) for node in nodes.tolist()],dtype=numpy.int64)
+        sizes=numpy.array([self.node_size(node) for node in nodes.tolist()],dtype=numpy.int64)
+        offsets=numpy.zeros(len(nodes)+1,dtype=numpy.int64)
+        numpy.cumsum(sizes,out=offsets[1:])
+        element_ids=numpy.empty(offsets[-1],dtype=numpy.int64)
+        for i,node in enumerate(nodes.tolist()):
+            element_ids[offsets[i]:offsets[i+1]]=self._element_ids(node)
+        return nodes,parent,offsets,element_ids
+
+    def to_shared_memory(self):
+        """Exports the tree as flat arrays into a new shared memory segment, that other processes can map with **HierarchicalPartition.attach()** without copying it.
+
+        Comments:
+            The segment holds the arrays 'nodes', 'parent', 'offsets' and 'element_ids' (see **_csr_arrays()**), the table of 'elements' (as in **save_hierarchical_partition_binary()**), and the 'weights' of the elements, if any. It also holds what a **PreparedHierarchy** needs to compare against the tree: the 'labels' of **_label_matrix()**, the 'nonleaf' mask of the nodes, the 'order' that sorts the elements, and the hierarchical 'entropy'.
+            The segment is a directory of .npy files in /dev/shm (or in the temporary directory, if /dev/shm is missing), and it persists until it is released with **release_shared_memory()**.
+            Later modifications of the tree do not affect the segment.
+            Forked processes share the memory of their parent only until they write to it, and merely reading Python objects writes their reference counts; so, workers that look elements up in the dicts of a tree end up with their own copy of it. The process pools of **PreparedHierarchy.compare_many()** and of the **hierpart compare** command give their workers a segment instead.
+
+        Returns
+        -------
+        : <str>
+            The name of the segment.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition, release_shared_memory
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> name=hp.to_shared_memory()
+        >>> arrays=HierarchicalPartition.attach(name).arrays()
+        >>> sorted(arrays)
+        ['element_ids', 'elements', 'entropy', 'labels', 'nodes', 'nonleaf', 'offsets', 'order', 'parent']
+        >>> arrays['parent'].tolist()
+        [-1, 0, 0, 1, 1]
+        >>> arrays['elements'][arrays['element_ids'][arrays['offsets'][4]:arrays['offsets'][5]]].tolist()
+        ['b', 'c']
+        >>> arrays['parent'].flags.writeable
+        False
+        >>> release_shared_memory(name)
+        """
+        nodes,parent,offsets,element_ids=self._csr_arrays()
+        elements=_elements_array(self.all_elements())
+        return _share_arrays(dict(nodes=nodes,parent=parent,offsets=offsets,element_ids=element_ids,elements=elements,weights=self.element_weights(),
+                                  labels=self._label_matrix(),nonleaf=self._nonleaf_mask(),order=numpy.argsort(elements,kind='mergesort'),
+                                  entropy=numpy.array([self.hierarchical_entropy()],dtype=numpy.double)))
+
+    @staticmethod
+    def attach(name):
+        """Maps the arrays of a shared memory segment written by **to_shared_memory()**.
+
+        Parameters
+        ----------
+        name : <str>
+            The name of the segment.
+
+        Returns
+        -------
+        : SharedHierarchy
+            The read-only arrays of the segment. They are memory maps of the segment, not copies. It can be the reference of a **PreparedHierarchy**.
+        """
+        return SharedHierarchy(name)
+
+    def _nonleaf_mask(self):
+        """Returns a boolean <numpy.ndarray>, indexed by node, that is True for the nodes that are not leaves. It is cached until the next modification of the tree."""
+        try:
+            return self._cache['nonleaf_mask']
+        except KeyError:
+            pass
+        table=self.node_table()
+        mask=numpy.zeros(int(table['node'].max())+1,dtype=bool)
+        mask[table['node'][~table['leaf']]]=True
+        mask.flags.writeable=False
+        self._cache['nonleaf_mask']=mask
+        return mask
+
+    def _disjoint_children(self):
+        """Returns True if the children of every node are disjoint subsets of it (see **consistency_report()**), ie., if the vectorized computations over encoded labels give the value of the recursion. The children need not cover their parent. It is cached until the next modification of the tree."""
+        try:
+            return self._cache['disjoint_children']
+        except KeyError:
+            pass
+        report=self.consistency_report()
+        disjoint=not report['overlapping'] and not report['not_subset']
+        self._cache['disjoint_children']=disjoint
+        return disjoint
+
+    def level_labels(self,depth):
+        """Returns the flat partition of the elements at a given depth, as a vector of labels.
+
+        Comments:
+            The labels are node names. They are given in the order of the elements in **all_elements()**.
+            Elements contained in a leaf shallower than **depth** are labeled with that leaf; so, the labels always conform a partition of the full set of elements.
+
+        Parameters
+        ----------
+        depth : <int>
+            The depth of the level.
+
+        Returns
+        -------
+        : <numpy.ndarray>
+            An int32 array with the label of each element at depth **depth**.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> print hp.level_labels(0)
+        [0 0 0 0 0 0]
+        >>> print hp.level_labels(2)
+        [3 4 4 2 2 2]
+        >>> print hp.level_labels(5)
+        [3 5 6 2 2 2]
+        """
+        assert depth>=0,'ERROR in level_labels(): depth should be non-negative.'
+        L=self._label_matrix()
+        return L[:,min(depth,L.shape[1]-1)].copy()
+
+    def label_matrix(self):
+        """Returns the flat partitions of all the levels of the tree as a matrix of labels.
+
+        Comments:
+            Column i corresponds to depth i+1, ie., the trivial partition at the root is not included.
+            The matrix is computed in a single pass over the nodes and cached until the next modification of the tree. The returned array is read-only.
+
+        Returns
+        -------
+        : <numpy.ndarray>
+            An int32 array of shape (N,max_depth()), where N is **total_num_elements()**. Row j corresponds to the j-th element in **all_elements()**.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> print hp.label_matrix()
+        [[1 3 3]
+         [1 4 5]
+         [1 4 6]
+         [2 2 2]
+         [2 2 2]
+         [2 2 2]]
+        """
+        return self._label_matrix()[:,1:]
+
+    def _node_position(self):
+        """Returns a dict mapping each node to its row in the arrays of **node_table()**."""
+        try:
+            return self._cache['node_position']
+        except KeyError:
+            pass
+        _position={}
+        for i,node in enumerate(self.nodes()):
+            _position[node]=i
+        self._cache['node_position']=_position
+        return _position
+
+    def _parent_rows(self):
+        """Returns an array with the row, in **node_table()**, of the parent of each node (-1 for the root)."""
+        try:
+            return self._cache['parent_rows']
+        except KeyError:
+            pass
+        _position=self._node_position()
+        parent_row=numpy.array([_position.get(p,-1) for p in self.node_table()['parent'].tolist()],dtype=numpy.int64)
+        self._cache['parent_rows']=parent_row
+        return parent_row
+
+    def node_table(self):
+        """Returns a table with the basic statistics of all the nodes of the tree, computed in a single traversal.
+
+        Comments:
+            The rows of the table follow the order of **nodes()**.
+            The table is cached until the next modification of the tree, and it is used by the statistics methods, like **max_depth()**, **leaves()** or **branching_factors()**. Its arrays are read-only.
+
+        Returns
+        -------
+        : <dict>
+            A dict of <numpy.ndarray> with keys:
+                'node' : the node names.
+                'parent' : the parent of each node (-1 for the root).
+                'size' : the number of elements of each node.
+                'depth' : the depth of each node.
+                'branching_factor' : the number of children of each node.
+                'leaf' : True if the node is a leaf.
+                'children_avrg_size' : as in **node_children_avrg_size(node,weighted=True)**.
+                'children_avrg_size_unweighted' : as in **node_children_avrg_size(node,weighted=False)**.
+
+        Example
+        -------
+        >>> from hierpart import HierarchicalPartition
+        >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+        >>> root=hp.root()
+        >>> n1=hp.add_child(root,['a','b','c'])
+        >>> n2=hp.add_child(root,['d','e','f'])
+        >>> dummy=hp.add_child(n1,['a'])
+        >>> n3=hp.add_child(n1,['b','c'])
+        >>> dummy=hp.add_child(n3,['b'])
+        >>> dummy=hp.add_child(n3,['c'])
+        >>> table=hp.node_table()
+        >>> print table['node']
+        [0 1 2 3 4 5 6]
+        >>> print table['parent']
+        [-1  0  0  1  1  4  4]
+        >>> print table['size']
+        [6 3 3 1 2 1 1]
+        >>> print table['depth']
+        [0 1 1 2 2 3 3]
+        >>> print table['branching_factor']
+        [2 2 0 0 2 0 0]
+        """
+        try:
+            return self._cache['node_table']
+        except KeyError:
+            pass
+        nodes=self.nodes()
+        n=len(nodes)
+        _position=self._node_position()
+        node=numpy.array(nodes,dtype=numpy.int64)
+        size=numpy.fromiter((len(self._node_elements[v]) for v in nodes),dtype=numpy.int64,count=n)
+        depth=numpy.fromiter((self._node_depth[v] for v in nodes),dtype=numpy.int64,count=n)
+        parent=numpy.empty(n,dtype=numpy.int64)
+        parent.fill(-1)
+        parent_row=numpy.empty(n,dtype=numpy.int64)
+        parent_row.fill(-1)
+        for u,v in self._tree.edges_iter():
+            parent[_position[v]]=u
+            parent_row[_position[v]]=_position[u]
+        has_parent=parent_row>=0
+        rows=parent_row[has_parent]
+        child_size=size[has_parent].astype(numpy.double)
+        branching_factor=numpy.bincount(rows,minlength=n)
+        leaf=branching_factor==0
+        parent_size=size[rows].astype(numpy.double)
+        weight=numpy.zeros(len(rows),dtype=numpy.double)
+        numpy.divide(child_size,parent_size,out=weight,where=parent_size>0.0) # Empty nodes, eg., left by move_element(), have weight 0.
+        sum_weighted=numpy.bincount(rows,weights=weight*child_size,minlength=n)
+        num_weighted=numpy.bincount(rows,weights=weight,minlength=n)
+        sum_unweighted=numpy.bincount(rows,weights=child_size,minlength=n)
+        children_avrg_size=numpy.zeros(n,dtype=numpy.double)
+        children_avrg_size_unweighted=numpy.zeros(n,dtype=numpy.double)
+        positive=num_weighted>0.0
+        children_avrg_size[positive]=sum_weighted[positive]/num_weighted[positive]
+        children_avrg_size_unweighted[~leaf]=sum_unweighted[~leaf]/branching_factor[~leaf]
+        table={'node':node,
+               'parent':parent,
+               'size':size,
+               'depth':depth,
+               'branching_factor':branching_factor,
+               'leaf':leaf,
+               'children_avrg_size':children_avrg_size,
+               'children_avrg_size_unweighted':children_avrg_size_unweighted}
+        for a in table.values():
+            a.flags.writeable=False
+        self._cache['node_table']=table
+        return table
+
     def node_children_avrg_size(self,node,weighted=True):
         """Returns the average size of the children nodes of a given node **node**.
 
@@ -957,19 +2466,507 @@ class HierarchicalPartition:
         >>> print [hp.node_children_avrg_size(node,weighted=False) for node in hp.nodes()]
         [3.0, 1.5, 0.0, 0.0, 1.0, 0.0, 0.0]
         """
-        sum_children_size=0.0
-        num_children_size=0.0
-        weight=1.0
-        parent_size=float(self.node_size(node))
-        for child in self.node_children(node):
-            child_size=float(self.node_size(child))
-            if weighted:
-                weight=child_size/parent_size
-            sum_children_size+=weight*child_size
-            num_children_size+=weight
-        if num_children_size==0.0:
+        table=self.node_table()
+        i=self._node_position()[node]
+        if weighted:
+            return float(table['children_avrg_size'][i])
+        return float(table['children_avrg_size_unweighted'][i])
+
+class HMICache:
+    """A persistent cache of hierarchical mutual information values, stored in a SQLite database.
+
+    The values are stored under the key (hash_x,hash_y,norm), where the hashes are the **content_hash()** of the compared trees. Then, the cache survives the trees being regenerated, renumbered or saved to new files.
+    It is used through the **cache** parameter of **hierarchical_mutual_information()** and **normalized_hierarchical_mutual_information()**.
+
+    Parameters
+    ----------
+    filename : <str>
+        The filename (and path) of the SQLite database. It is created if it does not exist. Use ':memory:' for a non-persistent cache.
+    max_entries : <int=1000000>
+        The maximum number of entries, ie., of keys (not of bytes: each entry takes about the size of its two hashes plus five floats). When exceeded, the least recently used entries are evicted.
+
+    Comments:
+        The hits do not write to the database: their access times are kept in memory and written together, at the next **put()**, every 1000 hits, or on **close()**. So, the order of eviction may miss the hits of a process that ends without closing the cache.
+        The number of entries is counted once, when the cache is opened, and then kept up to date by **put()**. So, the entries stored meanwhile by other processes sharing the database only count towards **max_entries** after it is opened again.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition, HMICache
+    >>> from hierpart import normalized_hierarchical_mutual_information
+    >>> hpx=HierarchicalPartition(['a','b','c','d'])
+    >>> dummy=hpx.add_child(hpx.root(),['a','b'])
+    >>> dummy=hpx.add_child(hpx.root(),['c','d'])
+    >>> hpy=HierarchicalPartition(['a','b','c','d'])
+    >>> dummy=hpy.add_child(hpy.root(),['a','b','c'])
+    >>> dummy=hpy.add_child(hpy.root(),['d'])
+    >>> cache=HMICache(':memory:',max_entries=2)
+    >>> print '%.6f' % normalized_hierarchical_mutual_information(hpx,hpy,cache=cache)[0]
+    0.345592
+    >>> print len(cache), cache.get(hpx.content_hash(),hpy.content_hash(),'CS')==normalized_hierarchical_mutual_information(hpx,hpy)
+    1 True
+    >>> print '%.6f' % normalized_hierarchical_mutual_information(hpy,hpx,cache=cache)[0]
+    0.345592
+    >>> print len(cache)
+    1
+    >>> dummy=normalized_hierarchical_mutual_information(hpx,hpy,cache=cache,norm='add')
+    >>> dummy=normalized_hierarchical_mutual_information(hpx,hpy,cache=cache,norm='max')
+    >>> print len(cache), cache.get(hpx.content_hash(),hpy.content_hash(),'CS')
+    2 None
+    >>> cache.put('x','y','CS',(1.0,1.0,1.0,1.0))
+    >>> cache.put('x','y','CS',(1.0,1.0,1.0,1.0))
+    >>> print len(cache), cache._num_entries
+    2 2
+    """
+    def __init__(self,filename,max_entries=1000000):
+        assert max_entries>0,'ERROR in HMICache: max_entries should be positive.'
+        self._max_entries=int(max_entries)
+        self._db=sqlite3.connect(filename)
+        self._db.execute('CREATE TABLE IF NOT EXISTS hmi ('
+                         'hash_x TEXT, hash_y TEXT, norm TEXT, '
+                         'nhmi REAL, hmi_xy REAL, hmi_xx REAL, hmi_yy REAL, '
+                         'last_used REAL, PRIMARY KEY (hash_x,hash_y,norm))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS hmi_last_used ON hmi (last_used)')
+        self._db.commit()
+        self._last_used={}
+        self._num_entries=len(self) # Kept up to date by put(), so that it never counts the table.
+
+    _MAX_PENDING_HITS=1000
+
+    def _write_last_used(self):
+        """Writes the access times of the recent hits, without committing."""
+        if self._last_used:
+            self._db.executemany('UPDATE hmi SET last_used=? WHERE hash_x=? AND hash_y=? AND norm=?',[(t,)+key for key,t in self._last_used.items()])
+            self._last_used.clear()
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM hmi').fetchone()[0]
+
+    def get(self,hash_x,hash_y,norm):
+        """Returns the cached values (i(T;T'),I(T;T'),I(T;T),I(T';T')) for the given key, or None if they are not in the cache. Since the values are symmetric, the swapped key (hash_y,hash_x,norm) is also looked up."""
+        for _hash_x,_hash_y,swapped in ((hash_x,hash_y,False),(hash_y,hash_x,True)):
+            row=self._db.execute('SELECT nhmi,hmi_xy,hmi_xx,hmi_yy FROM hmi WHERE hash_x=? AND hash_y=? AND norm=?',(_hash_x,_hash_y,norm)).fetchone()
+            if row is not None:
+                self._last_used[_hash_x,_hash_y,norm]=time.time()
+                if len(self._last_used)>=self._MAX_PENDING_HITS:
+                    self._write_last_used()
+                    self._db.commit()
+                if swapped:
+                    return row[0],row[1],row[3],row[2]
+                return tuple(row)
+        return None
+
+    def put(self,hash_x,hash_y,norm,values):
+        """Stores the values (i(T;T'),I(T;T'),I(T;T),I(T';T')) under the given key, evicting the least recently used entries if needed. Unknown values may be None."""
+        values=tuple(None if v is None else float(v) for v in values)
+        self._write_last_used()
+        if self._db.execute('SELECT 1 FROM hmi WHERE hash_x=? AND hash_y=? AND norm=?',(hash_x,hash_y,norm)).fetchone() is None:
+            self._num_entries+=1
+        self._db.execute('INSERT OR REPLACE INTO hmi VALUES (?,?,?,?,?,?,?,?)',(hash_x,hash_y,norm)+values+(time.time(),))
+        excess=self._num_entries-self._max_entries
+        if excess>0:
+            self._num_entries-=self._db.execute('DELETE FROM hmi WHERE rowid IN (SELECT rowid FROM hmi ORDER BY last_used LIMIT ?)',(excess,)).rowcount
+        self._db.commit()
+
+    def close(self):
+        """Writes the pending access times, and closes the underlying database."""
+        self._write_last_used()
+        self._db.commit()
+        self._db.close()
+
+class SharedHierarchy:
+    """A tree exported to a shared memory segment, as mapped by **HierarchicalPartition.attach()**.
+
+    It holds read-only memory maps of the arrays written by **HierarchicalPartition.to_shared_memory()**, which all the processes that attach the segment share. It pickles as the name of its segment, and it attaches the segment again when it is unpickled, so sending it to another process sends a few bytes, whatever the size of the tree.
+    It can be the reference of a **PreparedHierarchy**: then, the candidates are encoded against the sorted elements of the segment, and no dict of the reference is ever read.
+
+    Parameters
+    ----------
+    name : <str>
+        The name of the segment.
+    """
+    def __init__(self,name):
+        self._name=name
+        self._arrays=_attach_arrays(name)
+
+    def __getstate__(self):
+        return self._name
+
+    def __setstate__(self,name):
+        self.__init__(name)
+
+    def name(self):
+        """Returns the name of the segment."""
+        return self._name
+
+    def arrays(self):
+        """Returns the arrays of the segment, by name (see **HierarchicalPartition.to_shared_memory()**)."""
+        return dict(self._arrays)
+
+    def element_weights(self):
+        """Returns the weights of the elements, or None if the tree is not weighted."""
+        return self._arrays.get('weights')
+
+    def hierarchical_entropy(self):
+        """Returns the hierarchical entropy I(T;T) of the tree."""
+        return float(self._arrays['entropy'][0])
+
+    def _label_matrix(self):
+        return self._arrays['labels']
+
+    def _nonleaf_mask(self):
+        return self._arrays['nonleaf']
+
+    def _aligned_element_ids(self,candidate):
+        """Returns two <numpy.ndarray> with the positions, in **all_elements()** of **candidate** and of the tree, of the elements common to both, as **_aligned_element_ids(candidate,tree)** does. The elements are compared as in **save_hierarchical_partition_binary()**: integers, or else their str()."""
+        elements=self._arrays['elements']
+        elements_y=_elements_array(candidate.all_elements())
+        if len(elements)==0 or len(elements_y)==0 or (elements.dtype.kind=='i')!=(elements_y.dtype.kind=='i'):
+            return numpy.zeros(0,dtype=numpy.int64),numpy.zeros(0,dtype=numpy.int64)
+        order=self._arrays['order']
+        ids_x=order[numpy.searchsorted(elements,elements_y,sorter=order).clip(0,len(elements)-1)]
+        found=elements[ids_x]==elements_y
+        return numpy.flatnonzero(found),ids_x[found]
+
+class PreparedHierarchy:
+    """A reference tree prepared for fast one-vs-many comparisons.
+
+    The encoded labels, the leaves and the hierarchical entropy of the reference are computed once, at creation. Then, each comparison only encodes the candidate against the elements of the reference, and runs the vectorized computation over encoded labels (see **_label_hmi()**).
+    The results agree with **normalized_hierarchical_mutual_information(reference,candidate)** up to floating point rounding. The reference should not be modified afterwards.
+    The reference may be a **SharedHierarchy**, attached from a shared memory segment. Then, the prepared arrays are the memory maps of the segment, and the prepared hierarchy pickles as the segment name and the norm.
+
+    Parameters
+    ----------
+    reference : HierarchicalPartition or SharedHierarchy
+        The reference tree T.
+    norm : <str='CS'>
+        One of 'CS', 'add' or 'max' (see **normalized_hierarchical_mutual_information()**).
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition, PreparedHierarchy
+    >>> from hierpart import normalized_hierarchical_mutual_information
+    >>> hpx=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> rootx=hpx.root()
+    >>> n1x=hpx.add_child(rootx,['a','b','c'])
+    >>> n2x=hpx.add_child(rootx,['d','e','f'])
+    >>> dummy=hpx.add_child(n1x,['a'])
+    >>> n3x=hpx.add_child(n1x,['b','c'])
+    >>> dummy=hpx.add_child(n3x,['b'])
+    >>> dummy=hpx.add_child(n3x,['c'])
+    >>> hpy=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> rooty=hpy.root()
+    >>> n1y=hpy.add_child(rooty,['a','b','c'])
+    >>> n2y=hpy.add_child(rooty,['d','e','f'])
+    >>> dummy=hpy.add_child(n2y,['f'])
+    >>> n3y=hpy.add_child(n2y,['d','e'])
+    >>> dummy=hpy.add_child(n3y,['d'])
+    >>> dummy=hpy.add_child(n3y,['e'])
+    >>> prepared=PreparedHierarchy(hpx)
+    >>> print '%.6f %.6f %.6f %.6f' % prepared.compare(hpy)
+    0.557886 0.693147 1.242453 1.242453
+    >>> print '%.6f %.6f %.6f %.6f' % normalized_hierarchical_mutual_information(hpx,hpy)
+    0.557886 0.693147 1.242453 1.242453
+    >>> print ['%.6f' % values[0] for values in prepared.compare_many([hpx,hpy])]
+    ['1.000000', '0.557886']
+    >>> # Over a shared memory segment, it pickles in a few bytes, whatever the size of the reference.
+    >>> import pickle
+    >>> from hierpart import release_shared_memory
+    >>> hpz=HierarchicalPartition(['e%d' % i for i in xrange(100000)])
+    >>> dummy=hpz.add_child(hpz.root(),['e%d' % i for i in xrange(50000)])
+    >>> dummy=hpz.add_child(hpz.root(),['e%d' % i for i in xrange(50000,100000)])
+    >>> names=[hpx.to_shared_memory(),hpz.to_shared_memory()]
+    >>> shared=[PreparedHierarchy(HierarchicalPartition.attach(name)) for name in names]
+    >>> print len(pickle.dumps(PreparedHierarchy(hpx),2))<len(pickle.dumps(PreparedHierarchy(hpz),2)), len(set(len(pickle.dumps(p,2)) for p in shared))
+    True 1
+    >>> print '%.6f %.6f %.6f %.6f' % pickle.loads(pickle.dumps(shared[0],2)).compare(hpy)
+    0.557886 0.693147 1.242453 1.242453
+    >>> for name in names: release_shared_memory(name)
+    """
+    def __init__(self,reference,norm='CS'):
+        assert isinstance(reference,(HierarchicalPartition,SharedHierarchy))
+        assert norm in ('CS','add','max'), "ERROR: norm should be one of 'CS','add','max'"
+        self._reference=reference
+        self._norm=norm
+        self._labels=reference._label_matrix()
+        self._nonleaf=reference._nonleaf_mask()
+        self._HMI_xx=reference.hierarchical_entropy()
+        if isinstance(reference,HierarchicalPartition):
+            reference._element_index()
+
+    def __getstate__(self):
+        if isinstance(self._reference,SharedHierarchy):
+            return {'_reference':self._reference,'_norm':self._norm}
+        return self.__dict__
+
+    def __setstate__(self,state):
+        if '_labels' in state:
+            self.__dict__.update(state)
+        else:
+            self.__init__(state['_reference'],state['_norm'])
+
+    def reference(self):
+        """Returns the reference tree."""
+        return self._reference
+
+    def norm(self):
+        """Returns the norm used by the comparisons."""
+        return self._norm
+
+    def compare(self,candidate):
+        """Compares a candidate tree against the reference.
+
+        Parameters
+        ----------
+        candidate : HierarchicalPartition
+            The tree T'.
+
+        Returns
+        -------
+        : (<float>,<float>,<float>,<float>)
+            It returns i(T;T'), I(T;T'), I(T;T), I(T';T')
+        """
+        assert isinstance(candidate,HierarchicalPartition)
+        if isinstance(self._reference,SharedHierarchy):
+            ids_y,ids_x=self._reference._aligned_element_ids(candidate)
+        else:
+            ids_y,ids_x=_aligned_element_ids(candidate,self._reference)
+        weights=_common_weights(self._reference,candidate,ids_x,ids_y)
+        HMI_xy=_label_hmi(self._labels[ids_x],candidate._label_matrix()[ids_y],self._nonleaf,candidate._nonleaf_mask(),weights=weights)
+        HMI_yy=candidate.hierarchical_entropy()
+        return _normalize_hmi(HMI_xy,self._HMI_xx,HMI_yy,self._norm)
+
+    def compare_many(self,candidates,n_jobs=1,chunksize=1):
+        """Compares several candidate trees against the reference.
+
+        Parameters
+        ----------
+        candidates : <iterable>
+            The candidate trees.
+        n_jobs : <int=1>
+            The number of processes. If larger than 1, the candidates are compared in a <multiprocessing.Pool>, whose workers attach the reference from a shared memory segment (see **SharedHierarchy**), which is written for the call unless the reference already is one. So, the workers share a single copy of it.
+        chunksize : <int=1>
+            The number of candidates sent at once to each worker.
+
+        Returns
+        -------
+        : <list>
+            The values returned by **compare()** for each candidate, in order.
+        """
+        if n_jobs==1:
+            return [self.compare(candidate) for candidate in candidates]
+        name=None
+        prepared=self
+        if not isinstance(self._reference,SharedHierarchy):
+            name=self._reference.to_shared_memory()
+            prepared=PreparedHierarchy(HierarchicalPartition.attach(name),norm=self._norm)
+        try:
+            pool=multiprocessing.Pool(n_jobs,initializer=_init_prepared_worker,initargs=(prepared,))
+            try:
+                return list(pool.imap(_prepared_worker_compare,candidates,chunksize))
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            if name is not None:
+                release_shared_memory(name)
+
+class TrackedComparison:
+    """Keeps I(T;T') up to date while the tree T is edited against a fixed target tree T'.
+
+    The values I(T_v;T'_v') of all the pairs of nodes explored by the recursion of **sub_hierarchical_mutual_information()** are cached, together with the hierarchical entropy I(T_v;T_v) of the nodes of T.
+    Every modification of T (**add_child()**, **remove_subtree()**, **merge_siblings()**, **split_node()**, **move_element()**, **move_subtree()**, **insert_elements()**) tells the tracker which nodes changed. Then, only the pairs with a node on the paths from those nodes up to the root are recomputed by the next **compare()**; the other ones are reused.
+    The values are those of the recursion without shortcut, so they agree with **normalized_hierarchical_mutual_information()** up to floating point rounding. Modifying the target T' invalidates all the cached pairs. Weighted elements are not supported.
+
+    Parameters
+    ----------
+    hierpart : HierarchicalPartition
+        The tree T, to be edited.
+    target : HierarchicalPartition
+        The target tree T'.
+    norm : <str='CS'>
+        One of 'CS', 'add' or 'max' (see **normalized_hierarchical_mutual_information()**).
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition, TrackedComparison
+    >>> from hierpart import normalized_hierarchical_mutual_information
+    >>> hpx=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> n1x=hpx.add_child(hpx.root(),['a','b','c'])
+    >>> n2x=hpx.add_child(hpx.root(),['d','e','f'])
+    >>> dummy=hpx.add_child(n1x,['a'])
+    >>> n3x=hpx.add_child(n1x,['b','c'])
+    >>> hpy=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> n1y=hpy.add_child(hpy.root(),['a','b'])
+    >>> n2y=hpy.add_child(hpy.root(),['c','d','e','f'])
+    >>> dummy=hpy.add_child(n2y,['c','d'])
+    >>> dummy=hpy.add_child(n2y,['e','f'])
+    >>> tracked=TrackedComparison(hpx,hpy)
+    >>> print '%.6f %.6f %.6f %.6f' % tracked.compare()
+    0.301921 0.318257 1.011404 1.098612
+    >>> hpx.move_element('c',n2x)
+    >>> print '%.6f %.6f %.6f %.6f' % tracked.compare()
+    0.651982 0.636514 0.867563 1.098612
+    >>> print '%.6f %.6f %.6f %.6f' % normalized_hierarchical_mutual_information(hpx,hpy)
+    0.651982 0.636514 0.867563 1.098612
+    >>> # The entries of the removed nodes are dropped, so the cache does not grow with the edits.
+    >>> sizes=lambda: (len(tracked._pairs),len(tracked._sets),len(tracked._entropy))
+    >>> before=sizes()
+    >>> for i in xrange(100):
+    ...     n4x=hpx.split_node(n2x,['e','f'])
+    ...     dummy=tracked.compare()
+    ...     dummy=hpx.merge_siblings(n2x,n4x)
+    ...     hpx.insert_elements(['g'],[n2x])
+    ...     n5x=hpx.split_node(n2x,['g'])
+    ...     dummy=tracked.compare()
+    ...     dummy=hpx.remove_subtree(n5x)
+    >>> print '%.6f %.6f %.6f %.6f' % tracked.compare(), sizes()==before
+    0.651982 0.636514 0.867563 1.098612 True
+    """
+    def __init__(self,hierpart,target,norm='CS'):
+        assert isinstance(hierpart,HierarchicalPartition)
+        assert isinstance(target,HierarchicalPartition)
+        assert norm in ('CS','add','max'), "ERROR: norm should be one of 'CS','add','max'"
+        assert hierpart.element_weights() is None and target.element_weights() is None,'ERROR in TrackedComparison: weighted elements are not supported.'
+        self._hierpart=hierpart
+        self._target=target
+        self._norm=norm
+        self._pairs={}     # node_x -> {node_y : I(T_v;T'_v')}
+        self._entropy={}   # node_x -> I(T_v;T_v)
+        self._sets={}      # node_x -> set of elements
+        self._target_sets={}
+        self._dirty=set()
+        self._HMI_yy=None
+        for hp in (hierpart,target):
+            if hp._trackers is None:
+                hp._trackers=weakref.WeakSet()
+            hp._trackers.add(self)
+
+    def hierarchical_partition(self):
+        """Returns the tracked tree T."""
+        return self._hierpart
+
+    def target(self):
+        """Returns the target tree T'."""
+        return self._target
+
+    def _touch(self,hierpart,nodes,removed=()):
+        """Called by a tree after it is modified. The entries of the **removed** nodes are dropped, since their names are never used again."""
+        if hierpart is self._target:
+            self._pairs.clear()
+            self._target_sets.clear()
+            self._HMI_yy=None
+            return
+        for node in removed:
+            self._pairs.pop(node,None)
+            self._entropy.pop(node,None)
+            self._sets.pop(node,None)
+            self._dirty.discard(node)
+        for node in nodes:
+            # The ancestors of a dirty node are dirty too, so the walk stops at the first one.
+            while node is not None and node not in self._dirty:
+                self._dirty.add(node)
+                node=hierpart.node_parent(node)
+
+    def _flush(self):
+        for node in self._dirty:
+            self._pairs.pop(node,None)
+            self._entropy.pop(node,None)
+            self._sets.pop(node,None)
+        self._dirty.clear()
+
+    def _set(self,node):
+        try:
+            return self._sets[node]
+        except KeyError:
+            pass
+        w=self._sets[node]=set(self._hierpart.node_elements(node))
+        return w
+
+    def _target_set(self,node):
+        try:
+            return self._target_sets[node]
+        except KeyError:
+            pass
+        w=self._target_sets[node]=set(self._target.node_elements(node))
+        return w
+
+    def _sub_hmi(self,node_x,node_y):
+        """Returns I(T_v;T'_v'), with the same arithmetic as **sub_hierarchical_mutual_information()**."""
+        pairs=self._pairs.setdefault(node_x,{})
+        try:
+            return pairs[node_y]
+        except KeyError:
+            pass
+        hx=self._hierpart
+        hy=self._target
+        wxy=self._set(node_x)&self._target_set(node_y)
+        denxy=float(len(wxy))
+        if denxy==0.0 or hx.node_leaf(node_x) or hy.node_leaf(node_y):
+            pairs[node_y]=0.0
             return 0.0
-        return sum_children_size/num_children_size
+        children_x=list(hx.node_children(node_x))
+        children_y=list(hy.node_children(node_y))
+        Sx=0.0
+        for child_x in children_x:
+            Sx-=_plogp(float(len(self._set(child_x)&wxy))/denxy)
+        Sy=0.0
+        for child_y in children_y:
+            Sy-=_plogp(float(len(self._target_set(child_y)&wxy))/denxy)
+        Sxy=0.0
+        second_term_xy=0.0
+        for child_x in children_x:
+            w_child_x=self._set(child_x)
+            for child_y in children_y:
+                frac=float(len(w_child_x&self._target_set(child_y)))/denxy
+                Sxy-=_plogp(frac)
+                second_term_xy+=frac*self._sub_hmi(child_x,child_y)
+        value=(Sx+Sy-Sxy)+second_term_xy
+        pairs[node_y]=value
+        return value
+
+    def _sub_entropy(self,node):
+        """Returns I(T_v;T_v), with the same arithmetic as **HierarchicalPartition.hierarchical_entropy()**."""
+        try:
+            return self._entropy[node]
+        except KeyError:
+            pass
+        hx=self._hierpart
+        denxy=float(hx.node_size(node))
+        value=0.0
+        if denxy>0.0 and not hx.node_leaf(node):
+            Sx=0.0
+            second_term_xy=0.0
+            for child in hx.node_children(node):
+                frac=float(hx.node_size(child))/denxy
+                Sx-=_plogp(frac)
+                second_term_xy+=frac*self._sub_entropy(child)
+            value=Sx+second_term_xy
+        self._entropy[node]=value
+        return value
+
+    def compare(self):
+        """Compares the current tree T against the target, recomputing only what changed since the last call.
+
+        Returns
+        -------
+        : (<float>,<float>,<float>,<float>)
+            It returns i(T;T'), I(T;T'), I(T;T), I(T';T')
+        """
+        self._flush()
+        if self._HMI_yy is None:
+            self._HMI_yy=self._target.hierarchical_entropy()
+        HMI_xy=self._sub_hmi(self._hierpart.root(),self._target.root())
+        HMI_xx=self._sub_entropy(self._hierpart.root())
+        return _normalize_hmi(HMI_xy,HMI_xx,self._HMI_yy,self._norm)
+
+_PREPARED=None
+
+def _init_prepared_worker(prepared):
+    global _PREPARED
+    _PREPARED=prepared
+
+def _prepared_worker_compare(candidate):
+    return _PREPARED.compare(candidate)
 
 ##############################################################################
 # Public Functions ###########################################################
@@ -981,6 +2978,9 @@ class HierarchicalPartition:
 def save_hierarchical_partition(hier_part,fileout=None,fhw=None):
     """It saves a HierarchicalPartition object into a file.
 
+    Comments:
+        If all the elements are integers, a first line '# elements: int' (or '# elements: indices', for trees with elements_are_indices) records it, so that **load_hierarchical_partition()** returns them as integers instead of strings.
+
     Parameters
     ----------
 
@@ -995,6 +2995,10 @@ def save_hierarchical_partition(hier_part,fileout=None,fhw=None):
     assert not ( fileout is not None and fhw is not None ), "ERROR in save_hierarchical_partition : fileout and fhw, cannot be both specified."
     if fileout is not None:
         fhw=open(fileout,'w')
+    if hier_part.elements_are_indices():
+        print >>fhw,'# elements: indices'
+    elif all(isinstance(e,(int,long,numpy.integer)) for e in hier_part.all_elements()):
+        print >>fhw,'# elements: int'
     count_vs_depth=defaultdict(int)
     for node in hier_part.dfs_traversal():
         depth=hier_part.node_depth(node)
@@ -1009,7 +3013,7 @@ def save_hierarchical_partition(hier_part,fileout=None,fhw=None):
             elements=''
             sep=''
             for element in hier_part.node_elements(node):
-                assert '"' not in element,'ERROR: the double quotation mark " cannot be part of an element name for saving.'
+                assert '"' not in str(element),'ERROR: the double quotation mark " cannot be part of an element name for saving.'
                 elements+=sep+'"'+str(element)+'"'
                 sep=','
             print >>fhw,elements
@@ -1027,16 +3031,42 @@ def load_hierarchical_partition(filein):
     Returns
     -------
     : HierarchicalPartition
-        The loaded tree.
+        The loaded tree. Its elements are strings, unless the file records that they are integers (see **save_hierarchical_partition()**).
+
+    Example
+    -------
+    >>> import os, shutil, tempfile
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import save_hierarchical_partition, load_hierarchical_partition
+    >>> hp=HierarchicalPartition(range(4),elements_are_indices=True)
+    >>> n1=hp.add_child(hp.root(),[0,1])
+    >>> n2=hp.add_child(hp.root(),[2,3])
+    >>> tmpdir=tempfile.mkdtemp()
+    >>> save_hierarchical_partition(hp,os.path.join(tmpdir,'hp.txt'))
+    >>> print open(os.path.join(tmpdir,'hp.txt')).read()
+    # elements: indices
+    0 "2","3"
+    1 "0","1"
+    <BLANKLINE>
+    >>> hpl=load_hierarchical_partition(os.path.join(tmpdir,'hp.txt'))
+    >>> print hpl.elements_are_indices(), sorted(hpl.node_elements(n).tolist() for n in hpl.leaves())
+    True [[0, 1], [2, 3]]
+    >>> shutil.rmtree(tmpdir)
     """
     element_2_path=defaultdict(float)
+    kind=None
     with open(filein,'r') as fh:
         for line in fh.readlines():
+            if line.startswith('# elements:'):
+                kind=line.split(':')[1].strip()
+                continue
             if '#' in line:
                 continue
             cols=line.split()
             path=cols[0].split(',')
             elements=[e.replace('"','') for e in cols[1].split('","')]
+            if kind is not None:
+                elements=[int(e) for e in elements]
             for i,e in enumerate(elements):
                 element_2_path[e]=path
     assert len(set(element_2_path.keys()))==len(element_2_path) # Check elements are unique.
@@ -1064,7 +3094,10 @@ def load_hierarchical_partition(filein):
             node=node[i]
             node.add_element(element)
 
-    _hier_part=HierarchicalPartition(root.elements)
+    if kind=='indices':
+        _hier_part=HierarchicalPartition(sorted(root.elements),elements_are_indices=True)
+    else:
+        _hier_part=HierarchicalPartition(root.elements)
     node_2_hp_node={}
     node_2_hp_node[root]=_hier_part.root()
     traverse=[root]
@@ -1081,6 +3114,143 @@ def load_hierarchical_partition(filein):
     #
     return _hier_part
 
+def save_hierarchical_partition_binary(hier_part,fileout):
+    """It saves a HierarchicalPartition object into a binary (numpy .npz) file.
+
+    Comments:
+        The file stores the table of elements, and the nodes in BFS order as flat arrays: the parent of each node, plus the offsets and encoded elements of each node. Integer elements are stored as integers; any other element is stored as its str(), as in **save_hierarchical_partition()**. The weights of the elements, if any, are stored too, and so is whether the tree has elements_are_indices.
+
+    Parameters
+    ----------
+    hier_part : HierarchicalPartition
+        The tree to be saved.
+    fileout : <str>
+        The name (and path) of the file where the tree is saved. numpy appends the extension '.npz' if it is missing.
+
+    Example
+    -------
+    >>> import os, shutil, tempfile
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import save_hierarchical_partition_binary, load_hierarchical_partition_binary
+    >>> hp=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> root=hp.root()
+    >>> n1=hp.add_child(root,['a','b','c'])
+    >>> n2=hp.add_child(root,['d','e','f'])
+    >>> dummy=hp.add_child(n1,['a'])
+    >>> n3=hp.add_child(n1,['b','c'])
+    >>> tmpdir=tempfile.mkdtemp()
+    >>> save_hierarchical_partition_binary(hp,os.path.join(tmpdir,'hp.npz'))
+    >>> load_hierarchical_partition_binary(os.path.join(tmpdir,'hp.npz')).show()
+    0 ['a', 'b', 'c', 'd', 'e', 'f']
+    1 ['a', 'b', 'c']
+    2 ['d', 'e', 'f']
+    3 ['a']
+    4 ['b', 'c']
+    >>> shutil.rmtree(tmpdir)
+    """
+    elements=_elements_array(hier_part.all_elements())
+    nodes,parent,offsets,element_ids=hier_part._csr_arrays()
+    arrays=dict(elements=elements,parent=parent,offsets=offsets,element_ids=element_ids)
+    if hier_part.element_weights() is not None:
+        arrays['weights']=hier_part.element_weights()
+    if hier_part.elements_are_indices():
+        arrays['elements_are_indices']=numpy.array(True)
+    numpy.savez(fileout,**arrays)
+
+def load_hierarchical_partition_binary(filein):
+    """Load a Hierarchical Partition from a binary file written by **save_hierarchical_partition_binary()**.
+
+    Parameters
+    ----------
+    filein : <str>
+        The filename (and path) to the file where a tree is stored.
+
+    Returns
+    -------
+    : HierarchicalPartition
+        The loaded tree. Its nodes are numbered in BFS order.
+    """
+    data=numpy.load(filein)
+    try:
+        elements=data['elements'].tolist()
+        parent=data['parent']
+        offsets=data['offsets']
+        element_ids=data['element_ids']
+        weights=data['weights'] if 'weights' in data.files else None
+        indices='elements_are_indices' in data.files
+    finally:
+        data.close()
+    root_ids=element_ids[offsets[0]:offsets[1]]
+    if indices:
+        # The encoded ids are the elements themselves.
+        _hier_part=HierarchicalPartition(root_ids,weights=None if weights is None else weights[root_ids],elements_are_indices=True)
+    else:
+        _hier_part=HierarchicalPartition([elements[j] for j in root_ids.tolist()],weights=None if weights is None else weights[root_ids])
+    position_2_node=[_hier_part.root()]
+    for i in xrange(1,len(parent)):
+        if indices:
+            child_elements=element_ids[offsets[i]:offsets[i+1]]
+        else:
+            child_elements=[elements[j] for j in element_ids[offsets[i]:offsets[i+1]].tolist()]
+        position_2_node.append(_hier_part.add_child(position_2_node[parent[i]],child_elements))
+    return _hier_part
+
+def release_shared_memory(name):
+    """Releases a shared memory segment written by **HierarchicalPartition.to_shared_memory()**.
+
+    Comments:
+        Processes that still map the segment keep their maps, until they drop them.
+
+    Parameters
+    ----------
+    name : <str>
+        The name of the segment.
+    """
+    assert os.path.isdir(name),'ERROR: there is no shared memory segment named '+repr(name)
+    shutil.rmtree(name)
+
+def save_hierarchical_partition_labels(hier_part,fileout,elements=None):
+    """It saves the labels of the levels of a HierarchicalPartition into a .npy file, to be used by **out_of_core_hierarchical_mutual_information()**.
+
+    Comments:
+        The file holds a single <numpy.ndarray> with shape (max_depth+1, number of rows), in C order, so that each level can be read as a contiguous array. Row d holds, for each element, the node at depth d containing it; elements in a leaf shallower than d keep the label of that leaf; elements not in the tree have label -1 at every level. Elements of a non-leaf node v that are in none of its children have label -2 below v; so the label of a row changes from one level to the next if and only if the node containing it is not a leaf. The labels are int32, or int64 if there are too many nodes.
+        The rows follow the order **elements**, which should be shared by all the files to be compared. Files in this format can also be written directly by other tools, and read without holding the tree in memory.
+
+    Parameters
+    ----------
+    hier_part : HierarchicalPartition
+        The tree to be saved.
+    fileout : <str>
+        The name (and path) of the .npy file.
+    elements : <list=None>
+        The elements, in the order of the rows. By default, **all_elements()**.
+    """
+    L=hier_part._label_matrix()
+    nonleaf=hier_part._nonleaf_mask()
+    dtype=numpy.int32 if hier_part._next_node<2**31 else numpy.int64
+    if elements is None:
+        rows=numpy.arange(L.shape[0],dtype=numpy.int64)
+    else:
+        _index=hier_part._element_index()
+        rows=numpy.fromiter((_index.get(e,-1) for e in elements),dtype=numpy.int64,count=len(elements))
+    present=rows>=0
+    out=numpy.lib.format.open_memmap(fileout,mode='w+',dtype=dtype,shape=(L.shape[1],len(rows)))
+    try:
+        for d in xrange(L.shape[1]):
+            labels=L[rows[present],d].astype(numpy.int64)
+            if d>0:
+                # They keep the label of v in the label matrix, at every level below it.
+                uncovered=(labels==parent)&nonleaf[parent]
+                labels[uncovered]=-2
+            parent=L[rows[present],d]
+            level=numpy.empty(len(rows),dtype=dtype)
+            level.fill(-1)
+            level[present]=labels
+            out[d]=level
+        out.flush()
+    finally:
+        del out
+
 # Hierarchical mutual information tools
 ########################################
 
@@ -1098,7 +3268,167 @@ def _node_communities(hierpart,node):
         s=s+';'+','.join(hierpart.node_elements(child))
     return s[1:]
 
-def sub_hierarchical_mutual_information(hierpart_x,hierpart_y,node_x,node_y,depth,show=False):
+def _restrict_to_common_elements(hierpart_x,hierpart_y):
+    """Restricts both trees to the elements they have in common. Trees that already contain only common elements are returned as they are."""
+    ids_x,ids_y=_aligned_element_ids(hierpart_x,hierpart_y)
+    if hierpart_x.elements_are_indices():
+        common=hierpart_x.all_elements()[ids_x]
+    else:
+        common=[hierpart_x.all_elements()[i] for i in ids_x.tolist()]
+    if len(common)<hierpart_x.total_num_elements():
+        hierpart_x=hierpart_x.restrict(common)
+    if len(common)<hierpart_y.total_num_elements():
+        hierpart_y=hierpart_y.restrict(common)
+    return hierpart_x,hierpart_y
+
+def _common_weights(hierpart_x,hierpart_y,ids_x,ids_y):
+    """Returns the weights of the common elements of both trees, given by **_aligned_element_ids()**, or None if neither tree is weighted. A tree without weights gives weight 1 to every element."""
+    weights_x=hierpart_x.element_weights()
+    weights_y=hierpart_y.element_weights()
+    if weights_x is None and weights_y is None:
+        return None
+    weights=numpy.ones(len(ids_x),dtype=numpy.double) if weights_x is None else weights_x[ids_x]
+    if hierpart_y is not hierpart_x:
+        _weights=numpy.ones(len(ids_y),dtype=numpy.double) if weights_y is None else weights_y[ids_y]
+        assert numpy.array_equal(weights,_weights),'ERROR: both trees should give the same weights to their common elements.'
+    return weights
+
+def _encoded_hierarchical_mutual_information(hierpart_x,hierpart_y,max_depth=None):
+    """Computes I(T;T') by the vectorized computation over encoded labels (see **_label_hmi()**), for trees with weighted elements or truncated at **max_depth**. Its cost does not depend on the magnitude of the weights.
+
+    Returns
+    -------
+    : (<float>,<numpy.ndarray>)
+        I(T;T'), and the contribution of each depth.
+    """
+    ids_x,ids_y=_aligned_element_ids(hierpart_x,hierpart_y)
+    weights=_common_weights(hierpart_x,hierpart_y,ids_x,ids_y)
+    return _label_hmi(hierpart_x._label_matrix(max_depth)[ids_x],hierpart_y._label_matrix(max_depth)[ids_y],hierpart_x._nonleaf_mask(),hierpart_y._nonleaf_mask(),weights=weights,max_depth=max_depth,profile=True)
+
+_POPCOUNT=numpy.array([bin(i).count('1') for i in xrange(256)],dtype=numpy.int64)
+
+def _popcount(words):
+    """Returns the number of bits set in a uint64 <numpy.ndarray>, counted byte by byte with a lookup table."""
+    return int(_POPCOUNT[words.view(numpy.uint8)].sum())
+
+def _bitset_intersection(a,b):
+    """Returns the intersection of two bitsets, each given as a pair (lo,words), where words[i] is the word lo+i of the bitset."""
+    lo=max(a[0],b[0])
+    hi=min(a[0]+len(a[1]),b[0]+len(b[1]))
+    if hi<=lo:
+        return 0,numpy.zeros(0,dtype=numpy.uint64)
+    return lo,a[1][lo-a[0]:hi-a[0]]&b[1][lo-b[0]:hi-b[0]]
+
+def _node_bitsets(hierpart,ids,rank):
+    """Returns a dict mapping each node of the tree to the bitset, as a pair (lo,words), of the ranks of its elements; **rank[k]** is the rank of the element with position **ids[k]** in **all_elements()**, and the other elements are left out."""
+    position=numpy.empty(hierpart.total_num_elements(),dtype=numpy.int64)
+    position.fill(-1)
+    position[ids]=rank
+    bitsets={}
+    for node in hierpart.nodes():
+        p=position[hierpart._element_ids(node)]
+        p=p[p>=0]
+        if len(p)==0:
+            bitsets[node]=(0,numpy.zeros(0,dtype=numpy.uint64))
+            continue
+        lo=int(p.min())>>6
+        bits=numpy.zeros(((int(p.max())>>6)-lo+1)*64,dtype=bool)
+        bits[p-lo*64]=True
+        words=numpy.packbits(bits).view(numpy.uint64)
+        words.flags.writeable=False
+        bitsets[node]=(lo,words)
+    return bitsets
+
+def node_bitsets(hierpart_x,hierpart_y):
+    """Returns the elements of the nodes of two trees as bitsets, to compute the sizes of their intersections by popcounts instead of with sets.
+
+    Comments:
+        The bits are the elements common to both trees, numbered in the order of the leaves of T, so that the bits of every node of T are contiguous. Each bitset is a pair (lo,words), where **words** is a read-only uint64 <numpy.ndarray> with the words from lo up to the last word with a bit set, and the intersection of two bitsets only visits the words where both overlap.
+        See **membership_nbytes()** for the memory they take, and **sub_hierarchical_mutual_information()** for their use.
+
+    Parameters
+    ----------
+    hierpart_x : HierarchicalPartition
+        The tree T.
+    hierpart_y : HierarchicalPartition
+        The tree T'.
+
+    Returns
+    -------
+    : (<dict>,<dict>)
+        For each tree, a dict mapping each node to its bitset.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import node_bitsets, sub_hierarchical_mutual_information
+    >>> hpx=HierarchicalPartition(range(200))
+    >>> n1x=hpx.add_child(hpx.root(),range(100))
+    >>> n2x=hpx.add_child(hpx.root(),range(100,200))
+    >>> hpy=HierarchicalPartition(range(200))
+    >>> n1y=hpy.add_child(hpy.root(),range(0,200,2))
+    >>> n2y=hpy.add_child(hpy.root(),range(1,200,2))
+    >>> bitsets_x,bitsets_y=node_bitsets(hpx,hpy)
+    >>> print bitsets_x[n2x][0], len(bitsets_x[n2x][1]), len(bitsets_y[n2y][1])
+    1 3 4
+    >>> print '%.6f %.6f' % (sub_hierarchical_mutual_information(hpx,hpy,0,0,0,bitsets=(bitsets_x,bitsets_y)), sub_hierarchical_mutual_information(hpx,hpy,0,0,0))
+    0.000000 0.000000
+    >>> dummy=hpx.add_child(n1x,range(50))
+    >>> dummy=hpx.add_child(n1x,range(50,100))
+    >>> hpz=HierarchicalPartition(range(200))
+    >>> n1z=hpz.add_child(hpz.root(),range(150))
+    >>> n2z=hpz.add_child(hpz.root(),range(150,200))
+    >>> dummy=hpz.add_child(n1z,range(0,150,2))
+    >>> dummy=hpz.add_child(n1z,range(1,150,2))
+    >>> bitsets_x,bitsets_z=node_bitsets(hpx,hpz)
+    >>> print '%.6f %.6f' % (sub_hierarchical_mutual_information(hpx,hpz,0,0,0,bitsets=(bitsets_x,bitsets_z)), sub_hierarchical_mutual_information(hpx,hpz,0,0,0))
+    0.215762 0.215762
+    """
+    ids_x,ids_y=_aligned_element_ids(hierpart_x,hierpart_y)
+    Lx=hierpart_x._label_matrix()[ids_x]
+    order=numpy.lexsort(Lx.T[::-1])
+    rank=numpy.empty(len(order),dtype=numpy.int64)
+    rank[order]=numpy.arange(len(order),dtype=numpy.int64)
+    return _node_bitsets(hierpart_x,ids_x,rank),_node_bitsets(hierpart_y,ids_y,rank)
+
+def membership_nbytes(hierpart_x,hierpart_y):
+    """Returns the memory taken by the elements of the nodes of two trees, for each representation that **sub_hierarchical_mutual_information()** can use for their intersections.
+
+    Comments:
+        'sets' is the memory of the <set> of the elements of every node, as the recursion builds them (one at a time, though), measured with <sys.getsizeof>, without the elements themselves. 'bitsets' is the memory of the words of **node_bitsets()**, which is small when the elements of T' are clustered like those of T, and at most (num_nodes_x+num_nodes_y)*N/8 bytes, for N common elements.
+
+    Returns
+    -------
+    : <dict>
+        The number of bytes for 'sets' and for 'bitsets'.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import membership_nbytes
+    >>> hpx=HierarchicalPartition(range(200))
+    >>> n1x=hpx.add_child(hpx.root(),range(100))
+    >>> n2x=hpx.add_child(hpx.root(),range(100,200))
+    >>> hpy=HierarchicalPartition(range(200))
+    >>> n1y=hpy.add_child(hpy.root(),range(0,200,2))
+    >>> n2y=hpy.add_child(hpy.root(),range(1,200,2))
+    >>> memory=membership_nbytes(hpx,hpy)
+    >>> print memory['bitsets'], memory['sets']>memory['bitsets']
+    168 True
+    """
+    set_nbytes={}
+    nbytes=0
+    for hierpart in (hierpart_x,hierpart_y):
+        for node in hierpart.nodes():
+            n=hierpart.node_size(node)
+            if n not in set_nbytes:
+                set_nbytes[n]=sys.getsizeof(set(xrange(n)))
+            nbytes+=set_nbytes[n]
+    bitsets_x,bitsets_y=node_bitsets(hierpart_x,hierpart_y)
+    bitsets_nbytes=sum(words.nbytes for bitsets in (bitsets_x,bitsets_y) for lo,words in bitsets.values())
+    return {'sets':nbytes,'bitsets':bitsets_nbytes}
+
+def sub_hierarchical_mutual_information(hierpart_x,hierpart_y,node_x,node_y,depth,show=False,shortcut=True,bitsets=None):
     """Cumputes the hierarchical mutual information between two sub-trees.
     More specifically, it computes I( T_v ; T'_v' ), where T and T' are <HierarchicalPartitions>, v is a node in T and v' is a node in T'. Also, T_v is the sub-tree obtained from T with v as root. The analogous for T'_v'.
     
@@ -1119,6 +3449,10 @@ def sub_hierarchical_mutual_information(hierpart_x,hierpart_y,node_x,node_y,dept
         The depth at which the nodes v and v' are. This variable is used for internal checks.
     show : <bool>
         If True, information is printed on the screen as the computation progress.
+    shortcut : <bool=True>
+        If True, whenever v and v' are the same node of the same tree, or root identical sub-trees (see **HierarchicalPartition.subtree_hash()**), the cached **hierarchical_entropy()** of the sub-tree is returned instead of recursing. The sub-trees are only compared if both trees already cached their hashes (eg., after **HierarchicalPartition.content_hash()**), so that a first comparison never hashes the elements. It is ignored if **show** is True, or if any of the trees has weighted elements, since the recursion does not weight them.
+    bitsets : <tuple=None>
+        If given, the pair returned by **node_bitsets(hierpart_x,hierpart_y)**. Then, the sizes of the intersections are computed by popcounts over the bitsets, instead of building sets of elements at every pair of nodes. This is much faster for dense comparisons of nodes with many elements, if the bitsets fit in memory (see **membership_nbytes()**). The value does not change.
 
     Returns
     -------
@@ -1152,12 +3486,31 @@ def sub_hierarchical_mutual_information(hierpart_x,hierpart_y,node_x,node_y,dept
     0.69314718056
     >>> print sub_hierarchical_mutual_information(hpx,hpy,n1x,n1y,1)
     0.0
+    >>> print '%.6f' % sub_hierarchical_mutual_information(hpx,hpy,n2x,n2y,1)
+    0.000000
+    >>> # The recursion counts the elements, so weighted trees take no shortcut.
+    >>> hpw=HierarchicalPartition(['a','b','c'],weights=[1,1,2])
+    >>> dummy=hpw.add_child(hpw.root(),['a','b'])
+    >>> dummy=hpw.add_child(hpw.root(),['c'])
+    >>> print '%.6f %.6f' % (sub_hierarchical_mutual_information(hpw,hpw,hpw.root(),hpw.root(),0),hpw.hierarchical_entropy())
+    0.636514 0.693147
     """
+    if shortcut and not show and hierpart_x.element_weights() is None and hierpart_y.element_weights() is None:
+        if hierpart_x is hierpart_y and node_x==node_y:
+            return hierpart_x.hierarchical_entropy(node_x)
+        if 'subtree_hashes' in hierpart_x._cache and 'subtree_hashes' in hierpart_y._cache and hierpart_x._subtree_hashes()[node_x]==hierpart_y._subtree_hashes()[node_y]:
+            return hierpart_x.hierarchical_entropy(node_x)
+
     wx=hierpart_x.node_elements(node_x)
     wy=hierpart_y.node_elements(node_y)
 
-    wxy=set(wx)&set(wy)
-    denxy=float(len(wxy))
+    if bitsets is None:
+        wxy=set(wx)&set(wy)
+        denxy=float(len(wxy))
+    else:
+        bitsets_x,bitsets_y=bitsets
+        wxy=_bitset_intersection(bitsets_x[node_x],bitsets_y[node_y])
+        denxy=float(_popcount(wxy[1]))
     if denxy==0.0 or hierpart_x.node_leaf(node_x) or hierpart_y.node_leaf(node_y):
         return 0.0
 
@@ -1170,18 +3523,24 @@ def sub_hierarchical_mutual_information(hierpart_x,hierpart_y,node_x,node_y,dept
     # Compute Sx
     Sx=0.0
     for child_x in hierpart_x.node_children(node_x):
-        w_child_x=hierpart_x.node_elements(child_x)
-        w_child_x_wxy=set(w_child_x)&wxy
-        num=float(len(w_child_x_wxy))
+        if bitsets is None:
+            w_child_x=hierpart_x.node_elements(child_x)
+            w_child_x_wxy=set(w_child_x)&wxy
+            num=float(len(w_child_x_wxy))
+        else:
+            num=float(_popcount(_bitset_intersection(bitsets_x[child_x],wxy)[1]))
         frac=num/denxy
         Sx-=_plogp(frac)
 
     # Compute Sy
     Sy=0.0
     for child_y in hierpart_y.node_children(node_y):
-        w_child_y=hierpart_y.node_elements(child_y)
-        w_child_y_wxy=set(w_child_y)&wxy
-        num=float(len(w_child_y_wxy))
+        if bitsets is None:
+            w_child_y=hierpart_y.node_elements(child_y)
+            w_child_y_wxy=set(w_child_y)&wxy
+            num=float(len(w_child_y_wxy))
+        else:
+            num=float(_popcount(_bitset_intersection(bitsets_y[child_y],wxy)[1]))
         frac=num/denxy
         Sy-=_plogp(frac)
 
@@ -1191,13 +3550,17 @@ def sub_hierarchical_mutual_information(hierpart_x,hierpart_y,node_x,node_y,dept
     for child_x in hierpart_x.node_children(node_x):
         w_child_x=hierpart_x.node_elements(child_x)
         for child_y in hierpart_y.node_children(node_y):
-            w_child_y=hierpart_y.node_elements(child_y)
-            w_child_xy=set(w_child_x)&set(w_child_y)
-            num=float(len(w_child_xy))
+            if bitsets is None:
+                w_child_y=hierpart_y.node_elements(child_y)
+                w_child_xy=set(w_child_x)&set(w_child_y)
+                num=float(len(w_child_xy))
+            else:
+                num=float(_popcount(_bitset_intersection(bitsets_x[child_x],bitsets_y[child_y])[1]))
             frac=num/denxy
 
             Sxy-=_plogp(frac)
-            second_term_xy+=frac*sub_hierarchical_mutual_information(hierpart_x,hierpart_y,child_x,child_y,depth+1)
+            if num>0.0: # Else, the pair contributes 0.
+                second_term_xy+=frac*sub_hierarchical_mutual_information(hierpart_x,hierpart_y,child_x,child_y,depth+1,shortcut=shortcut,bitsets=bitsets)
 
     one_step=Sx+Sy-Sxy
     #ret_val=Sx+Sy-Sxy+second_term_xy
@@ -1213,7 +3576,7 @@ def sub_hierarchical_mutual_information(hierpart_x,hierpart_y,node_x,node_y,dept
 
     return ret_val
 
-def hierarchical_mutual_information(hierpart_x,hierpart_y,show=False):
+def hierarchical_mutual_information(hierpart_x,hierpart_y,show=False,restrict=False,compress=False,shortcut=True,cache=None,max_depth=None,profile=False,bitsets=False):
 
     """Cumputes the hierarchical mutual information between two trees.
     More specifically, it computes I(T;T'), where T and T' are two <HierarchicalPartitions>.
@@ -1226,11 +3589,29 @@ def hierarchical_mutual_information(hierpart_x,hierpart_y,show=False):
         The hierarchical partition T'.
     show : <bool>
         If True, information is printed on the screen as the computation progress.
+    restrict : <bool=False>
+        If True, both trees are first restricted to their common elements (see **HierarchicalPartition.restrict()**), so that the intersections are not recomputed against the non-common elements at every pair of nodes. The value of I(T;T') does not change.
+    compress : <bool=False>
+        If True, the zero-size nodes and unary tails of both trees are first contracted (see **HierarchicalPartition.compress()**). The value of I(T;T') does not change.
+    shortcut : <bool=True>
+        If True, identical sub-trees are not explored; their cached hierarchical entropy is used instead (see **sub_hierarchical_mutual_information()**). Then, once both trees cached the hashes of their sub-trees (eg., after **HierarchicalPartition.content_hash()**), comparing near-duplicate trees takes time proportional to their differences.
+    cache : <HMICache=None>
+        If given, the value is looked up in the cache by the **content_hash()** of both trees (and **max_depth**, if given), and stored there if it was not found. It is not used when **show** or **profile** are True.
+    max_depth : <int=None>
+        If given, the computation does not descend below this depth: the nodes at depth **max_depth** are taken as leaves, and the deeper nodes are not visited. Then, only the levels above contribute to the truncated I(T;T'). With **compress**, the depths are those of the compressed trees.
+    profile : <bool=False>
+        If True, the contribution of each depth d, ie., the sum over the pairs of nodes (v,v') at depth d of n(v,v')/n times Sx+Sy-Sxy at (v,v'), is returned too. Its cumulative sum gives the value truncated at each depth.
+    bitsets : <bool=False>
+        If True, the recursion computes the sizes of the intersections with **node_bitsets()** (see **sub_hierarchical_mutual_information()**). The value does not change.
+
+    Comments:
+        If any of the trees has weighted elements (see **HierarchicalPartition**), every element counts by its weight. Then, or if **max_depth** or **profile** are given, the value is computed by the vectorized computation over encoded labels instead of the recursion; **show** and **shortcut** have no effect, and the elements that are not common to both trees are ignored. Both trees should give the same weights to their common elements.
+        If both trees have elements_are_indices (see **HierarchicalPartition**), and **show** is False, the value is computed by the vectorized computation too, so that the elements are never hashed, as long as the children of every node are disjoint subsets of it (see **consistency_report()**); they need not cover it. Otherwise, the recursion is used.
 
     Returns
     -------
     : <float>
-        The value I(T;T').
+        The value I(T;T'). If **profile** is True, it returns a pair with the value and a <numpy.ndarray> with the contribution of each depth.
 
     Example
     -------
@@ -1278,14 +3659,125 @@ def hierarchical_mutual_information(hierpart_x,hierpart_y,show=False):
     1.24245332489
     >>> print hierarchical_mutual_information(hpx,hpy)
     0.69314718056
+    >>> # Elements that are not shared by both trees do not contribute.
+    >>> hpz=HierarchicalPartition(['a','b','c','d','e','f','g'])
+    >>> rootz=hpz.root()
+    >>> n1z=hpz.add_child(rootz,['a','b','c','g'])
+    >>> n2z=hpz.add_child(rootz,['d','e','f'])
+    >>> print '%.6f %.6f' % (hierarchical_mutual_information(hpx,hpz),hierarchical_mutual_information(hpx,hpz,restrict=True))
+    0.693147 0.693147
+    >>> # Weighting an element is the same as duplicating it.
+    >>> hpw=HierarchicalPartition(['a','b','c','d','e','f'],weights=[3,1,1,1,1,1])
+    >>> n1w=hpw.add_child(hpw.root(),['a','b','c'])
+    >>> n2w=hpw.add_child(hpw.root(),['d','e','f'])
+    >>> hpd=HierarchicalPartition(['a','a2','a3','b','c','d','e','f'])
+    >>> n1d=hpd.add_child(hpd.root(),['a','a2','a3','b','c'])
+    >>> n2d=hpd.add_child(hpd.root(),['d','e','f'])
+    >>> print '%.6f %.6f' % (hierarchical_mutual_information(hpw,hpw),hierarchical_mutual_information(hpd,hpd))
+    0.661563 0.661563
+    >>> # Truncation, and contribution of each depth.
+    >>> HMI,profile=hierarchical_mutual_information(hpx,hpx,profile=True)
+    >>> print '%.6f' % HMI, ['%.6f' % v for v in profile]
+    1.242453 ['0.693147', '0.318257', '0.231049']
+    >>> print '%.6f' % hierarchical_mutual_information(hpx,hpx,max_depth=2)
+    1.011404
+    >>> # A node not covered by its children gives the same value with elements_are_indices.
+    >>> for indices in (False,True):
+    ...     hpu=HierarchicalPartition(range(8),elements_are_indices=indices)
+    ...     n1u=hpu.add_child(hpu.root(),[0,1,2,3])
+    ...     n2u=hpu.add_child(n1u,[0,1])
+    ...     hpv=HierarchicalPartition(range(8),elements_are_indices=indices)
+    ...     n1v=hpv.add_child(hpv.root(),[0,1,4,5])
+    ...     n2v=hpv.add_child(hpv.root(),[2,3,6,7])
+    ...     print '%.6f' % hierarchical_mutual_information(hpu,hpv)
+    0.346574
+    0.346574
     """
     assert isinstance(hierpart_x,HierarchicalPartition)
     assert isinstance(hierpart_y,HierarchicalPartition)
-    root_x=hierpart_x.root()
-    root_y=hierpart_y.root()
-    return sub_hierarchical_mutual_information(hierpart_x,hierpart_y,root_x,root_y,0,show=show)
+    if cache is not None and not show and not profile:
+        hash_x=hierpart_x.content_hash()
+        hash_y=hierpart_y.content_hash()
+        cache_key=_truncation_key('',max_depth,compress)
+        values=cache.get(hash_x,hash_y,cache_key)
+        if values is not None:
+            return values[1]
+    if max_depth is not None or profile:
+        if compress:
+            hierpart_x=hierpart_x.compress()[0]
+            hierpart_y=hierpart_y.compress()[0]
+        HMI_xy,_profile=_encoded_hierarchical_mutual_information(hierpart_x,hierpart_y,max_depth)
+        if profile:
+            return HMI_xy,_profile
+    elif hierpart_x.element_weights() is not None or hierpart_y.element_weights() is not None:
+        HMI_xy=_encoded_hierarchical_mutual_information(hierpart_x,hierpart_y)[0]
+    else:
+        if restrict:
+            hierpart_x,hierpart_y=_restrict_to_common_elements(hierpart_x,hierpart_y)
+        if compress:
+            hierpart_x=hierpart_x.compress()[0]
+            hierpart_y=hierpart_y.compress()[0]
+        if not show and hierpart_x.elements_are_indices() and hierpart_y.elements_are_indices() and hierpart_x._disjoint_children() and hierpart_y._disjoint_children():
+            HMI_xy=_encoded_hierarchical_mutual_information(hierpart_x,hierpart_y)[0]
+        else:
+            root_x=hierpart_x.root()
+            root_y=hierpart_y.root()
+            _bitsets=None
+            if bitsets and not ( shortcut and not show and hierpart_x is hierpart_y ):
+                _bitsets=node_bitsets(hierpart_x,hierpart_y)
+            HMI_xy=sub_hierarchical_mutual_information(hierpart_x,hierpart_y,root_x,root_y,0,show=show,shortcut=shortcut,bitsets=_bitsets)
+    if cache is not None and not show:
+        cache.put(hash_x,hash_y,cache_key,(None,HMI_xy,None,None))
+    return HMI_xy
+
+def _truncation_key(key,max_depth,compress):
+    """Returns the key of an **HMICache** for values truncated at **max_depth**, which depend on whether the trees were compressed."""
+    if max_depth is None:
+        return key
+    return key+':max_depth=%d' % max_depth+(':compress' if compress else '')
+
+def _normalize_hmi(HMI_xy,HMI_xx,HMI_yy,norm):
+    """Returns the tuple (i(T;T'),I(T;T'),I(T;T),I(T';T')) out of the hierarchical mutual informations, for a given norm (see **normalized_hierarchical_mutual_information()**)."""
+    if norm=='CS':
+        _prod=HMI_xx*HMI_yy
+        if _prod>0.0:
+
+#            print '# HMI_xy',HMI_xy
+#            print '# HMI_xx',HMI_xx
+#            print '# HMI_yy',HMI_yy
+#            print '# _prod',_prod
+#            print '# HMI_xy/(_prod**0.5)',repr(HMI_xy/(_prod**0.5))
+
+            return HMI_xy/(_prod**0.5),HMI_xy,HMI_xx,HMI_yy
+        return 0.0,HMI_xy,HMI_xx,HMI_yy
+    elif norm=='add':
+        _suma=HMI_xx+HMI_yy
+        if _suma>0.0:
+
+#            print '# HMI_xy',HMI_xy
+#            print '# HMI_xx',HMI_xx
+#            print '# HMI_yy',HMI_yy
+#            print '# _suma',_suma
+#            print '# 2.0*HMI_xy/_suma',repr(2.0*HMI_xy/_suma)
+
+            return 2.0*HMI_xy/_suma,HMI_xy,HMI_xx,HMI_yy
+        return 0.0,HMI_xy,HMI_xx,HMI_yy
+    elif norm=='max':
+        _max=max(HMI_xx,HMI_yy)
+        if _max>0.0:
+
+#            print '# HMI_xy',HMI_xy
+#            print '# HMI_xx',HMI_xx
+#            print '# HMI_yy',HMI_yy
+#            print '# _max',_max
+#            print '# HMI_xy/_max',repr(HMI_xy/_max)
 
-def normalized_hierarchical_mutual_information(hierpart_x,hierpart_y,show=False,norm='CS'):
+            return HMI_xy/_max,HMI_xy,HMI_xx,HMI_yy
+        return 0.0,HMI_xy,HMI_xx,HMI_yy
+    else:
+        assert False, "ERROR: norm should be one of 'CS','add','max'"
+
+def normalized_hierarchical_mutual_information(hierpart_x,hierpart_y,show=False,norm='CS',restrict=False,compress=False,shortcut=True,cache=None,max_depth=None,profile=False,bitsets=False):
     """Computes the normalized hierarchical mutual information between two partitions.
     More specifically, it computes i(T;T') where T and T' are two <HierarchicalPartitions>.
 
@@ -1299,11 +3791,28 @@ def normalized_hierarchical_mutual_information(hierpart_x,hierpart_y,show=False,
         If True, then it shows useful information during the computation process.
     norm : <str='CS'>
         One of 'CS' (or Cauchy Schwarz), 'add' (or additive), 'max' (or using the max function). The CS is defined as I(T,T')/sqrt(I(T,T)*I(T',T')). The add is defined as 2I(T,T')/(I(T,T)+I(T',T')). Finally, the max is defined as I(T,T')/max(I(T,T),I(T',T')).
+    restrict : <bool=False>
+        If True, both trees are restricted to their common elements once, up front (see **HierarchicalPartition.restrict()**). Notice that then I(T;T) and I(T';T') are also computed over the common elements only.
+    compress : <bool=False>
+        If True, the zero-size nodes and unary tails of both trees are contracted once, up front (see **HierarchicalPartition.compress()**). The returned values do not change.
+    shortcut : <bool=True>
+        If True, identical sub-trees are not explored; their cached hierarchical entropy is used instead (see **sub_hierarchical_mutual_information()**).
+    cache : <HMICache=None>
+        If given, the values are looked up in the cache by the **content_hash()** of both trees and the norm (and **max_depth**, if given), and stored there if they were not found. It is not used when **show** or **profile** are True.
+    max_depth : <int=None>
+        If given, the three hierarchical mutual informations are truncated at this depth (see **hierarchical_mutual_information()**).
+    profile : <bool=False>
+        If True, the contributions of each depth to I(T;T'), I(T;T) and I(T';T') are returned too. Then, the normalized value truncated at any depth follows from their cumulative sums, without recomputing.
+    bitsets : <bool=False>
+        If True, the recursions use bitsets (see **hierarchical_mutual_information()**).
+
+    Comments:
+        The trees may have weighted elements (see **hierarchical_mutual_information()**). Then, I(T;T) and I(T';T') are weighted too, each by the weights of its own tree.
 
     Returns
     -------
     : (<float>,<float>,<float>,<float>)
-        It returns i(T;T'), I(T;T'), I(T;T), I(T';T')
+        It returns i(T;T'), I(T;T'), I(T;T), I(T';T'). If **profile** is True, a fifth item holds the contributions of each depth, as a tuple of three <numpy.ndarray> for I(T;T'), I(T;T) and I(T';T').
 
     Example
     -------
@@ -1378,49 +3887,1022 @@ def normalized_hierarchical_mutual_information(hierpart_x,hierpart_y,show=False,
     (0.81896255088035252, 1.242453324894, 1.242453324894, 1.791759469228055)
     >>> print normalized_hierarchical_mutual_information(hpx,hpy,norm='max')
     (0.6934264036172707, 1.242453324894, 1.242453324894, 1.791759469228055)
+    >>> print '%.6f %.6f %.6f %.6f' % normalized_hierarchical_mutual_information(hpx,hpy,max_depth=1)
+    1.000000 0.693147 0.693147 0.693147
     """
-    HMI_xx=hierarchical_mutual_information(hierpart_x,hierpart_x,show=False)    
-    HMI_yy=hierarchical_mutual_information(hierpart_y,hierpart_y,show=False)    
-    HMI_xy=hierarchical_mutual_information(hierpart_x,hierpart_y,show=show)    
+    assert norm in ('CS','add','max'), "ERROR: norm should be one of 'CS','add','max'"
+    if cache is not None and not show and not profile:
+        hash_x=hierpart_x.content_hash()
+        hash_y=hierpart_y.content_hash()
+        cache_norm=_truncation_key(norm+(':restrict' if restrict else ''),max_depth,compress)
+        values=cache.get(hash_x,hash_y,cache_norm)
+        if values is not None:
+            return values
+    if restrict:
+        hierpart_x,hierpart_y=_restrict_to_common_elements(hierpart_x,hierpart_y)
+    if compress:
+        hierpart_x=hierpart_x.compress()[0]
+        hierpart_y=hierpart_y.compress()[0]
+    if max_depth is not None or profile:
+        HMI_xx,profile_xx=_encoded_hierarchical_mutual_information(hierpart_x,hierpart_x,max_depth)
+        HMI_yy,profile_yy=_encoded_hierarchical_mutual_information(hierpart_y,hierpart_y,max_depth)
+        HMI_xy,profile_xy=_encoded_hierarchical_mutual_information(hierpart_x,hierpart_y,max_depth)
+        values=_normalize_hmi(HMI_xy,HMI_xx,HMI_yy,norm)
+        if profile:
+            return values+((profile_xy,profile_xx,profile_yy),)
+        if cache is not None and not show:
+            cache.put(hash_x,hash_y,cache_norm,values)
+        return values
+    HMI_xx=hierarchical_mutual_information(hierpart_x,hierpart_x,show=False,shortcut=shortcut,bitsets=bitsets)    
+    HMI_yy=hierarchical_mutual_information(hierpart_y,hierpart_y,show=False,shortcut=shortcut,bitsets=bitsets)    
+    HMI_xy=hierarchical_mutual_information(hierpart_x,hierpart_y,show=show,shortcut=shortcut,bitsets=bitsets)    
+
+    values=_normalize_hmi(HMI_xy,HMI_xx,HMI_yy,norm)
+    if cache is not None and not show:
+        cache.put(hash_x,hash_y,cache_norm,values)
+    return values
+
+def nhmi_at_least(hierpart_x,hierpart_y,threshold,norm='CS'):
+    """Decides whether the normalized hierarchical mutual information reaches a threshold, exploring only as much of the trees as needed.
 
-    if norm=='CS':
-        _prod=HMI_xx*HMI_yy
-        if _prod>0.0:
+    Comments:
+        I(T;T) and I(T';T') are computed first (they are cached by each tree), so the question becomes whether I(T;T') reaches threshold times the normalization.
+        The pairs of nodes of the recursion of **sub_hierarchical_mutual_information()** are then explored best-first. A pair (v,v') at depth d contributes n(v,v')/n times Sx+Sy-Sxy, which is non-negative; and the contribution of its whole sub-tree is at most n(v,v')/n times log n(v,v'), or times I(T_v;T_v) if all the elements of v are common to v' (and the same for v'). So, lower and upper bounds of I(T;T') are kept along the traversal, and it stops as soon as the threshold falls outside them. Identical sub-trees (see **HierarchicalPartition.subtree_hash()**) are not explored.
+        Weighted elements are not supported.
 
-#            print '# HMI_xy',HMI_xy
-#            print '# HMI_xx',HMI_xx
-#            print '# HMI_yy',HMI_yy
-#            print '# _prod',_prod
-#            print '# HMI_xy/(_prod**0.5)',repr(HMI_xy/(_prod**0.5))
+    Parameters
+    ----------
+    hierpart_x : HierarchicalPartition
+        The tree T.
+    hierpart_y : HierarchicalPartition
+        The tree T'.
+    threshold : <float>
+        The threshold for i(T;T').
+    norm : <str='CS'>
+        One of 'CS', 'add' or 'max' (see **normalized_hierarchical_mutual_information()**).
 
-            return HMI_xy/(_prod**0.5),HMI_xy,HMI_xx,HMI_yy
-        return 0.0,HMI_xy,HMI_xx,HMI_yy
+    Returns
+    -------
+    : <bool>
+        True if i(T;T') >= threshold.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import nhmi_at_least
+    >>> hpx=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> n1x=hpx.add_child(hpx.root(),['a','b','c'])
+    >>> n2x=hpx.add_child(hpx.root(),['d','e','f'])
+    >>> dummy=hpx.add_child(n1x,['a'])
+    >>> n3x=hpx.add_child(n1x,['b','c'])
+    >>> dummy=hpx.add_child(n3x,['b'])
+    >>> dummy=hpx.add_child(n3x,['c'])
+    >>> hpy=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> n1y=hpy.add_child(hpy.root(),['a','b','c'])
+    >>> n2y=hpy.add_child(hpy.root(),['d','e','f'])
+    >>> dummy=hpy.add_child(n2y,['f'])
+    >>> n3y=hpy.add_child(n2y,['d','e'])
+    >>> dummy=hpy.add_child(n3y,['d'])
+    >>> dummy=hpy.add_child(n3y,['e'])
+    >>> print nhmi_at_least(hpx,hpy,0.5), nhmi_at_least(hpx,hpy,0.6), nhmi_at_least(hpx,hpx,0.95)
+    True False True
+    """
+    assert norm in ('CS','add','max'), "ERROR: norm should be one of 'CS','add','max'"
+    assert hierpart_x.element_weights() is None and hierpart_y.element_weights() is None,'ERROR in nhmi_at_least: weighted elements are not supported.'
+    HMI_xx=hierpart_x.hierarchical_entropy()
+    HMI_yy=hierpart_y.hierarchical_entropy()
+    if norm=='CS':
+        scale=(HMI_xx*HMI_yy)**0.5
     elif norm=='add':
-        _suma=HMI_xx+HMI_yy
-        if _suma>0.0:
+        scale=0.5*(HMI_xx+HMI_yy)
+    else:
+        scale=max(HMI_xx,HMI_yy)
+    if scale<=0.0:
+        return normalized_hierarchical_mutual_information(hierpart_x,hierpart_y,norm=norm)[0]>=threshold
+    target=threshold*scale
+    hashes_x=hierpart_x._subtree_hashes()
+    hashes_y=hierpart_y._subtree_hashes()
+
+    def cap(node_x,node_y,common):
+        """Upper bound of I(T_v;T'_v') over the elements **common**, or None if the pair contributes nothing more."""
+        m=len(common)
+        if m<2 or hierpart_x.node_leaf(node_x) or hierpart_y.node_leaf(node_y):
+            return None
+        bound=numpy.log(m)
+        if m==hierpart_x.node_size(node_x):
+            bound=min(bound,hierpart_x.hierarchical_entropy(node_x))
+        if m==hierpart_y.node_size(node_y):
+            bound=min(bound,hierpart_y.hierarchical_entropy(node_y))
+        return bound
 
-#            print '# HMI_xy',HMI_xy
-#            print '# HMI_xx',HMI_xx
-#            print '# HMI_yy',HMI_yy
-#            print '# _suma',_suma
-#            print '# 2.0*HMI_xy/_suma',repr(2.0*HMI_xy/_suma)
+    root_x=hierpart_x.root()
+    root_y=hierpart_y.root()
+    common=set(hierpart_x.node_elements(root_x))&set(hierpart_y.node_elements(root_y))
+    n=float(len(common))
+    known=0.0   # Exact contributions of the explored pairs.
+    pending=0.0 # Upper bound of the contributions of the pairs left to explore.
+    heap=[]
+    pushed=0 # Breaks the ties of the heap in order of arrival.
+    bound=cap(root_x,root_y,common)
+    if bound is not None:
+        heapq.heappush(heap,(-bound,pushed,bound,root_x,root_y,common))
+        pending+=bound
+    while heap:
+        if known>=target:
+            return True
+        if known+pending<target*(1.0-1e-12):
+            return False
+        priority,_,bound,node_x,node_y,common=heapq.heappop(heap)
+        weight=len(common)/n
+        pending-=weight*bound
+        if len(common)==hierpart_x.node_size(node_x)==hierpart_y.node_size(node_y) and hashes_x[node_x]==hashes_y[node_y]:
+            known+=weight*hierpart_x.hierarchical_entropy(node_x)
+            continue
+        denxy=float(len(common))
+        Sx=0.0
+        for child_x in hierpart_x.node_children(node_x):
+            Sx-=_plogp(len(common.intersection(hierpart_x.node_elements(child_x)))/denxy)
+        Sy=0.0
+        children_y=[]
+        for child_y in hierpart_y.node_children(node_y):
+            common_y=common.intersection(hierpart_y.node_elements(child_y))
+            Sy-=_plogp(len(common_y)/denxy)
+            children_y.append((child_y,common_y))
+        Sxy=0.0
+        for child_x in hierpart_x.node_children(node_x):
+            elements_x=hierpart_x.node_elements(child_x)
+            for child_y,common_y in children_y:
+                common_xy=common_y.intersection(elements_x)
+                Sxy-=_plogp(len(common_xy)/denxy)
+                child_bound=cap(child_x,child_y,common_xy)
+                if child_bound is not None:
+                    child_weight=len(common_xy)/n
+                    pushed+=1
+                    heapq.heappush(heap,(-child_weight*child_bound,pushed,child_bound,child_x,child_y,common_xy))
+                    pending+=child_weight*child_bound
+        known+=weight*(Sx+Sy-Sxy)
+    return known>=target
+
+# Hierarchical mutual information over encoded labels
+######################################################
+
+def _xlogx_of_groups(keys,weights,replicate_of_key,num_replicates,coefficients=None):
+    """Groups equal **keys**, and returns, for each replicate, the sum of n*log(n) over its groups, where n is the (weighted) number of items in a group.
+
+    If the boolean **coefficients** are given, the sum is that of a*log(n) instead, where a is the (weighted) number of items of the group with a True coefficient.
+    """
+    if len(keys)==0:
+        return numpy.zeros(num_replicates,dtype=numpy.double)
+    if coefficients is not None:
+        _coefficients=coefficients.astype(numpy.double) if weights is None else weights*coefficients
+    kmax=int(keys.max())
+    if kmax<4*len(keys)+1024:
+        counts=numpy.bincount(keys,weights=weights)
+        groups=numpy.flatnonzero(counts)
+        counts=counts[groups]
+        factors=None if coefficients is None else numpy.bincount(keys,weights=_coefficients)[groups]
+    else:
+        groups,inverse=numpy.unique(keys,return_inverse=True)
+        counts=numpy.bincount(inverse,weights=weights)
+        factors=None if coefficients is None else numpy.bincount(inverse,weights=_coefficients)
+    counts=counts.astype(numpy.double)
+    if factors is None:
+        factors=counts
+    positive=counts>0.0
+    xlogx=numpy.zeros(len(counts),dtype=numpy.double)
+    xlogx[positive]=factors[positive]*numpy.log(counts[positive])
+    return numpy.bincount(replicate_of_key(groups),weights=xlogx,minlength=num_replicates)
+
+def _label_hmi(Lx,Ly,nonleaf_x,nonleaf_y,weights=None,replicate=None,num_replicates=1,max_depth=None,profile=False):
+    """Computes I(T;T') out of the label matrices of both trees (see **HierarchicalPartition._label_matrix()**), with rows aligned over the common elements.
 
-            return 2.0*HMI_xy/_suma,HMI_xy,HMI_xx,HMI_yy
-        return 0.0,HMI_xy,HMI_xx,HMI_yy
-    elif norm=='max':
-        _max=max(HMI_xx,HMI_yy)
-        if _max>0.0:
+    Comments:
+        Expanding the recursion of **sub_hierarchical_mutual_information()**, the fraction multiplying a pair of nodes (u,u') at depth d is n(u,u')/n, then
+            n I(T;T') = sum_d sum_{(u,u') non-leaves} [ n(u,u')log n(u,u') - sum_c n(c,u')log n(c,u') - sum_c' n(u,c')log n(u,c') + sum_{c,c'} n(c,c')log n(c,c') ]
+        where c and c' run over the children of u and u'. So, each depth takes four (weighted) group counts over the encoded labels.
+        The elements of a non-leaf node that are in none of its children keep its label one level down (see **_label_matrix()**). As in the recursion, they are left out of the counts of the children, and of the deeper levels, and the first term becomes a(u,u')log n(u,u'), where a(u,u') counts the elements of the pair in a child of u or in a child of u'.
+        The children of a node are assumed to be disjoint. The result agrees with the recursion up to floating point rounding.
+        Several replicates (eg., permutations or resamplings) can be computed in the same pass, by stacking their rows and telling the replicate of each row.
+        If **max_depth** is given, the nodes at that depth (relative to the first column) are taken as leaves, ie., only the depths above it contribute. If **profile** is True, the contribution of each depth is returned too.
 
-#            print '# HMI_xy',HMI_xy
-#            print '# HMI_xx',HMI_xx
-#            print '# HMI_yy',HMI_yy
-#            print '# _max',_max
-#            print '# HMI_xy/_max',repr(HMI_xy/_max)
+    Returns
+    -------
+    : <float> or <numpy.ndarray>
+        I(T;T'), or an array with its value for each replicate if **replicate** is given. If **profile** is True, it returns a pair with the value and the contributions of each depth (with shape (depths,), or (num_replicates,depths) if **replicate** is given).
+    """
+    n_x=len(nonleaf_x)
+    n_y=len(nonleaf_y)
+    stride=n_x*n_y
+    if replicate is None:
+        _replicate=numpy.zeros(Lx.shape[0],dtype=numpy.int64)
+    else:
+        _replicate=numpy.asarray(replicate,dtype=numpy.int64)
+    total=numpy.bincount(_replicate,weights=weights,minlength=num_replicates).astype(numpy.double)
+    replicate_of_key=lambda keys: keys//stride
+    HMI=numpy.zeros(num_replicates,dtype=numpy.double)
+    num_depths=min(Lx.shape[1],Ly.shape[1])-1
+    if max_depth is not None:
+        num_depths=max(0,min(num_depths,max_depth))
+    levels=numpy.zeros((num_depths,num_replicates),dtype=numpy.double)
+    # The rows that the recursion still reaches; None while it reaches all of them.
+    alive=None
+    for d in xrange(num_depths):
+        mask=nonleaf_x[Lx[:,d]]&nonleaf_y[Ly[:,d]]
+        if alive is not None:
+            mask&=alive
+        if not mask.any():
+            break
+        offset=_replicate[mask]*stride
+        _weights=None if weights is None else weights[mask]
+        x0=Lx[mask,d].astype(numpy.int64)*n_y
+        x1=Lx[mask,d+1].astype(numpy.int64)*n_y
+        y0=Ly[mask,d].astype(numpy.int64)
+        y1=Ly[mask,d+1].astype(numpy.int64)
+        covered_x=x1!=x0
+        covered_y=y1!=y0
+        covered=covered_x&covered_y
+        level=levels[d]
+        if covered.all():
+            level+=_xlogx_of_groups(offset+x0+y0,_weights,replicate_of_key,num_replicates)
+            level-=_xlogx_of_groups(offset+x1+y0,_weights,replicate_of_key,num_replicates)
+            level-=_xlogx_of_groups(offset+x0+y1,_weights,replicate_of_key,num_replicates)
+            level+=_xlogx_of_groups(offset+x1+y1,_weights,replicate_of_key,num_replicates)
+        else:
+            level+=_xlogx_of_groups(offset+x0+y0,_weights,replicate_of_key,num_replicates,coefficients=covered_x|covered_y)
+            for keys,rows in ((x1+y0,covered_x),(x0+y1,covered_y),(x1+y1,covered)):
+                sign=1.0 if rows is covered else -1.0
+                level+=sign*_xlogx_of_groups((offset+keys)[rows],None if _weights is None else _weights[rows],replicate_of_key,num_replicates)
+            if alive is None:
+                alive=numpy.ones(Lx.shape[0],dtype=bool)
+            alive[numpy.flatnonzero(mask)[~covered]]=False
+        HMI+=level
+    positive=total>0.0
+    HMI[positive]/=total[positive]
+    HMI[~positive]=0.0
+    if profile:
+        levels[:,positive]/=total[positive]
+        levels[:,~positive]=0.0
+    if replicate is None:
+        if profile:
+            return float(HMI[0]),levels[:,0]
+        return float(HMI[0])
+    if profile:
+        return HMI,levels.T
+    return HMI
+
+def compare_hierarchy_files(reference,filenames,norm='CS',n_threads=4,max_in_flight=8,loader=None):
+    """Compares a reference tree against trees stored in files, yielding the results as the files are loaded.
 
-            return HMI_xy/_max,HMI_xy,HMI_xx,HMI_yy
-        return 0.0,HMI_xy,HMI_xx,HMI_yy
+    Comments:
+        The files are loaded lazily, by a pool of threads, while the comparisons run in the calling thread through a **PreparedHierarchy**.
+        At most **max_in_flight** trees are loaded (or being loaded) and waiting to be compared at any time, so the memory stays bounded however many files there are.
+        The results are yielded in the order of **filenames**.
+
+    Parameters
+    ----------
+    reference : HierarchicalPartition or PreparedHierarchy
+        The reference tree T.
+    filenames : <iterable>
+        The filenames (and paths) of the trees T' to compare.
+    norm : <str='CS'>
+        One of 'CS', 'add' or 'max' (see **normalized_hierarchical_mutual_information()**). It is ignored if **reference** is a **PreparedHierarchy**.
+    n_threads : <int=4>
+        The number of threads loading files.
+    max_in_flight : <int=8>
+        The maximum number of loaded trees waiting to be compared.
+    loader : <function=None>
+        The function loading a tree from a filename. By default, **load_hierarchical_partition()**.
+
+    Returns
+    -------
+    : <generator>
+        It yields tuples (filename, i(T;T'), I(T;T'), I(T';T')).
+
+    Example
+    -------
+    >>> import os, shutil, tempfile
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import save_hierarchical_partition, compare_hierarchy_files
+    >>> hpx=HierarchicalPartition(['a','b','c','d'])
+    >>> dummy=hpx.add_child(hpx.root(),['a','b'])
+    >>> dummy=hpx.add_child(hpx.root(),['c','d'])
+    >>> hpy=HierarchicalPartition(['a','b','c','d'])
+    >>> dummy=hpy.add_child(hpy.root(),['a','b','c'])
+    >>> dummy=hpy.add_child(hpy.root(),['d'])
+    >>> tmpdir=tempfile.mkdtemp()
+    >>> save_hierarchical_partition(hpx,fileout=os.path.join(tmpdir,'x.txt'))
+    >>> save_hierarchical_partition(hpy,fileout=os.path.join(tmpdir,'y.txt'))
+    >>> filenames=[os.path.join(tmpdir,name) for name in ['x.txt','y.txt']]
+    >>> for filename,NHMI,HMI_xy,HMI_yy in compare_hierarchy_files(hpx,filenames,max_in_flight=1):
+    ...     print os.path.basename(filename), '%.6f %.6f %.6f' % (NHMI,HMI_xy,HMI_yy)
+    ...
+    x.txt 1.000000 0.693147 0.693147
+    y.txt 0.345592 0.215762 0.562335
+    >>> shutil.rmtree(tmpdir)
+    """
+    assert max_in_flight>0,'ERROR in compare_hierarchy_files: max_in_flight should be positive.'
+    if isinstance(reference,PreparedHierarchy):
+        prepared=reference
     else:
-        assert False, "ERROR: norm should be one of 'CS','add','max'"
+        prepared=PreparedHierarchy(reference,norm=norm)
+    if loader is None:
+        loader=load_hierarchical_partition
+    pool=ThreadPool(n_threads)
+    in_flight=deque()
+
+    def _compare(filename,result):
+        candidate=result.get()
+        NHMI,HMI_xy,HMI_xx,HMI_yy=prepared.compare(candidate)
+        return filename,NHMI,HMI_xy,HMI_yy
+
+    try:
+        for filename in filenames:
+            if len(in_flight)>=max_in_flight:
+                yield _compare(*in_flight.popleft())
+            in_flight.append((filename,pool.apply_async(loader,(filename,))))
+        while len(in_flight)>0:
+            yield _compare(*in_flight.popleft())
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _external_xlogx_sum(chunks,num_buckets,workdir,name):
+    """Returns the sum of a*log(n) over the groups of equal keys, where the (key,n,a) triples come in **chunks** (each one with unique keys) too many to hold in memory together. For the sum of n*log(n), a is n.
+
+    The pairs are spilled to **num_buckets** files by key modulo num_buckets, and each bucket is then aggregated on its own. So, the memory is bounded by the size of a chunk plus that of a bucket.
+    """
+    if num_buckets==1:
+        keys=[]
+        counts=[]
+        factors=[]
+        for _keys,_counts,_factors in chunks:
+            keys.append(_keys)
+            counts.append(_counts)
+            factors.append(_factors)
+        buckets=[(keys,counts,factors)]
+    else:
+        filenames=[os.path.join(workdir,'%s_%d.bin' % (name,b)) for b in xrange(num_buckets)]
+        for _keys,_counts,_factors in chunks:
+            bucket=_keys%num_buckets
+            order=numpy.argsort(bucket,kind='mergesort')
+            bounds=numpy.searchsorted(bucket[order],numpy.arange(num_buckets+1))
+            for b in numpy.flatnonzero(numpy.diff(bounds)).tolist():
+                rows=order[bounds[b]:bounds[b+1]]
+                with open(filenames[b],'ab') as fhw:
+                    numpy.vstack((_keys[rows],_counts[rows],_factors[rows])).T.astype(numpy.int64).tofile(fhw)
+        buckets=(filenames[b] for b in xrange(num_buckets))
+    total=0.0
+    for bucket in buckets:
+        if num_buckets==1:
+            keys,counts,factors=bucket
+            if len(keys)==0:
+                continue
+            keys=numpy.concatenate(keys)
+            counts=numpy.concatenate(counts)
+            factors=numpy.concatenate(factors)
+        else:
+            if not os.path.exists(bucket):
+                continue
+            triples=numpy.fromfile(bucket,dtype=numpy.int64).reshape(-1,3)
+            os.remove(bucket)
+            keys=triples[:,0]
+            counts=triples[:,1]
+            factors=triples[:,2]
+        groups,inverse=numpy.unique(keys,return_inverse=True)
+        n=numpy.bincount(inverse,weights=counts)
+        a=numpy.bincount(inverse,weights=factors)
+        positive=n>0
+        total+=float((a[positive]*numpy.log(n[positive])).sum())
+    return total
+
+def out_of_core_hierarchical_mutual_information(filein_x,filein_y,chunk_size=2**22,num_buckets=None,tmpdir=None):
+    """Computes I(T;T') between two trees stored as level labels (see **save_hierarchical_partition_labels()**), with bounded memory.
+
+    Comments:
+        The label files are memory-mapped, and read one level and one chunk of rows at a time. For each depth, the identity of **_label_hmi()** needs four sums of n*log(n) over groups of rows with equal pairs of labels. Each chunk is grouped in memory, and the partial counts are merged externally, through hash buckets on disk (see **_external_xlogx_sum()**).
+        With labels padded below the leaves, a pair of nodes where any of them is a leaf contributes nothing, so the rows where a label does not change from one level to the next are skipped; no other information about the trees is needed. The elements of a non-leaf node that are in none of its children are labeled -2 below it (see **save_hierarchical_partition_labels()**); as in the recursion, they count in the pair of nodes above, but not in the children nor deeper (see **_label_hmi()**).
+        The pairs of labels are encoded in 64 bits, so the labels should be below 2^32.
+        The memory used is of the order of **chunk_size** rows, plus the largest bucket. I(T;T) is obtained by passing the same file twice.
+
+    Parameters
+    ----------
+    filein_x : <str>
+        The .npy file with the labels of T.
+    filein_y : <str>
+        The .npy file with the labels of T', with its rows in the same order of elements.
+    chunk_size : <int=2**22>
+        The number of rows read at once.
+    num_buckets : <int=None>
+        The number of buckets of the external merge. By default, the number of chunks, ie., one bucket holds as many groups as a chunk at most.
+    tmpdir : <str=None>
+        The directory for the buckets. By default, the system temporary directory.
+
+    Returns
+    -------
+    : <float>
+        The value I(T;T').
+
+    Example
+    -------
+    >>> import os, shutil, tempfile
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import save_hierarchical_partition_labels, out_of_core_hierarchical_mutual_information
+    >>> from hierpart import hierarchical_mutual_information
+    >>> hpx=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> n1x=hpx.add_child(hpx.root(),['a','b','c'])
+    >>> n2x=hpx.add_child(hpx.root(),['d','e','f'])
+    >>> dummy=hpx.add_child(n1x,['a'])
+    >>> n3x=hpx.add_child(n1x,['b','c'])
+    >>> dummy=hpx.add_child(n3x,['b'])
+    >>> dummy=hpx.add_child(n3x,['c'])
+    >>> hpy=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> n1y=hpy.add_child(hpy.root(),['a','b','c'])
+    >>> n2y=hpy.add_child(hpy.root(),['d','e','f'])
+    >>> dummy=hpy.add_child(n2y,['f'])
+    >>> n3y=hpy.add_child(n2y,['d','e'])
+    >>> dummy=hpy.add_child(n3y,['d'])
+    >>> dummy=hpy.add_child(n3y,['e'])
+    >>> tmpdir=tempfile.mkdtemp()
+    >>> save_hierarchical_partition_labels(hpx,os.path.join(tmpdir,'x.npy'))
+    >>> save_hierarchical_partition_labels(hpy,os.path.join(tmpdir,'y.npy'),elements=hpx.all_elements())
+    >>> print '%.6f' % out_of_core_hierarchical_mutual_information(os.path.join(tmpdir,'x.npy'),os.path.join(tmpdir,'y.npy'),chunk_size=4)
+    0.693147
+    >>> print '%.6f' % out_of_core_hierarchical_mutual_information(os.path.join(tmpdir,'x.npy'),os.path.join(tmpdir,'x.npy'),chunk_size=4)
+    1.242453
+    >>> # A non-leaf node may have elements in none of its children; they count as in the recursion.
+    >>> hpx=HierarchicalPartition(range(8))
+    >>> n1x=hpx.add_child(hpx.root(),range(4))
+    >>> dummy=hpx.add_child(n1x,[0,1])
+    >>> hpy=HierarchicalPartition(range(8))
+    >>> dummy=hpy.add_child(hpy.root(),[0,1,4,5])
+    >>> dummy=hpy.add_child(hpy.root(),[2,3,6,7])
+    >>> save_hierarchical_partition_labels(hpx,os.path.join(tmpdir,'x.npy'))
+    >>> save_hierarchical_partition_labels(hpy,os.path.join(tmpdir,'y.npy'))
+    >>> print '%.6f %.6f' % (out_of_core_hierarchical_mutual_information(os.path.join(tmpdir,'x.npy'),os.path.join(tmpdir,'y.npy')), hierarchical_mutual_information(hpx,hpy))
+    0.346574 0.346574
+    >>> shutil.rmtree(tmpdir)
+    """
+    Lx=numpy.load(filein_x,mmap_mode='r')
+    Ly=numpy.load(filein_y,mmap_mode='r')
+    assert Lx.ndim==2 and Ly.ndim==2 and Lx.shape[1]==Ly.shape[1],'ERROR in out_of_core_hierarchical_mutual_information: the label files should have the same number of rows.'
+    N=Lx.shape[1]
+    num_depths=min(Lx.shape[0],Ly.shape[0])-1
+    num_chunks=max(1,(N+chunk_size-1)//chunk_size)
+    if num_buckets is None:
+        num_buckets=num_chunks
+    n=0
+    for start in xrange(0,N,chunk_size):
+        n+=int(((Lx[0,start:start+chunk_size]>=0)&(Ly[0,start:start+chunk_size]>=0)).sum())
+    if n==0 or num_depths<1:
+        return 0.0
+    # The four groupings of the identity, as (level of x, level of y, sign) relative to depth d.
+    groupings=((0,0,1.0),(1,0,-1.0),(0,1,-1.0),(1,1,1.0))
+    workdir=tempfile.mkdtemp(dir=tmpdir)
+    try:
+        total=0.0
+        for d in xrange(num_depths):
+            for dx,dy,sign in groupings:
+
+                def chunks():
+                    for start in xrange(0,N,chunk_size):
+                        x0=numpy.asarray(Lx[d,start:start+chunk_size],dtype=numpy.int64)
+                        x1=numpy.asarray(Lx[d+1,start:start+chunk_size],dtype=numpy.int64)
+                        y0=numpy.asarray(Ly[d,start:start+chunk_size],dtype=numpy.int64)
+                        y1=numpy.asarray(Ly[d+1,start:start+chunk_size],dtype=numpy.int64)
+                        mask=(x0>=0)&(y0>=0)&(x1!=x0)&(y1!=y0)
+                        if dx:
+                            mask&=x1>=0
+                        if dy:
+                            mask&=y1>=0
+                        if not mask.any():
+                            continue
+                        a=(x1 if dx else x0)[mask]
+                        b=(y1 if dy else y0)[mask]
+                        assert a.max()<2**32 and b.max()<2**32,'ERROR in out_of_core_hierarchical_mutual_information: the labels should be below 2**32.'
+                        groups,inverse=numpy.unique((a<<32)|b,return_inverse=True)
+                        counts=numpy.bincount(inverse)
+                        if dx or dy:
+                            yield groups,counts,counts
+                        else:
+                            # Only the rows in a child of either node count in the first term.
+                            covered=((x1>=0)|(y1>=0))[mask]
+                            yield groups,counts,numpy.bincount(inverse[covered],minlength=len(groups))
+
+                total+=sign*_external_xlogx_sum(chunks(),num_buckets,workdir,'%d_%d_%d' % (d,dx,dy))
+    finally:
+        shutil.rmtree(workdir,ignore_errors=True)
+    return total/n
+
+# Null models
+#############
+
+def _replicate_batches(worker,initializer,initargs,state,num_replicates,num_rows,n_jobs,seed,batch_size=None):
+    """Computes **num_replicates** replicates in batches, each one a task (seed,size) of **worker**, and returns their concatenated values.
+
+    The batches are seeded from **seed** independently of **n_jobs**, so the results are reproducible. By default, a batch stacks up to about 2^20 rows of **num_rows** each. The workers are set up by **initializer(*initargs)**, which fills the module-level dict **state**; with **n_jobs** processes, the pool is forked, so the arrays in **initargs** are shared copy-on-write.
+    """
+    if batch_size is None:
+        batch_size=max(1,min(64,2**20//max(num_rows,1)))
+    tasks=[]
+    seeds=numpy.random.RandomState(seed).randint(0,2**31-1,size=(num_replicates+batch_size-1)//batch_size)
+    for k,_seed in enumerate(seeds.tolist()):
+        tasks.append((_seed,min(batch_size,num_replicates-k*batch_size)))
+    if n_jobs==1:
+        initializer(*initargs)
+        try:
+            batches=[worker(task) for task in tasks]
+        finally:
+            state.clear()
+    else:
+        pool=multiprocessing.Pool(n_jobs,initializer=initializer,initargs=initargs)
+        try:
+            batches=pool.map(worker,tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return numpy.concatenate(batches)
+
+_NULL_MODEL={}
+
+def _init_null_worker(arrays):
+    _NULL_MODEL['arguments']=(arrays['Lx'],arrays['Ly'],arrays['nonleaf_x'],arrays['nonleaf_y'])
+
+def _null_worker(task):
+    """Computes I(T;T') for a batch of random permutations of the elements of T', drawn from the given seed."""
+    seed,num_replicates=task
+    Lx,Ly,nonleaf_x,nonleaf_y=_NULL_MODEL['arguments']
+    n=Lx.shape[0]
+    rng=numpy.random.RandomState(seed)
+    permutations=numpy.concatenate([rng.permutation(n) for r in xrange(num_replicates)])
+    replicate=numpy.repeat(numpy.arange(num_replicates),n)
+    return _label_hmi(numpy.tile(Lx,(num_replicates,1)),Ly[permutations],nonleaf_x,nonleaf_y,replicate=replicate,num_replicates=num_replicates)
+
+def _permutation_null_hmi(hierpart_x,hierpart_y,n_perm,n_jobs,seed,batch_size=None):
+    """Returns the observed I(T;T'), and its values under **n_perm** random permutations of the common elements of T'.
+
+    The permutations act directly on the rows of the label matrices, and are computed in batches, stacked as replicates of a single call to **_label_hmi()** (see **_replicate_batches()**).
+    """
+    ids_x,ids_y=_aligned_element_ids(hierpart_x,hierpart_y)
+    Lx=hierpart_x._label_matrix()[ids_x]
+    Ly=hierpart_y._label_matrix()[ids_y]
+    nonleaf_x=hierpart_x._nonleaf_mask()
+    nonleaf_y=hierpart_y._nonleaf_mask()
+    HMI_xy=_label_hmi(Lx,Ly,nonleaf_x,nonleaf_y)
+    arrays=dict(Lx=Lx,Ly=Ly,nonleaf_x=nonleaf_x,nonleaf_y=nonleaf_y)
+    return HMI_xy,_replicate_batches(_null_worker,_init_null_worker,(arrays,),_NULL_MODEL,n_perm,len(ids_x),n_jobs,seed,batch_size)
+
+def adjusted_nhmi(hierpart_x,hierpart_y,n_perm=1000,n_jobs=1,seed=None,norm='CS'):
+    """Computes the normalized hierarchical mutual information adjusted for chance, under a permutation null model.
+
+    Comments:
+        The null model randomly permutes the (common) elements of T', keeping the shape of both trees. Then, the adjusted value is (i-E[i])/(1-E[i]), where E[i] is the average of i(T;T') over the null model. It is 0 on average for unrelated trees, and 1 for identical ones.
+        The permutations act directly on the encoded labels of the elements, and the hierarchical mutual informations are computed as in **PreparedHierarchy**, in vectorized batches that can be spread over several processes.
+
+    Parameters
+    ----------
+    hierpart_x : HierarchicalPartition
+        The tree T.
+    hierpart_y : HierarchicalPartition
+        The tree T'.
+    n_perm : <int=1000>
+        The number of random permutations.
+    n_jobs : <int=1>
+        The number of processes.
+    seed : <int=None>
+        The seed of the random permutations. The results do not depend on **n_jobs**.
+    norm : <str='CS'>
+        One of 'CS', 'add' or 'max' (see **normalized_hierarchical_mutual_information()**).
+
+    Returns
+    -------
+    : (<float>,<float>,<float>,<float>)
+        It returns the adjusted i(T;T'), i(T;T'), and the average and standard deviation of i(T;T') over the null model.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import adjusted_nhmi
+    >>> hpx=HierarchicalPartition(range(12))
+    >>> n1=hpx.add_child(hpx.root(),range(6))
+    >>> n2=hpx.add_child(hpx.root(),range(6,12))
+    >>> dummy=hpx.add_child(n1,range(3))
+    >>> dummy=hpx.add_child(n1,range(3,6))
+    >>> adjusted,NHMI,mean,std=adjusted_nhmi(hpx,hpx,n_perm=200,seed=1)
+    >>> print '%.6f %.6f' % (adjusted,NHMI), mean<0.5
+    1.000000 1.000000 True
+    >>> print adjusted_nhmi(hpx,hpx,n_perm=200,seed=1,n_jobs=2)==adjusted_nhmi(hpx,hpx,n_perm=200,seed=1)
+    True
+    """
+    assert norm in ('CS','add','max'), "ERROR: norm should be one of 'CS','add','max'"
+    assert n_perm>0,'ERROR in adjusted_nhmi: n_perm should be positive.'
+    HMI_xx=hierpart_x.hierarchical_entropy()
+    HMI_yy=hierpart_y.hierarchical_entropy()
+    HMI_xy,null=_permutation_null_hmi(hierpart_x,hierpart_y,n_perm,n_jobs,seed)
+    NHMI=_normalize_hmi(HMI_xy,HMI_xx,HMI_yy,norm)[0]
+    null=numpy.array([_normalize_hmi(v,HMI_xx,HMI_yy,norm)[0] for v in null.tolist()])
+    mean=null.mean()
+    if mean<1.0:
+        adjusted=(NHMI-mean)/(1.0-mean)
+    else:
+        adjusted=0.0
+    return adjusted,NHMI,mean,null.std()
+
+def hmi_pvalue(hierpart_x,hierpart_y,n_perm=1000,n_jobs=1,seed=None):
+    """Computes the p-value of the hierarchical mutual information I(T;T'), under a permutation null model.
+
+    Comments:
+        The null model randomly permutes the (common) elements of T', keeping the shape of both trees (see **adjusted_nhmi()**). The p-value is (1+k)/(1+n_perm), where k is the number of permutations with I(T;T') at least as large as the observed one.
+
+    Parameters
+    ----------
+    hierpart_x : HierarchicalPartition
+        The tree T.
+    hierpart_y : HierarchicalPartition
+        The tree T'.
+    n_perm : <int=1000>
+        The number of random permutations.
+    n_jobs : <int=1>
+        The number of processes.
+    seed : <int=None>
+        The seed of the random permutations. The results do not depend on **n_jobs**.
+
+    Returns
+    -------
+    : <float>
+        The p-value.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import hmi_pvalue
+    >>> hpx=HierarchicalPartition(range(12))
+    >>> n1=hpx.add_child(hpx.root(),range(6))
+    >>> n2=hpx.add_child(hpx.root(),range(6,12))
+    >>> print hmi_pvalue(hpx,hpx,n_perm=99,seed=1)
+    0.01
+    """
+    assert n_perm>0,'ERROR in hmi_pvalue: n_perm should be positive.'
+    HMI_xy,null=_permutation_null_hmi(hierpart_x,hierpart_y,n_perm,n_jobs,seed)
+    k=int((null>=HMI_xy-1e-12*abs(HMI_xy)).sum())
+    return (1.0+k)/(1.0+n_perm)
+
+# Bootstrap
+###########
+
+_BOOTSTRAP={}
+
+def _init_bootstrap_worker(arrays,norm):
+    _BOOTSTRAP['arguments']=(arrays['Lx'],arrays['Ly'],arrays['nonleaf_x'],arrays['nonleaf_y'],norm,arrays.get('weights'),arrays.get('strata'))
+
+def _bootstrap_worker(task):
+    """Computes i(T;T') for a batch of resamplings of the elements, drawn from the given seed. Each resampling is a vector of integer weights over the elements, and only the elements with non-zero weight are stacked.
+    If strata are given, as the offsets of consecutive blocks of rows, each block is resampled on its own."""
+    seed,num_replicates=task
+    Lx,Ly,nonleaf_x,nonleaf_y,norm,element_weights,strata=_BOOTSTRAP['arguments']
+    n=Lx.shape[0]
+    rng=numpy.random.RandomState(seed)
+    if strata is not None:
+        strata_sizes=numpy.diff(strata)
+        row_start=numpy.repeat(strata[:-1],strata_sizes)
+        row_size=numpy.repeat(strata_sizes,strata_sizes)
+    rows=[]
+    weights=[]
+    replicate=[]
+    for r in xrange(num_replicates):
+        if strata is None:
+            draws=rng.randint(0,n,size=n)
+        else:
+            draws=row_start+(rng.random_sample(n)*row_size).astype(numpy.int64)
+        counts=numpy.bincount(draws,minlength=n)
+        sampled=numpy.flatnonzero(counts)
+        rows.append(sampled)
+        if element_weights is None:
+            weights.append(counts[sampled].astype(numpy.double))
+        else:
+            weights.append(counts[sampled]*element_weights[sampled])
+        replicate.append(numpy.zeros(len(sampled),dtype=numpy.int64)+r)
+    rows=numpy.concatenate(rows)
+    weights=numpy.concatenate(weights)
+    replicate=numpy.concatenate(replicate)
+    Lx=Lx[rows]
+    Ly=Ly[rows]
+    HMI_xy=_label_hmi(Lx,Ly,nonleaf_x,nonleaf_y,weights=weights,replicate=replicate,num_replicates=num_replicates)
+    HMI_xx=_label_hmi(Lx,Lx,nonleaf_x,nonleaf_x,weights=weights,replicate=replicate,num_replicates=num_replicates)
+    HMI_yy=_label_hmi(Ly,Ly,nonleaf_y,nonleaf_y,weights=weights,replicate=replicate,num_replicates=num_replicates)
+    return numpy.array([_normalize_hmi(HMI_xy[r],HMI_xx[r],HMI_yy[r],norm)[0] for r in xrange(num_replicates)])
+
+def bootstrap_nhmi(hierpart_x,hierpart_y,n_boot=1000,n_jobs=1,seed=None,alpha=0.05,norm='CS'):
+    """Computes a bootstrap confidence interval for the normalized hierarchical mutual information.
+
+    Comments:
+        Each bootstrap replicate resamples the common elements of both trees with replacement. The resampling is not materialized as new trees: it is a vector of integer weights over the encoded elements, which the vectorized hierarchical mutual information consumes directly (see **_label_hmi()**).
+        The replicates are computed in batches that can be spread over several processes, seeded from **seed** independently of **n_jobs**.
+        All values, including I(T;T) and I(T';T'), are computed over the common elements only. Weighted elements (see **HierarchicalPartition**) keep their weights, multiplied by the number of times they are drawn.
+
+    Parameters
+    ----------
+    hierpart_x : HierarchicalPartition
+        The tree T.
+    hierpart_y : HierarchicalPartition
+        The tree T'.
+    n_boot : <int=1000>
+        The number of bootstrap replicates.
+    n_jobs : <int=1>
+        The number of processes.
+    seed : <int=None>
+        The seed of the resamplings. The results do not depend on **n_jobs**.
+    alpha : <float=0.05>
+        The confidence interval covers 1-alpha of the bootstrap distribution, between its alpha/2 and 1-alpha/2 percentiles.
+    norm : <str='CS'>
+        One of 'CS', 'add' or 'max' (see **normalized_hierarchical_mutual_information()**).
+
+    Returns
+    -------
+    : (<float>,<float>,<float>)
+        It returns i(T;T'), and the lower and upper ends of its confidence interval.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import bootstrap_nhmi
+    >>> hpx=HierarchicalPartition(range(12))
+    >>> n1=hpx.add_child(hpx.root(),range(6))
+    >>> n2=hpx.add_child(hpx.root(),range(6,12))
+    >>> hpy=HierarchicalPartition(range(12))
+    >>> n1=hpy.add_child(hpy.root(),range(5))
+    >>> n2=hpy.add_child(hpy.root(),range(5,12))
+    >>> NHMI,low,high=bootstrap_nhmi(hpx,hpy,n_boot=200,seed=1)
+    >>> print '%.6f' % NHMI, low<=NHMI<=high<=1.0
+    0.661550 True
+    >>> print bootstrap_nhmi(hpx,hpy,n_boot=200,seed=1,n_jobs=2)==(NHMI,low,high)
+    True
+    """
+    assert norm in ('CS','add','max'), "ERROR: norm should be one of 'CS','add','max'"
+    assert 0.0<alpha<1.0, 'ERROR in bootstrap_nhmi: alpha should be in (0,1).'
+    assert n_boot>0, 'ERROR in bootstrap_nhmi: n_boot should be positive.'
+    ids_x,ids_y=_aligned_element_ids(hierpart_x,hierpart_y)
+    Lx=hierpart_x._label_matrix()[ids_x]
+    Ly=hierpart_y._label_matrix()[ids_y]
+    nonleaf_x=hierpart_x._nonleaf_mask()
+    nonleaf_y=hierpart_y._nonleaf_mask()
+    w=_common_weights(hierpart_x,hierpart_y,ids_x,ids_y)
+    NHMI=_normalize_hmi(_label_hmi(Lx,Ly,nonleaf_x,nonleaf_y,weights=w),_label_hmi(Lx,Lx,nonleaf_x,nonleaf_x,weights=w),_label_hmi(Ly,Ly,nonleaf_y,nonleaf_y,weights=w),norm)[0]
+    replicates=_bootstrap_replicates(Lx,Ly,nonleaf_x,nonleaf_y,norm,w,n_boot,n_jobs,seed)
+    low,high=numpy.percentile(replicates,[100.0*alpha/2.0,100.0*(1.0-alpha/2.0)])
+    return NHMI,float(low),float(high)
+
+def _bootstrap_replicates(Lx,Ly,nonleaf_x,nonleaf_y,norm,weights,n_boot,n_jobs,seed,strata=None):
+    """Returns the values of i(T;T') over **n_boot** resamplings of the rows of the label matrices, computed in batches seeded from **seed** independently of **n_jobs** (see **_bootstrap_worker()** and **_replicate_batches()**)."""
+    arrays=dict(Lx=Lx,Ly=Ly,nonleaf_x=nonleaf_x,nonleaf_y=nonleaf_y,weights=weights,strata=strata)
+    return _replicate_batches(_bootstrap_worker,_init_bootstrap_worker,(arrays,norm),_BOOTSTRAP,n_boot,Lx.shape[0],n_jobs,seed)
+
+# Approximate hierarchical mutual information
+##############################################
+
+def approximate_nhmi(hierpart_x,hierpart_y,tolerance=0.01,alpha=0.05,stratify=False,initial_size=1000,n_boot=200,n_jobs=1,seed=None,norm='CS'):
+    """Estimates the normalized hierarchical mutual information out of a sample of the elements.
+
+    Comments:
+        A sample of the common elements is drawn without replacement, and i(T;T') is computed on both trees restricted to it, directly over the rows of their label matrices (see **_label_hmi()**). All values, including I(T;T) and I(T';T'), are computed over the common elements only, as in **bootstrap_nhmi()**; so, the estimated value is that of **normalized_hierarchical_mutual_information(T,T',restrict=True)**.
+        The sample starts with **initial_size** elements, and it is doubled (extending the previous one). The value over a sample overestimates the exact one; assuming that the bias shrinks as 1/k-1/n for a sample of k out of n elements, the change of the value since the previous sample estimates the bias left, which is subtracted. The spread of the value is estimated by bootstrap (see **bootstrap_nhmi()**). The doubling stops when both the estimated bias and the half-width of the bootstrap interval are at most **tolerance**, and the interval is widened by the estimated bias. So, the cost of the estimation grows with 1/tolerance^2 rather than with the number of elements; only the encoding of the trees, which is cached by each tree, takes linear time. If the sample reaches all the common elements, the exact value is returned.
+        With **stratify**, the sample is split across the top-level communities of T in proportion to their sizes, and each sampled element is weighted by the inverse of the sampling fraction of its community. The bootstrap then resamples each community on its own.
+        Notice that the interval is not a coverage guarantee. For samples that are small compared to the number of leaves, the bias shrinks more slowly than assumed, so the estimate and the interval stay too high; smaller tolerances, which lead to larger samples, reduce this.
+
+    Parameters
+    ----------
+    hierpart_x : HierarchicalPartition
+        The tree T.
+    hierpart_y : HierarchicalPartition
+        The tree T'.
+    tolerance : <float=0.01>
+        The largest accepted half-width of the confidence interval.
+    alpha : <float=0.05>
+        The confidence interval covers 1-alpha of the bootstrap distribution.
+    stratify : <bool=False>
+        If True, the sample is stratified by the top-level communities of T.
+    initial_size : <int=1000>
+        The size of the first sample.
+    n_boot : <int=200>
+        The number of bootstrap replicates for each sample size.
+    n_jobs : <int=1>
+        The number of processes for the bootstrap.
+    seed : <int=None>
+        The seed of the sampling and of the bootstrap.
+    norm : <str='CS'>
+        One of 'CS', 'add' or 'max' (see **normalized_hierarchical_mutual_information()**).
+
+    Returns
+    -------
+    : (<float>,<float>,<float>,<int>)
+        It returns the estimate of i(T;T'), the lower and upper ends of its interval, and the size of the sample.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import approximate_nhmi, normalized_hierarchical_mutual_information
+    >>> hpx=HierarchicalPartition(range(4000))
+    >>> n1=hpx.add_child(hpx.root(),range(2000))
+    >>> n2=hpx.add_child(hpx.root(),range(2000,4000))
+    >>> for i in xrange(0,4000,500): dummy=hpx.add_child(n1 if i<2000 else n2,range(i,i+500))
+    >>> hpy=HierarchicalPartition(range(4000))
+    >>> n1=hpy.add_child(hpy.root(),range(1500))
+    >>> n2=hpy.add_child(hpy.root(),range(1500,4000))
+    >>> print '%.2f %.2f %.2f %d' % approximate_nhmi(hpx,hpy,tolerance=0.05,initial_size=200,seed=1,stratify=True)
+    0.34 0.30 0.38 400
+    >>> print '%.2f' % normalized_hierarchical_mutual_information(hpx,hpy)[0]
+    0.32
+    >>> print approximate_nhmi(hpx,hpy,tolerance=0.0,initial_size=200,seed=1)[3]
+    4000
+    """
+    assert norm in ('CS','add','max'), "ERROR: norm should be one of 'CS','add','max'"
+    assert 0.0<alpha<1.0, 'ERROR in approximate_nhmi: alpha should be in (0,1).'
+    assert n_boot>0, 'ERROR in approximate_nhmi: n_boot should be positive.'
+    assert initial_size>0, 'ERROR in approximate_nhmi: initial_size should be positive.'
+    ids_x,ids_y=_aligned_element_ids(hierpart_x,hierpart_y)
+    n=len(ids_x)
+    element_weights=_common_weights(hierpart_x,hierpart_y,ids_x,ids_y)
+    Lx=hierpart_x._label_matrix()
+    Ly=hierpart_y._label_matrix()
+    nonleaf_x=hierpart_x._nonleaf_mask()
+    nonleaf_y=hierpart_y._nonleaf_mask()
+    rng=numpy.random.RandomState(seed)
+    # Each stratum is kept as a random permutation of its rows; a sample takes a prefix of each one.
+    if stratify and Lx.shape[1]>1:
+        labels,num_strata=_compact_labels(Lx[ids_x,1])
+        order=numpy.argsort(labels,kind='mergesort')
+        bounds=numpy.zeros(num_strata+1,dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(labels,minlength=num_strata),out=bounds[1:])
+        strata=[order[bounds[k]:bounds[k+1]] for k in xrange(num_strata)]
+    else:
+        strata=[numpy.arange(n,dtype=numpy.int64)]
+    strata=[stratum[rng.permutation(len(stratum))] for stratum in strata]
+    stratum_sizes=numpy.array([len(stratum) for stratum in strata],dtype=numpy.int64)
+    size=min(initial_size,n)
+    previous=None
+    while True:
+        if size>=n:
+            HMI_xy=_label_hmi(Lx[ids_x],Ly[ids_y],nonleaf_x,nonleaf_y,weights=element_weights)
+            HMI_xx=_label_hmi(Lx[ids_x],Lx[ids_x],nonleaf_x,nonleaf_x,weights=element_weights)
+            HMI_yy=_label_hmi(Ly[ids_y],Ly[ids_y],nonleaf_y,nonleaf_y,weights=element_weights)
+            NHMI=_normalize_hmi(HMI_xy,HMI_xx,HMI_yy,norm)[0]
+            return NHMI,NHMI,NHMI,n
+        sample_sizes=numpy.minimum(stratum_sizes,numpy.maximum(1,numpy.round(size*stratum_sizes/float(n)).astype(numpy.int64)))
+        rows=numpy.concatenate([stratum[:k] for stratum,k in zip(strata,sample_sizes.tolist())])
+        weights=numpy.repeat(stratum_sizes/sample_sizes.astype(numpy.double),sample_sizes)
+        if element_weights is not None:
+            weights=weights*element_weights[rows]
+        offsets=numpy.zeros(len(strata)+1,dtype=numpy.int64)
+        numpy.cumsum(sample_sizes,out=offsets[1:])
+        Lx_sample=Lx[ids_x[rows]]
+        Ly_sample=Ly[ids_y[rows]]
+        HMI_xy=_label_hmi(Lx_sample,Ly_sample,nonleaf_x,nonleaf_y,weights=weights)
+        HMI_xx=_label_hmi(Lx_sample,Lx_sample,nonleaf_x,nonleaf_x,weights=weights)
+        HMI_yy=_label_hmi(Ly_sample,Ly_sample,nonleaf_y,nonleaf_y,weights=weights)
+        NHMI=_normalize_hmi(HMI_xy,HMI_xx,HMI_yy,norm)[0]
+        replicates=_bootstrap_replicates(Lx_sample,Ly_sample,nonleaf_x,nonleaf_y,norm,weights,n_boot,n_jobs,rng.randint(0,2**31-1),strata=offsets)
+        # The interval is the basic bootstrap interval, but reflected around the mean of the replicates instead of the value, and then moved to the value: the bias
+        # of the replicates is not subtracted, since the bias is estimated, and subtracted, from the change of the value between samples.
+        low,high=numpy.percentile(replicates,[100.0*alpha/2.0,100.0*(1.0-alpha/2.0)])
+        if previous is not None:
+            # The bias of a sample of k out of n elements shrinks roughly as 1/k-1/n, so the change since the previous (half) sample estimates the bias left.
+            bias=(previous-NHMI)*(1.0-len(rows)/float(n))
+            if (high-low)/2.0<=tolerance and abs(bias)<=tolerance:
+                center=replicates.mean()
+                NHMI-=bias
+                return float(NHMI),float(NHMI-(high-center)-abs(bias)),float(NHMI+(center-low)+abs(bias)),len(rows)
+        previous=NHMI
+        size*=2
+
+# Level-wise comparison tools
+##############################
+
+def _aligned_element_ids(hierpart_x,hierpart_y):
+    """Returns two <numpy.ndarray> with the positions, in **all_elements()** of each tree, of the elements common to both trees."""
+    if hierpart_x.elements_are_indices() and hierpart_y.elements_are_indices():
+        ids=numpy.arange(min(hierpart_x.total_num_elements(),hierpart_y.total_num_elements()),dtype=numpy.int64)
+        return ids,ids
+    elements_x=hierpart_x.all_elements()
+    elements_y=hierpart_y.all_elements()
+    if hierpart_x.elements_are_indices():
+        elements_x=elements_x.tolist()
+    if hierpart_y.elements_are_indices():
+        elements_y=elements_y.tolist()
+    if elements_x==elements_y:
+        ids=numpy.arange(len(elements_x),dtype=numpy.int64)
+        return ids,ids
+    index_y=hierpart_y._element_index()
+    ids_x=[]
+    ids_y=[]
+    for i,element in enumerate(elements_x):
+        j=index_y.get(element)
+        if j is not None:
+            ids_x.append(i)
+            ids_y.append(j)
+    return numpy.array(ids_x,dtype=numpy.int64),numpy.array(ids_y,dtype=numpy.int64)
+
+def _compact_labels(labels):
+    """Relabels **labels** as consecutive integers 0,1,... Returns the new labels and the number of different labels."""
+    uniques,compact=numpy.unique(labels,return_inverse=True)
+    return compact.astype(numpy.int64),len(uniques)
+
+def _entropy_of_counts(counts,n):
+    """Computes the entropy, in nats, of the distribution counts/n."""
+    counts=counts[counts>0].astype(numpy.double)
+    return numpy.log(n)-(counts*numpy.log(counts)).sum()/n
+
+def _comb2_sum(counts):
+    counts=counts.astype(numpy.double)
+    return (counts*(counts-1.0)).sum()/2.0
+
+def levelwise_similarity(hierpart_x,hierpart_y,metric='nmi'):
+    """Compares every level of a tree against every level of another tree.
+    The level at depth d of a tree is the flat partition given by **level_labels(d)**.
+
+    Comments:
+        Only the elements common to both trees are considered.
+        All contingency tables are built out of the encoded labels of **label_matrix()**, with vectorized bincounts. Each level is relabeled once, with consecutive labels; then, a pair of levels is counted by a bincount of the combined labels, without sorting, unless the pair has more than 4n possible combinations.
+
+    Parameters
+    ----------
+    hierpart_x : HierarchicalPartition
+        The hierarchical partition T.
+    hierpart_y : HierarchicalPartition
+        The hierarchical partition T'.
+    metric : <str='nmi'>
+        One of 'nmi' (normalized mutual information) or 'ari' (adjusted Rand index). The 'nmi' is defined as I(X;Y)/sqrt(H(X)H(Y)), and it is 0.0 if any of the entropies vanishes.
+
+    Returns
+    -------
+    : <numpy.ndarray>
+        An array of shape (T.max_depth(),T'.max_depth()). The entry [i,j] compares depth i+1 of T against depth j+1 of T'.
+
+    Example
+    -------
+    >>> from hierpart import HierarchicalPartition
+    >>> from hierpart import levelwise_similarity
+    >>> hpx=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> rootx=hpx.root()
+    >>> n1x=hpx.add_child(rootx,['a','b','c'])
+    >>> n2x=hpx.add_child(rootx,['d','e','f'])
+    >>> dummy=hpx.add_child(n1x,['a'])
+    >>> n3x=hpx.add_child(n1x,['b','c'])
+    >>> dummy=hpx.add_child(n3x,['b'])
+    >>> dummy=hpx.add_child(n3x,['c'])
+    >>> hpy=HierarchicalPartition(['a','b','c','d','e','f'])
+    >>> rooty=hpy.root()
+    >>> n1y=hpy.add_child(rooty,['a','b','c'])
+    >>> n2y=hpy.add_child(rooty,['d','e','f'])
+    >>> dummy=hpy.add_child(n2y,['f'])
+    >>> n3y=hpy.add_child(n2y,['d','e'])
+    >>> dummy=hpy.add_child(n3y,['d'])
+    >>> dummy=hpy.add_child(n3y,['e'])
+    >>> m=levelwise_similarity(hpx,hpy)
+    >>> print m.shape
+    (3, 3)
+    >>> print '%.6f %.6f %.6f' % (m[0,0],m[1,1],m[2,2])
+    1.000000 0.685331 0.557886
+    >>> m=levelwise_similarity(hpx,hpy,metric='ari')
+    >>> print '%.6f %.6f' % (m[0,0],m[1,1])
+    1.000000 0.318182
+    """
+    assert metric in ('nmi','ari'), "ERROR: metric should be one of 'nmi','ari'"
+    ids_x,ids_y=_aligned_element_ids(hierpart_x,hierpart_y)
+    n=len(ids_x)
+    Lx=hierpart_x.label_matrix()[ids_x]
+    Ly=hierpart_y.label_matrix()[ids_y]
+    levels_x=[_compact_labels(Lx[:,i]) for i in xrange(Lx.shape[1])]
+    levels_y=[_compact_labels(Ly[:,j]) for j in xrange(Ly.shape[1])]
+    sizes_x=[numpy.bincount(a,minlength=k) for a,k in levels_x]
+    sizes_y=[numpy.bincount(b,minlength=k) for b,k in levels_y]
+    if metric=='nmi':
+        H_x=[_entropy_of_counts(c,n) for c in sizes_x]
+        H_y=[_entropy_of_counts(c,n) for c in sizes_y]
+    else:
+        C_x=[_comb2_sum(c) for c in sizes_x]
+        C_y=[_comb2_sum(c) for c in sizes_y]
+        C_n=n*(n-1.0)/2.0
+    similarity=numpy.zeros((len(levels_x),len(levels_y)),dtype=numpy.double)
+    for i,(a,ka) in enumerate(levels_x):
+        for j,(b,kb) in enumerate(levels_y):
+            if ka*kb<=4*n:
+                # The levels are already compact, so the combined key indexes a dense contingency table.
+                counts=numpy.bincount(a*kb+b,minlength=ka*kb)
+            else:
+                joint,dummy=_compact_labels(a*kb+b)
+                counts=numpy.bincount(joint)
+            if metric=='nmi':
+                _prod=H_x[i]*H_y[j]
+                if _prod>0.0:
+                    MI=H_x[i]+H_y[j]-_entropy_of_counts(counts,n)
+                    similarity[i,j]=MI/(_prod**0.5)
+            else:
+                expected=C_x[i]*C_y[j]/C_n if C_n>0.0 else 0.0
+                _max=0.5*(C_x[i]+C_y[j])
+                if _max-expected!=0.0:
+                    similarity[i,j]=(_comb2_sum(counts)-expected)/(_max-expected)
+                else:
+                    similarity[i,j]=1.0
+    return similarity
 
 # Examples
 # ========
@@ -15,6 +15,8 @@ def run_doctests():
     sys.path.append('../')
     m = __import__('hierpart')
     doctest.testmod(m)
+    c = __import__('cli')
+    doctest.testmod(c)
 
 if __name__=='__main__':
     run_doctests()
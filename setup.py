@@ -8,4 +8,5 @@ setup(name='hierpart',
       author_email='juanpool at gmail.com',
       license='GPL-2.0',
       packages=['hierpart'],
+      entry_points={'console_scripts':['hierpart=hierpart.cli:main']},
       zip_safe=False)